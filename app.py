@@ -1,7 +1,8 @@
+import re
 import streamlit as st
 import pandas as pd
 from src.db_manager import DatabaseManager
-from src.agents import agent_workflow
+from src.agent_jobs import submit_job, get_job, cancel_job, JOB_POLL_INTERVAL_S
 from src.visualizer import (
     create_age_distribution,
     create_bmi_distribution,
@@ -72,6 +73,7 @@ def main():
     from src.session_db import SessionDatabaseManager
     from src.data_preprocessor import DataPreprocessor
     from src.file_reader import DataFileReader
+    from src.ingestion import ingest_files
     
     session_db = SessionDatabaseManager()
     preprocessor = DataPreprocessor()
@@ -82,109 +84,56 @@ def main():
         "Upload Patients Files",
         type=file_reader.get_supported_formats(),
         accept_multiple_files=True,
-        help="Upload one or more patients data files (CSV, Excel, JSON, TXT)",
+        help="Upload one or more patients data files (CSV, Excel, JSON, TXT, Parquet, Feather/Arrow)",
         key="patients_upload"
     )
     
-    if patients_files:
-        for uploaded_file in patients_files:
-            file_name = uploaded_file.name.rsplit('.', 1)[0].replace(' ', '_')
-            
-            if not session_db.table_exists(file_name):
-                try:
-                    file_ext = uploaded_file.name.split('.')[-1].lower()
-                    sheet_msg = ""
-                    
-                    if file_ext in ['xlsx', 'xls']:
-                        result = file_reader.read_file(uploaded_file)
-                        df, file_info, sheet_names = result
-                        df, file_info, _ = file_reader.read_file(uploaded_file, sheet_name=sheet_names[0])
-                        if len(sheet_names) > 1:
-                            sheet_msg = f" (Used sheet: '{sheet_names[0]}')"
-                    else:
-                        df, file_info = file_reader.read_file(uploaded_file)
-                    
-                    
-                    # 1. Smart Header Detection
-                    promoted_msg = ""
-                    row_idx, df_promoted = preprocessor.find_best_header_row(df)
-                    if row_idx != -1:
-                        df = df_promoted
-                        promoted_msg = f" (Auto-detected header at row {row_idx+1})"
-                    
-                    # 2. Normalize columns
-                    df, mapping_log = preprocessor.normalize_columns(df)
-                    
-                    is_valid, msg = preprocessor.validate_patients_schema(df)
-                    if is_valid:
-                        df_clean = preprocessor.preprocess_patients_data(df)
-                        session_db.create_table_from_df(df_clean, file_name, 'patients')
-                        st.sidebar.success(f"✅ {uploaded_file.name}: {len(df_clean)} patients{sheet_msg}{promoted_msg}")
-                        with st.sidebar.expander("🔍 Column Mapping Details"):
-                            st.json(mapping_log)
-                    else:
-                        st.sidebar.error(f"❌ {uploaded_file.name}: {msg}")
-                        st.sidebar.warning(f"Found columns: {list(df.columns)}")
-                        with st.sidebar.expander("🔍 Column Mapping Details", expanded=True):
-                            st.write("Original -> Mapped")
-                            st.json(mapping_log)
-                
-                except Exception as e:
-                    st.sidebar.error(f"❌ {uploaded_file.name}: {str(e)}")
-    
     st.sidebar.markdown("#### 🏃 Activity Data")
     activity_files = st.sidebar.file_uploader(
         "Upload Activity Files",
         type=file_reader.get_supported_formats(),
         accept_multiple_files=True,
-        help="Upload one or more activity data files (CSV, Excel, JSON, TXT)",
+        help="Upload one or more activity data files (CSV, Excel, JSON, TXT, Parquet, Feather/Arrow)",
         key="activity_upload"
     )
     
-    if activity_files:
-        for uploaded_file in activity_files:
-            file_name = uploaded_file.name.rsplit('.', 1)[0].replace(' ', '_')
-            
-            if not session_db.table_exists(file_name):
-                try:
-                    file_ext = uploaded_file.name.split('.')[-1].lower()
-                    sheet_msg = ""
-                    
-                    if file_ext in ['xlsx', 'xls']:
-                        result = file_reader.read_file(uploaded_file)
-                        df, file_info, sheet_names = result
-                        df, file_info, _ = file_reader.read_file(uploaded_file, sheet_name=sheet_names[0])
-                        if len(sheet_names) > 1:
-                            sheet_msg = f" (Used sheet: '{sheet_names[0]}')"
-                    else:
-                        df, file_info = file_reader.read_file(uploaded_file)
-                    
-                    # 1. Smart Header Detection
-                    promoted_msg = ""
-                    row_idx, df_promoted = preprocessor.find_best_header_row(df)
-                    if row_idx != -1:
-                        df = df_promoted
-                        promoted_msg = f" (Auto-detected header at row {row_idx+1})"
-                    
-                    # 2. Normalize columns
-                    df, mapping_log = preprocessor.normalize_columns(df)
-                    
-                    is_valid, msg = preprocessor.validate_activity_schema(df)
-                    if is_valid:
-                        df_clean = preprocessor.preprocess_activity_data(df)
-                        session_db.create_table_from_df(df_clean, file_name, 'activity')
-                        st.sidebar.success(f"✅ {uploaded_file.name}: {len(df_clean)} records{sheet_msg}{promoted_msg}")
-                        with st.sidebar.expander("🔍 Column Mapping Details"):
-                            st.json(mapping_log)
-                    else:
-                        st.sidebar.error(f"❌ {uploaded_file.name}: {msg}")
-                        st.sidebar.warning(f"Found columns: {list(df.columns)}")
-                        with st.sidebar.expander("🔍 Column Mapping Details", expanded=True):
-                            st.write("Original -> Mapped")
-                            st.json(mapping_log)
-                
-                except Exception as e:
-                    st.sidebar.error(f"❌ {uploaded_file.name}: {str(e)}")
+    uploads = [(f, 'patients') for f in patients_files or []] + [(f, 'activity') for f in activity_files or []]
+    if uploads:
+        progress = st.sidebar.empty()
+        
+        def show_progress(result, done, total):
+            progress.progress(done / total, text=f"Processed {done}/{total}: {result['file_name']}")
+        
+        try:
+            results = ingest_files(session_db, uploads, preprocessor, on_result=show_progress)
+        except Exception as e:
+            results = []
+            st.sidebar.error(f"❌ Upload failed, no files were added: {str(e)}")
+        progress.empty()
+        
+        for r in results:
+            if r['duplicate_of']:
+                st.sidebar.info(f"ℹ️ {r['file_name']}: {r['message']}, not loaded again")
+            elif r['error']:
+                st.sidebar.error(f"❌ {r['file_name']}: {r['error']}")
+            elif r['valid']:
+                unit = "patients" if r['data_type'] == 'patients' else "records"
+                promoted_msg = f" (Auto-detected header at row {r['header_row']+1})" if r['header_row'] != -1 else ""
+                renamed_msg = f" as '{r['table_name']}'" if r['table_name'] != r['file_name'].rsplit('.', 1)[0].replace(' ', '_') else ""
+                st.sidebar.success(f"✅ {r['file_name']}: {r['rows']} {unit}{r['sheet_msg']}{promoted_msg}{renamed_msg}")
+                with st.sidebar.expander("🔍 Column Mapping Details"):
+                    st.json(r['mapping_log'])
+                    if r.get('compacted'):
+                        saved = r['bytes_before'] - r['bytes_after']
+                        st.caption(f"Compact types saved {saved / 1e6:.1f} MB "
+                                   f"({saved / max(r['bytes_before'], 1):.0%}): "
+                                   + ", ".join(f"{col} → {t}" for col, t in r['compacted'].items()))
+            else:
+                st.sidebar.error(f"❌ {r['file_name']}: {r['message']}")
+                st.sidebar.warning(f"Found columns: {r['columns']}")
+                with st.sidebar.expander("🔍 Column Mapping Details", expanded=True):
+                    st.write("Original -> Mapped")
+                    st.json(r['mapping_log'])
     
     
     uploaded_sources = session_db.get_uploaded_sources()
@@ -202,6 +151,16 @@ def main():
     
     if uploaded_sources:
         st.sidebar.markdown("**Loaded Sources:**")
+        if session_db.persisted:
+            st.sidebar.caption("💾 Saved with this session — keep the page URL to come back to them. "
+                               "Tables are read from the session file; memory is capped at the quota.")
+        
+        usage = session_db.memory_usage()
+        st.sidebar.progress(
+            min(1.0, usage['used_bytes'] / usage['quota_bytes']),
+            text=f"Memory: {usage['used_bytes'] / 1e6:.1f} / {usage['quota_bytes'] / 1e6:.0f} MB"
+                 + (f" (+{usage['offloaded_bytes'] / 1e6:.1f} MB on disk)" if usage['offloaded_bytes'] else "")
+        )
         
         patients_sources = {k: v for k, v in uploaded_sources.items() if v['type'] == 'patients'}
         activity_sources = {k: v for k, v in uploaded_sources.items() if v['type'] == 'activity'}
@@ -211,7 +170,8 @@ def main():
             for table_name, info in patients_sources.items():
                 col1, col2 = st.sidebar.columns([3, 1])
                 with col1:
-                    st.sidebar.caption(f"• {table_name} ({info['rows']} rows)")
+                    size = f", {info.get('bytes', 0) / 1e6:.1f} MB" + (" on disk" if info.get('offloaded') else "")
+                    st.sidebar.caption(f"• {table_name} ({info['rows']} rows{size})")
                 with col2:
                     if st.sidebar.button("🗑️", key=f"remove_{table_name}", help=f"Remove {table_name}"):
                         session_db.remove_table(table_name)
@@ -222,7 +182,8 @@ def main():
             for table_name, info in activity_sources.items():
                 col1, col2 = st.sidebar.columns([3, 1])
                 with col1:
-                    st.sidebar.caption(f"• {table_name} ({info['rows']} rows)")
+                    size = f", {info.get('bytes', 0) / 1e6:.1f} MB" + (" on disk" if info.get('offloaded') else "")
+                    st.sidebar.caption(f"• {table_name} ({info['rows']} rows{size})")
                 with col2:
                     if st.sidebar.button("🗑️", key=f"remove_{table_name}", help=f"Remove {table_name}"):
                         session_db.remove_table(table_name)
@@ -970,6 +931,174 @@ def module_preventive():
             except Exception as e:
                 st.error(f"Error loading stress data: {str(e)}")
 
+def render_strategic_result(result):
+    if result["success"]:
+        if result.get("fast_path"):
+            st.caption(f"⚡ Answered instantly from the `{result['fast_path']}` query template")
+        if result.get("cached_from"):
+            cached_from = result["cached_from"]
+            st.caption(f"♻️ Reused the plan of a similar question ({cached_from['similarity']:.0%} match): "
+                       f"\"{cached_from['question']}\"")
+
+        # 1. Main Insight & Recommendations (Prominent)
+        st.markdown(f"""
+        <div style="background-color: #e8f5e9; padding: 20px; border-radius: 10px; border-left: 5px solid #2e7d32; margin-bottom: 20px;">
+            <h3 style="color: #1b5e20; margin-top: 0;">💡 Strategic Insights</h3>
+            <p style="font-size: 1.1em; color: #333;">{result["insight"]}</p>
+        </div>
+        """, unsafe_allow_html=True)
+
+        # 2. Key Insights (Hidden by default)
+        if result.get("key_insights", []):
+            with st.expander("🔍 View Key Insights", expanded=False):
+                st.markdown("**Key Insights:**")
+                for insight in result.get("key_insights", []):
+                    st.markdown(f"- {insight}")
+        
+        if result.get("recommendations"):
+            rec_items = "".join([f"<li style='margin-bottom: 8px;'>{rec}</li>" for rec in result['recommendations']])
+            st.markdown(f"""
+            <div style="background-color: #e3f2fd; padding: 20px; border-radius: 10px; border-left: 5px solid #1565c0; margin-bottom: 20px;">
+                <h3 style="color: #0d47a1; margin-top: 0;">📋 Recommendations</h3>
+                <ul style="color: #333; font-size: 1.05em; margin-bottom: 0; padding-left: 20px;">
+                    {rec_items}
+                </ul>
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # 2. Technical Details (Hidden by default)
+        with st.expander("🔍 View Technical Details (SQL & Data)", expanded=False):
+            planner_label = f" · planner: {result['planner']}" if result.get("planner") else ""
+            st.caption(f"LLM calls: {result.get('llm_calls', 0)} · SQL repairs: {result.get('sql_repairs', 0)}{planner_label}")
+            compliance_stats = result.get("compliance", {})
+            if compliance_stats.get("round_trips_saved"):
+                st.caption(
+                    f"Compliance: {compliance_stats['reviewed']} step(s) reviewed in "
+                    f"{compliance_stats['llm_calls']} call(s), {compliance_stats['round_trips_saved']} round trip(s) saved "
+                    f"({compliance_stats['latency_ms']:.0f} ms)"
+                )
+            shared_stats = result.get("shared_execution", {})
+            if shared_stats.get("deduplicated") or shared_stats.get("cohorts_materialized"):
+                st.caption(
+                    f"Shared work: {shared_stats['deduplicated']} duplicate step(s) reused, "
+                    f"{shared_stats['cohorts_materialized']} cohort(s) materialized once "
+                    f"and reused {shared_stats['cohort_reuses']} time(s)"
+                )
+            compaction = result.get("compaction", {})
+            if compaction.get("tokens_saved", 0) > 0:
+                st.caption(
+                    f"Insight prompt compacted {compaction['compression_ratio']}x: "
+                    f"~{compaction['original_tokens']:,} → ~{compaction['compact_tokens']:,} tokens "
+                    f"(~{compaction['tokens_saved']:,} saved)"
+                )
+            st.markdown("**Execution Steps:**")
+            for i, step in enumerate(result.get("steps", []), 1):
+                st.markdown(f"---")
+                st.markdown(f"**Step {i}:** {step['description']}")
+                st.code(step['sql'], language="sql")
+                
+                if step['data'] is not None and not step['data'].empty:
+                    st.dataframe(step['data'], use_container_width=True)
+                else:
+                    st.write("No data returned for this step.")
+    elif result.get("cancelled"):
+        st.warning("⏹️ Analysis cancelled.")
+    else:
+        st.error(result["error"])
+    
+    # 3. Performance Trace (Hidden by default)
+    trace = result.get("trace")
+    if trace:
+        with st.expander("⏱️ Performance", expanded=False):
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                render_metric_card("Total Time", f"{trace['total_ms'] / 1000:.2f}s")
+            with col2:
+                render_metric_card("LLM Calls", trace["llm_calls"])
+            with col3:
+                render_metric_card("Prompt Tokens", f"{trace['prompt_tokens']:,}")
+            with col4:
+                render_metric_card("Completion Tokens", f"{trace['completion_tokens']:,}")
+            
+            st.markdown("**Time by Stage:**")
+            stages_df = pd.DataFrame.from_dict(trace["stages"], orient="index")
+            stages_df.index.name = "stage"
+            st.dataframe(stages_df.sort_values("duration_ms", ascending=False), use_container_width=True)
+            
+            if trace.get("models"):
+                st.markdown("**LLM Latency by Stage & Model:**")
+                st.dataframe(pd.DataFrame(trace["models"]), use_container_width=True)
+            
+            st.markdown("**Spans:**")
+            st.dataframe(pd.DataFrame(trace["spans"]), use_container_width=True)
+            st.caption(f"Trace `{trace['trace_id']}` appended to the agent trace log.")
+
+def render_job_progress(events):
+    """
+    Live plan / step / insight view rebuilt from a job's events so far.
+    """
+    plan_title, plan_lines, steps, draft = None, "", {}, ""
+    for event in events:
+        if event["type"] == "plan_ready":
+            plan_title = "⚡ Instant answer plan" if event.get("fast_path") else "🧭 Analysis plan"
+            plan_lines = "\n".join(f"{i}. {s['description']}" for i, s in enumerate(event["steps"], 1))
+            # A fast-path fallback re-plans, so start the step list afresh
+            steps = {s["step"]: None for s in event["steps"]}
+            draft = ""
+        elif event["type"] in ("step_started", "step_finished"):
+            if event["step"] in steps:
+                steps[event["step"]] = event
+        elif event["type"] == "insight_token":
+            draft += event["token"]
+    
+    if plan_title is None:
+        st.info("🧭 Planning the analysis...")
+        return
+    st.markdown(f"**{plan_title}:**\n\n{plan_lines}")
+    
+    for step, event in steps.items():
+        if event is None:
+            continue
+        if event["type"] == "step_started":
+            st.info(f"⏳ Step {step}: {event['description']}")
+        elif event["status"] == "ok":
+            st.success(f"✅ Step {step}: {event['description']}")
+            if event["data"] is not None and not event["data"].empty:
+                st.dataframe(event["data"].head(20), use_container_width=True)
+        elif event["status"] == "blocked":
+            st.warning(f"🛡️ Step {step} blocked: {event.get('message', '')}")
+        else:
+            st.error(f"❌ Step {step} failed: {event.get('message', '')}")
+    
+    if draft:
+        # Hide the model's <think> reasoning, including an unterminated block
+        visible = re.sub(r'<think>.*?(</think>|$)', '', draft, flags=re.DOTALL).strip()
+        if visible:
+            st.code(visible[-2000:], language="json")
+        else:
+            st.info("🤔 Reasoning over the results...")
+
+def render_strategic_job(job_id, polling):
+    job = get_job(job_id)
+    if job is None:
+        return
+    if job.finished:
+        if polling:
+            # Stop polling: rerun the page once so the fragment is rebuilt without a timer
+            st.rerun()
+        render_strategic_result(job.result)
+        return
+    
+    col_status, col_cancel = st.columns([4, 1])
+    with col_status:
+        st.caption(f"Running in the background: *{job.user_query}*")
+    with col_cancel:
+        if job.cancel_event.is_set():
+            st.caption("Cancelling...")
+        elif st.button("⏹️ Cancel", key=f"cancel_{job_id}"):
+            cancel_job(job_id)
+    render_job_progress(job.snapshot())
+
 def module_strategic():
     st.markdown("<h1 style='text-align: center; margin-top: 0;'>🧠 NeuroHealth Nexus</h1>", unsafe_allow_html=True)
     st.markdown("<h3 style='text-align: center; color: #666;'>📊 Strategic Intelligence - Natural Language Query Interface</h3>", unsafe_allow_html=True)
@@ -1024,56 +1153,43 @@ def module_strategic():
             placeholder="e.g., What is the average age of patients with chronic kidney disease?"
         )
         
+        col_opt1, col_opt2 = st.columns(2)
+        with col_opt1:
+            template_insights = st.checkbox(
+                "💡 Generate AI narrative for instant answers",
+                value=True,
+                help="Common questions are answered from pre-approved SQL templates without query planning. "
+                     "Uncheck to skip the narrative and show the data immediately."
+            )
+        with col_opt2:
+            planner_mode = st.selectbox(
+                "Planner Mode",
+                options=["multi", "single"],
+                format_func=lambda m: "Multi-step (plan, then SQL per step)" if m == "multi" else "Single round trip (plan + SQL together)",
+                help="Single round trip is faster for simple questions and falls back to multi-step if its output is invalid."
+            )
+        
         if st.button("Run Query", type="primary"):
             if user_query:
-                with st.spinner("Processing your query..."):
-                    include_uploaded = st.session_state.get('include_uploaded_data', False)
-                    # Pass the executor and checkbox state to the agent workflow
-                    result = agent_workflow(user_query, executor, include_uploaded)
-                    
-                    if result["success"]:
-                        # 1. Main Insight & Recommendations (Prominent)
-                        st.markdown(f"""
-                        <div style="background-color: #e8f5e9; padding: 20px; border-radius: 10px; border-left: 5px solid #2e7d32; margin-bottom: 20px;">
-                            <h3 style="color: #1b5e20; margin-top: 0;">💡 Strategic Insights</h3>
-                            <p style="font-size: 1.1em; color: #333;">{result["insight"]}</p>
-                        </div>
-                        """, unsafe_allow_html=True)
-
-                        # 2. Key Insights (Hidden by default)
-                        if result.get("key_insights", []):
-                            with st.expander("🔍 View Key Insights", expanded=False):
-                                st.markdown("**Key Insights:**")
-                                for insight in result.get("key_insights", []):
-                                    st.markdown(f"- {insight}")
-                        
-                        if result.get("recommendations"):
-                            rec_items = "".join([f"<li style='margin-bottom: 8px;'>{rec}</li>" for rec in result['recommendations']])
-                            st.markdown(f"""
-                            <div style="background-color: #e3f2fd; padding: 20px; border-radius: 10px; border-left: 5px solid #1565c0; margin-bottom: 20px;">
-                                <h3 style="color: #0d47a1; margin-top: 0;">📋 Recommendations</h3>
-                                <ul style="color: #333; font-size: 1.05em; margin-bottom: 0; padding-left: 20px;">
-                                    {rec_items}
-                                </ul>
-                            </div>
-                            """, unsafe_allow_html=True)
-                        
-                        # 2. Technical Details (Hidden by default)
-                        with st.expander("🔍 View Technical Details (SQL & Data)", expanded=False):
-                            st.markdown("**Execution Steps:**")
-                            for i, step in enumerate(result.get("steps", []), 1):
-                                st.markdown(f"---")
-                                st.markdown(f"**Step {i}:** {step['description']}")
-                                st.code(step['sql'], language="sql")
-                                
-                                if step['data'] is not None and not step['data'].empty:
-                                    st.dataframe(step['data'], use_container_width=True)
-                                else:
-                                    st.write("No data returned for this step.")
-                    else:
-                        st.error(result["error"])
+                include_uploaded = st.session_state.get('include_uploaded_data', False)
+                # A new question supersedes a run that is still in flight
+                previous_job = get_job(st.session_state.get('strategic_job_id'))
+                if previous_job is not None:
+                    cancel_job(previous_job.job_id)
+                
+                # The run continues in the background across reruns; only its id lives in the session
+                st.session_state.strategic_job_id = submit_job(
+                    user_query, executor, include_uploaded=include_uploaded,
+                    template_insights=template_insights, planner_mode=planner_mode
+                )
             else:
                 st.warning("Please enter a question")
+        
+        job = get_job(st.session_state.get('strategic_job_id'))
+        if job is not None:
+            # Poll only while the job runs, and only this fragment rather than the whole page
+            polling = not job.finished
+            st.fragment(run_every=JOB_POLL_INTERVAL_S if polling else None)(render_strategic_job)(job.job_id, polling)
     
     with tab2:
         st.subheader("Population Health Metrics")
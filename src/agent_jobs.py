@@ -0,0 +1,124 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from src.agents import agent_workflow_stream
+
+# Agent runs as background jobs, so Streamlit reruns neither block on nor
+# discard in-flight work. The UI keeps only the job id in st.session_state
+# and polls the job's events.
+
+AGENT_JOB_WORKERS = int(os.getenv('AGENT_JOB_WORKERS', 4))
+
+# Finished jobs are forgotten after this many seconds
+AGENT_JOB_TTL_S = int(os.getenv('AGENT_JOB_TTL_S', 3600))
+
+# How often the UI refreshes a running job's progress
+JOB_POLL_INTERVAL_S = 0.5
+
+_jobs: Dict[str, "AgentJob"] = {}
+_jobs_lock = threading.Lock()
+
+class AgentJob:
+    """
+    One agent_workflow_stream run. Events are appended as they arrive; the
+    last one is always "complete" (also stored as `result`).
+    """
+
+    def __init__(self, user_query: str):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.user_query = user_query
+        self.status = "queued"   # queued -> running -> done | cancelled | failed
+        self.events: List[Dict[str, Any]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.cancel_event = threading.Event()
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "cancelled", "failed")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return list(self.events)
+
+    def _append(self, event: Dict[str, Any]):
+        with self.lock:
+            self.events.append(event)
+
+    def _finish(self, status: str, result: Dict[str, Any]):
+        with self.lock:
+            self.result = result
+            self.status = status
+            self.finished_at = time.time()
+
+@lru_cache(maxsize=None)
+def _pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=AGENT_JOB_WORKERS, thread_name_prefix="agent-job")
+
+def _run(job: AgentJob, executor: Any, workflow_kwargs: Dict[str, Any]):
+    # A job cancelled while queued never starts
+    with job.lock:
+        cancelled = job.cancel_event.is_set()
+        if not cancelled:
+            job.status = "running"
+    if cancelled:
+        result = {"success": False, "error": "Cancelled by user", "cancelled": True}
+        job._append({"type": "complete", "result": result})
+        job._finish("cancelled", result)
+        return
+
+    result = None
+    try:
+        for event in agent_workflow_stream(job.user_query, executor, cancel_event=job.cancel_event,
+                                           **workflow_kwargs):
+            job._append(event)
+            if event["type"] == "complete":
+                result = event["result"]
+    except Exception as e:
+        result = {"success": False, "error": f"Job Error: {str(e)}"}
+        job._append({"type": "complete", "result": result})
+
+    if result is None:
+        result = {"success": False, "error": "Workflow produced no result"}
+        job._append({"type": "complete", "result": result})
+    status = "cancelled" if result.get("cancelled") else ("done" if result.get("success") else "failed")
+    job._finish(status, result)
+
+def _prune():
+    cutoff = time.time() - AGENT_JOB_TTL_S
+    with _jobs_lock:
+        for job_id in [j for j, job in _jobs.items() if job.finished and job.finished_at < cutoff]:
+            del _jobs[job_id]
+
+def submit_job(user_query: str, executor: Any, **workflow_kwargs) -> str:
+    """
+    Queues agent_workflow_stream(user_query, executor, **workflow_kwargs) on
+    the worker pool and returns the job id.
+    """
+    _prune()
+    job = AgentJob(user_query)
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+    _pool().submit(_run, job, executor, workflow_kwargs)
+    return job.job_id
+
+def get_job(job_id: Optional[str]) -> Optional[AgentJob]:
+    with _jobs_lock:
+        return _jobs.get(job_id) if job_id else None
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Requests cancellation; the run stops before its next LLM call or query.
+    Returns False if the job is unknown or already finished.
+    """
+    job = get_job(job_id)
+    if job is None or job.finished:
+        return False
+    job.cancel_event.set()
+    return True
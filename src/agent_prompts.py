@@ -0,0 +1,227 @@
+from typing import List
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+from pydantic import BaseModel, Field
+
+# Heavy langchain/pydantic definitions for the agent workflow.
+# Imported lazily by src.agents on the first agent call, not at app start-up.
+
+# --- Pydantic Models for Structured Output ---
+
+class QueryStep(BaseModel):
+    step_id: int = Field(description="Step number")
+    description: str = Field(description="Description of what this step analyzes")
+    needed_columns: List[str] = Field(description="List of columns needed for this analysis")
+
+class DecompositionPlan(BaseModel):
+    steps: List[QueryStep] = Field(description="List of analytical steps to answer the user query")
+
+class SQLQuery(BaseModel):
+    sql: str = Field(description="The SQL query to execute")
+    explanation: str = Field(description="Brief explanation of the query logic")
+
+class ComplianceReview(BaseModel):
+    allowed: bool = Field(description="Whether the query is safe to execute")
+    reason: str = Field(description="Reason for allowing or rejecting the query")
+
+class StepComplianceReview(ComplianceReview):
+    step_id: int = Field(description="Step number of the reviewed query")
+
+class BatchComplianceReview(BaseModel):
+    reviews: List[StepComplianceReview] = Field(description="One review per step, in step order")
+
+class PlannedStep(QueryStep):
+    sql: str = Field(description="The SQL query that answers this step")
+    explanation: str = Field(description="Brief explanation of the query logic")
+
+class PlanWithSQL(BaseModel):
+    steps: List[PlannedStep] = Field(description="Analytical steps, each with the SQL that answers it")
+
+class InsightOutput(BaseModel):
+    summary: str = Field(description="Direct answer to the user's question")
+    key_insights: List[str] = Field(description="Bulleted list of interesting findings from the data")
+    recommendations: List[str] = Field(description="Actionable recommendations based on the findings")
+
+# --- Prompts & Parsers ---
+
+decomposition_parser = JsonOutputParser(pydantic_object=DecompositionPlan)
+sql_parser = JsonOutputParser(pydantic_object=SQLQuery)
+compliance_parser = JsonOutputParser(pydantic_object=ComplianceReview)
+batch_compliance_parser = JsonOutputParser(pydantic_object=BatchComplianceReview)
+insight_parser = JsonOutputParser(pydantic_object=InsightOutput)
+plan_with_sql_parser = JsonOutputParser(pydantic_object=PlanWithSQL)
+
+decomposition_prompt = ChatPromptTemplate.from_template("""
+You are a Senior Healthcare Data Analyst.
+Your task is to break down a complex user query into simple, logical analytical steps that can be executed via SQL.
+
+User Query: {query}
+
+Data Schema:
+Table: patients
+- patient_number (INT)
+- age, bmi, sex, pregnancy, smoking, alcohol_consumption_per_day
+- blood_pressure_abnormality, chronic_kidney_disease, adrenal_and_thyroid_disorders
+- level_of_hemoglobin, genetic_pedigree_coefficient, level_of_stress, salt_content_in_the_diet
+
+Table: activity
+- patient_number (INT)
+- day_number, physical_activity
+
+Instructions:
+1. Break the query into distinct parts if it asks about multiple things (e.g., "avg BMI" AND "activity trends").
+2. Each step should result in a specific dataset or metric.
+3. Return the plan as a JSON object with a list of steps.
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object. Do not add any explanation or text outside the JSON.
+""")
+
+sql_gen_prompt = ChatPromptTemplate.from_template("""
+You are a PostgreSQL Expert. Generate a SQL query for the following task.
+
+Task: {step_description}
+
+Database Schema:
+- Table `patients`: patient_number, age, bmi, sex (0=M,1=F), pregnancy, smoking (0=No,1=Yes), alcohol_consumption_per_day, blood_pressure_abnormality (0/1), chronic_kidney_disease (0/1), adrenal_and_thyroid_disorders (0/1), level_of_stress (1=Low, 2=Normal, 3=High), salt_content_in_the_diet.
+- Table `activity`: patient_number, day_number, physical_activity.
+
+Constraints:
+1. **Focus**: Generate SQL *ONLY* for the specific "Task" above. Do NOT address other parts of the original user request.
+2. **Safety**: NEVER use `SELECT *`. Always select specific columns or aggregations.
+3. **Aggregation**: Use AVG, COUNT, SUM, etc., unless listing specific IDs is requested (avoid if possible).
+4. **Joins**: Use `LEFT JOIN` on `patient_number` if needed.
+5. **Syntax**: Standard PostgreSQL.
+6. **Output**: Return ONLY the SQL query in a JSON object.
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object. No markdown formatting.
+""")
+
+plan_with_sql_prompt = ChatPromptTemplate.from_template("""
+You are a Senior Healthcare Data Analyst and PostgreSQL Expert.
+Break down the user query into simple, logical analytical steps AND write the SQL query for every step.
+
+User Query: {query}
+
+Database Schema:
+- Table `patients`: patient_number, age, bmi, sex (0=M,1=F), pregnancy, smoking (0=No,1=Yes), alcohol_consumption_per_day, blood_pressure_abnormality (0/1), chronic_kidney_disease (0/1), adrenal_and_thyroid_disorders (0/1), level_of_hemoglobin, genetic_pedigree_coefficient, level_of_stress (1=Low, 2=Normal, 3=High), salt_content_in_the_diet.
+- Table `activity`: patient_number, day_number, physical_activity.
+
+Instructions:
+1. Break the query into distinct parts if it asks about multiple things (e.g., "avg BMI" AND "activity trends").
+2. Each step should result in a specific dataset or metric and carry its own SQL query.
+3. **Safety**: NEVER use `SELECT *`. Always select specific columns or aggregations.
+4. **Aggregation**: Use AVG, COUNT, SUM, etc., unless listing specific IDs is requested (avoid if possible).
+5. **Joins**: Use `LEFT JOIN` on `patient_number` if needed.
+6. **Syntax**: Standard PostgreSQL.
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object. Do not add any explanation or text outside the JSON.
+""")
+
+sql_repair_prompt = ChatPromptTemplate.from_template("""
+You are a PostgreSQL Expert. The SQL query below was generated for a task but failed validation.
+Fix the query so that it is valid and still answers the task.
+
+Task: {step_description}
+
+Failed SQL:
+{sql}
+
+Validation Error:
+{error}
+
+Database Schema:
+- Table `patients`: patient_number, age, bmi, sex (0=M,1=F), pregnancy, smoking (0=No,1=Yes), alcohol_consumption_per_day, blood_pressure_abnormality (0/1), chronic_kidney_disease (0/1), adrenal_and_thyroid_disorders (0/1), level_of_hemoglobin, genetic_pedigree_coefficient, level_of_stress (1=Low, 2=Normal, 3=High), salt_content_in_the_diet.
+- Table `activity`: patient_number, day_number, physical_activity.
+
+Constraints:
+1. Use ONLY the tables and columns listed above.
+2. Return a single SELECT statement. NEVER use `SELECT *`.
+3. **Syntax**: Standard PostgreSQL.
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object. No markdown formatting.
+""")
+
+compliance_prompt = ChatPromptTemplate.from_template("""
+You are a strict HIPAA & GDPR Compliance Officer.
+Review the following SQL query to ensure it meets safety and privacy standards for a healthcare application.
+
+SQL Query: {sql}
+Task Description: {step_description}
+
+Rules:
+1. **No Modification**: The query must NOT contain DROP, DELETE, INSERT, UPDATE, TRUNCATE, ALTER, GRANT.
+2. **Privacy First**: 
+   - `SELECT *` is STRICTLY FORBIDDEN.
+   - Accessing PII (like patient names, if they existed) is forbidden.
+   - `patient_number` is allowed ONLY for joins or specific cohort identification if functionality requires it, but Aggregations (COUNT, AVG) are preferred.
+3. **Relevance**: The query must be relevant to the Task Description.
+
+Output:
+Return a JSON object with:
+- "allowed": boolean (true/false)
+- "reason": string (explanation of the decision)
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object.
+""")
+
+batch_compliance_prompt = ChatPromptTemplate.from_template("""
+You are a strict HIPAA & GDPR Compliance Officer.
+Review EACH of the following SQL queries, one per analytical step, to ensure it meets safety and privacy standards for a healthcare application.
+
+{queries}
+
+Rules (apply to every query independently):
+1. **No Modification**: The query must NOT contain DROP, DELETE, INSERT, UPDATE, TRUNCATE, ALTER, GRANT.
+2. **Privacy First**:
+   - `SELECT *` is STRICTLY FORBIDDEN.
+   - Accessing PII (like patient names, if they existed) is forbidden.
+   - `patient_number` is allowed ONLY for joins or specific cohort identification if functionality requires it, but Aggregations (COUNT, AVG) are preferred.
+3. **Relevance**: The query must be relevant to its own Task Description.
+
+Output:
+Return a JSON object with a "reviews" list containing exactly one entry per step:
+- "step_id": integer (the step number shown above)
+- "allowed": boolean (true/false)
+- "reason": string (explanation of the decision)
+
+Format Instructions:
+{format_instructions}
+
+IMPORTANT: Return ONLY the JSON object.
+""")
+
+insight_prompt = ChatPromptTemplate.from_template("""
+You are a Chief Medical Officer and Data Scientist.
+Analyze the following data results and answer the user's question with strategic insights and actionable recommendations.
+
+User Query: {query}
+
+Analytical Steps & Results:
+{results_summary}
+
+Instructions:
+1. **Summary**: Provide a direct, data-backed answer to the question.
+2. **Key Insights**: Highlight trends, correlations, or alarming stats.
+3. **Recommendations**: Suggest clinical or lifestyle interventions based on the risk factors found (e.g., if high stress/smoking found, suggest cessation programs).
+4. **Tone**: Professional, encouraging, and evidence-based.
+
+Output Format: JSON with keys "summary", "key_insights" (list), "recommendations" (list).
+
+Format Instructions:
+{format_instructions}
+""")
@@ -1,156 +1,142 @@
 import os
-import pandas as pd
 import json
 import re
-from typing import List, Dict, Any, Optional
-from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
-from pydantic import BaseModel, Field
+import time
+import threading
+from functools import lru_cache
+from typing import List, Dict, Any, Iterator, Optional
 from dotenv import load_dotenv
+from src.query_templates import match_template
+from src.result_compactor import compact_dataframe, estimate_tokens, summarize_compaction
+from src.sql_validator import get_sql_validator
+from src.question_cache import get_question_cache
+from src.plan_optimizer import SharedExecution
+from src.tracing import Tracer
 
 load_dotenv()
 
 # --- Configuration ---
-try:
-    import streamlit as st
-    groq_api_key = st.secrets["groq"]["api_key"]
-except:
-    groq_api_key = os.getenv('GROQ_API_KEY')
-
-llm = ChatGroq(
-    model="qwen/qwen3-32b",
-    temperature=0,
-    api_key=groq_api_key
-)
-
-# --- Pydantic Models for Structured Output ---
-
-class QueryStep(BaseModel):
-    step_id: int = Field(description="Step number")
-    description: str = Field(description="Description of what this step analyzes")
-    needed_columns: List[str] = Field(description="List of columns needed for this analysis")
-
-class DecompositionPlan(BaseModel):
-    steps: List[QueryStep] = Field(description="List of analytical steps to answer the user query")
-
-class SQLQuery(BaseModel):
-    sql: str = Field(description="The SQL query to execute")
-    explanation: str = Field(description="Brief explanation of the query logic")
-
-class ComplianceReview(BaseModel):
-    allowed: bool = Field(description="Whether the query is safe to execute")
-    reason: str = Field(description="Reason for allowing or rejecting the query")
-
-class InsightOutput(BaseModel):
-    summary: str = Field(description="Direct answer to the user's question")
-    key_insights: List[str] = Field(description="Bulleted list of interesting findings from the data")
-    recommendations: List[str] = Field(description="Actionable recommendations based on the findings")
-
-# --- Prompts & Parsers ---
-
-decomposition_parser = JsonOutputParser(pydantic_object=DecompositionPlan)
-sql_parser = JsonOutputParser(pydantic_object=SQLQuery)
-compliance_parser = JsonOutputParser(pydantic_object=ComplianceReview)
-insight_parser = JsonOutputParser(pydantic_object=InsightOutput)
-
-decomposition_prompt = ChatPromptTemplate.from_template("""
-You are a Senior Healthcare Data Analyst.
-Your task is to break down a complex user query into simple, logical analytical steps that can be executed via SQL.
-
-User Query: {query}
-
-Data Schema:
-Table: patients
-- patient_number (INT)
-- age, bmi, sex, pregnancy, smoking, alcohol_consumption_per_day
-- blood_pressure_abnormality, chronic_kidney_disease, adrenal_and_thyroid_disorders
-- level_of_hemoglobin, genetic_pedigree_coefficient, level_of_stress, salt_content_in_the_diet
-
-Table: activity
-- patient_number (INT)
-- day_number, physical_activity
-
-Instructions:
-1. Break the query into distinct parts if it asks about multiple things (e.g., "avg BMI" AND "activity trends").
-2. Each step should result in a specific dataset or metric.
-3. Return the plan as a JSON object with a list of steps.
-
-Format Instructions:
-{format_instructions}
-
-IMPORTANT: Return ONLY the JSON object. Do not add any explanation or text outside the JSON.
-""")
-
-sql_gen_prompt = ChatPromptTemplate.from_template("""
-You are a PostgreSQL Expert. Generate a SQL query for the following task.
 
-Task: {step_description}
-
-Database Schema:
-- Table `patients`: patient_number, age, bmi, sex (0=M,1=F), pregnancy, smoking (0=No,1=Yes), alcohol_consumption_per_day, blood_pressure_abnormality (0/1), chronic_kidney_disease (0/1), adrenal_and_thyroid_disorders (0/1), level_of_stress (1=Low, 2=Normal, 3=High), salt_content_in_the_diet.
-- Table `activity`: patient_number, day_number, physical_activity.
-
-Constraints:
-1. **Focus**: Generate SQL *ONLY* for the specific "Task" above. Do NOT address other parts of the original user request.
-2. **Safety**: NEVER use `SELECT *`. Always select specific columns or aggregations.
-3. **Aggregation**: Use AVG, COUNT, SUM, etc., unless listing specific IDs is requested (avoid if possible).
-4. **Joins**: Use `LEFT JOIN` on `patient_number` if needed.
-5. **Syntax**: Standard PostgreSQL.
-6. **Output**: Return ONLY the SQL query in a JSON object.
-
-Format Instructions:
-{format_instructions}
-
-IMPORTANT: Return ONLY the JSON object. No markdown formatting.
-""")
-
-compliance_prompt = ChatPromptTemplate.from_template("""
-You are a strict HIPAA & GDPR Compliance Officer.
-Review the following SQL query to ensure it meets safety and privacy standards for a healthcare application.
-
-SQL Query: {sql}
-Task Description: {step_description}
-
-Rules:
-1. **No Modification**: The query must NOT contain DROP, DELETE, INSERT, UPDATE, TRUNCATE, ALTER, GRANT.
-2. **Privacy First**: 
-   - `SELECT *` is STRICTLY FORBIDDEN.
-   - Accessing PII (like patient names, if they existed) is forbidden.
-   - `patient_number` is allowed ONLY for joins or specific cohort identification if functionality requires it, but Aggregations (COUNT, AVG) are preferred.
-3. **Relevance**: The query must be relevant to the Task Description.
-
-Output:
-Return a JSON object with:
-- "allowed": boolean (true/false)
-- "reason": string (explanation of the decision)
-
-Format Instructions:
-{format_instructions}
+# Total token budget for step results passed to the insight agent
+RESULT_TOKEN_BUDGET = int(os.getenv('RESULT_TOKEN_BUDGET', 4000))
+
+# Bounded attempts to fix generated SQL that fails local validation
+MAX_SQL_REPAIRS = int(os.getenv('MAX_SQL_REPAIRS', 2))
+
+# --- Model Routing ---
+
+LLM_MODEL = os.getenv('LLM_MODEL', "qwen/qwen3-32b")
+SMALL_LLM_MODEL = os.getenv('LLM_MODEL_SMALL', "llama-3.1-8b-instant")
+
+# Model per agent stage; LLM_MODEL_<STAGE> (e.g. LLM_MODEL_COMPLIANCE) overrides one stage.
+# "sql_generation_simple" handles single-table steps (see is_simple_step).
+STAGE_MODELS = {
+    "decomposition": LLM_MODEL,
+    "plan_single": LLM_MODEL,
+    "sql_generation": LLM_MODEL,
+    "sql_generation_simple": SMALL_LLM_MODEL,
+    "sql_repair": LLM_MODEL,
+    "compliance": SMALL_LLM_MODEL,
+    "insight": LLM_MODEL,
+}
+STAGE_MODELS = {stage: os.getenv(f"LLM_MODEL_{stage.upper()}", model) for stage, model in STAGE_MODELS.items()}
+
+# Retry a stage on LLM_MODEL when a smaller model's output does not parse
+MODEL_ESCALATION = os.getenv('MODEL_ESCALATION', '1') != '0'
+
+# Step descriptions that need more than a single-table aggregate
+COMPLEX_STEP_PATTERN = re.compile(
+    r'correlat|trend|compar|versus|\bvs\.?\b|\bjoin|over time|rank|percentile|median|ratio|regress|each patient',
+    re.IGNORECASE
+)
+ACTIVITY_COLUMNS = {"day_number", "physical_activity"}
 
-IMPORTANT: Return ONLY the JSON object.
-""")
+def get_groq_api_key() -> Optional[str]:
+    try:
+        import streamlit as st
+        return st.secrets["groq"]["api_key"]
+    except:
+        return os.getenv('GROQ_API_KEY')
 
-insight_prompt = ChatPromptTemplate.from_template("""
-You are a Chief Medical Officer and Data Scientist.
-Analyze the following data results and answer the user's question with strategic insights and actionable recommendations.
+@lru_cache(maxsize=None)
+def get_groq_llm(model: str = LLM_MODEL):
+    """
+    Builds the Groq chat client for `model` on first use and caches it for the process.
+    """
+    from langchain_groq import ChatGroq
+    return ChatGroq(
+        model=model,
+        temperature=0,
+        api_key=get_groq_api_key()
+    )
 
-User Query: {query}
+# Optional override for every agent LLM call (see src/llm_backends.py)
+_llm_backend = None
 
-Analytical Steps & Results:
-{results_summary}
+def set_llm_backend(backend=None):
+    """
+    Routes agent LLM calls through `backend`, any object with
+    invoke(messages) and stream(messages) like a langchain chat model.
+    Passing None restores the Groq client.
+    """
+    global _llm_backend
+    _llm_backend = backend
 
-Instructions:
-1. **Summary**: Provide a direct, data-backed answer to the question.
-2. **Key Insights**: Highlight trends, correlations, or alarming stats.
-3. **Recommendations**: Suggest clinical or lifestyle interventions based on the risk factors found (e.g., if high stress/smoking found, suggest cessation programs).
-4. **Tone**: Professional, encouraging, and evidence-based.
+def get_llm(model: Optional[str] = None):
+    model = model or LLM_MODEL
+    if _llm_backend is not None:
+        # Backends may route by model name themselves (e.g. RecordingLLM over Groq)
+        return _llm_backend.for_model(model) if hasattr(_llm_backend, "for_model") else _llm_backend
+    return get_groq_llm(model)
 
-Output Format: JSON with keys "summary", "key_insights" (list), "recommendations" (list).
+def is_simple_step(step) -> bool:
+    """
+    True for single-table aggregate steps (counts, averages, group-bys) that
+    a small model writes reliably.
+    """
+    columns = set(step.needed_columns) - {"patient_number"}
+    uses_activity = bool(columns & ACTIVITY_COLUMNS) or "activity" in step.description.lower()
+    uses_patients = bool(columns - ACTIVITY_COLUMNS)
+    if uses_activity and uses_patients:
+        return False
+    return not COMPLEX_STEP_PATTERN.search(step.description)
+
+# Optional limiter shared by concurrent workflows (see src/batch_runner.py).
+# Installed per thread, so a batch run in the same process as the UI only
+# throttles its own worker threads.
+_rate_limiter = threading.local()
+
+# Completion tokens reserved per call until the real usage is known
+COMPLETION_TOKEN_RESERVE = 500
+
+def set_rate_limiter(limiter=None):
+    """
+    Makes agent LLM calls on the calling thread wait for capacity from
+    `limiter`, an object with acquire(tokens) -> seconds waited and
+    settle(reserved, actual). Passing None disables throttling.
+    Returns the limiter it replaced, so callers can restore it.
+    """
+    previous = getattr(_rate_limiter, "limiter", None)
+    _rate_limiter.limiter = limiter
+    return previous
 
-Format Instructions:
-{format_instructions}
-""")
+def _prompts():
+    """
+    Imports the langchain/pydantic prompt definitions on the first agent call.
+    """
+    from src import agent_prompts
+    return agent_prompts
+
+def __getattr__(name: str):
+    # Keep `from src.agents import llm, DecompositionPlan, ...` working without
+    # paying for langchain at import time.
+    if name == "llm":
+        return get_llm()
+    if not name.startswith("__"):
+        prompts = _prompts()
+        if hasattr(prompts, name):
+            return getattr(prompts, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # --- Helper Functions ---
 
@@ -182,77 +168,544 @@ def extract_json_from_text(text: str) -> Dict[str, Any]:
         print(f"JSON Parsing Error: {e}\nInput text: {text}")
         return {}
 
+class WorkflowCancelled(Exception):
+    """
+    Raised at the next LLM call or query once a run's cancel event is set.
+    """
+
+def new_run(user_query: str = "", cancel_event: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Per-request bookkeeping shared by the workflow stages.
+    `cancel_event` is any object with is_set(), e.g. threading.Event.
+    """
+    return {"llm_calls": 0, "sql_repairs": 0, "tracer": Tracer(user_query), "cancel_event": cancel_event}
+
+def check_cancelled(run: Dict[str, Any]):
+    cancel_event = run.get("cancel_event")
+    if cancel_event is not None and cancel_event.is_set():
+        raise WorkflowCancelled("Cancelled by user")
+
+def _record_usage(span: Optional[Dict[str, Any]], prompt, inputs: Dict[str, Any], message, text: str,
+                  reserved: int = 0):
+    """
+    Adds token usage of one LLM call to a trace span. Falls back to a
+    character-based estimate when the backend reports no usage metadata.
+    Settles the rate limiter reservation with the actual usage.
+    Returns (prompt_tokens, completion_tokens).
+    """
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage:
+        prompt_tokens = usage.get("input_tokens", 0)
+        completion_tokens = usage.get("output_tokens", 0)
+    else:
+        prompt_tokens = estimate_tokens(prompt.format(**inputs))
+        completion_tokens = estimate_tokens(text)
+    
+    limiter = getattr(_rate_limiter, "limiter", None)
+    if limiter is not None and reserved:
+        limiter.settle(reserved, prompt_tokens + completion_tokens)
+    if span is None:
+        return prompt_tokens, completion_tokens
+    span["llm_calls"] += 1
+    span["prompt_tokens"] += prompt_tokens
+    span["completion_tokens"] += completion_tokens
+    if not usage:
+        span["tokens_estimated"] = True
+    return prompt_tokens, completion_tokens
+
+def _throttle(prompt, inputs: Dict[str, Any], span: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Waits for rate limiter capacity before an LLM call.
+    Returns the number of tokens reserved (0 without a limiter).
+    """
+    limiter = getattr(_rate_limiter, "limiter", None)
+    if limiter is None:
+        return 0
+    reserved = estimate_tokens(prompt.format(**inputs)) + COMPLETION_TOKEN_RESERVE
+    waited = limiter.acquire(reserved)
+    if span is not None and waited:
+        span["rate_limit_wait_ms"] = round(span.get("rate_limit_wait_ms", 0.0) + waited * 1000, 1)
+    return reserved
+
+def _invoke(prompt, inputs: Dict[str, Any], run: Dict[str, Any], span: Optional[Dict[str, Any]] = None,
+            stage: str = "decomposition", model: Optional[str] = None) -> str:
+    """
+    One LLM call on the stage's routed model (or `model` if given), traced per model.
+    """
+    check_cancelled(run)
+    model = model or STAGE_MODELS[stage]
+    run["llm_calls"] += 1
+    reserved = _throttle(prompt, inputs, span)
+    start = time.perf_counter()
+    message = get_llm(model).invoke(prompt.format_messages(**inputs))
+    duration_ms = (time.perf_counter() - start) * 1000
+    text = message.content if hasattr(message, "content") else str(message)
+    tokens = _record_usage(span, prompt, inputs, message, text, reserved)
+    run["tracer"].record_call(stage, model, duration_ms, *tokens)
+    if span is not None:
+        span["model"] = model
+    return text
+
+def _invoke_json(prompt, inputs: Dict[str, Any], run: Dict[str, Any], span: Optional[Dict[str, Any]],
+                 stage: str, required_keys: List[str]) -> Dict[str, Any]:
+    """
+    _invoke + JSON extraction. If a stage routed to a smaller model returns
+    output without `required_keys`, the call is repeated once on LLM_MODEL.
+    """
+    parsed = extract_json_from_text(_invoke(prompt, inputs, run, span, stage))
+    if all(parsed.get(k) not in (None, "") for k in required_keys):
+        return parsed
+    if MODEL_ESCALATION and STAGE_MODELS[stage] != LLM_MODEL:
+        print(f"Escalating {stage} from {STAGE_MODELS[stage]} to {LLM_MODEL}")
+        if span is not None:
+            span["escalated"] = True
+            span["retries"] += 1
+        parsed = extract_json_from_text(_invoke(prompt, inputs, run, span, stage, model=LLM_MODEL))
+    return parsed
+
+def stream_insights(user_query: str, results_summary: str, run: Dict[str, Any],
+                    span: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    Runs the insight agent over the accumulated step results, yielding raw tokens.
+    """
+    p = _prompts()
+    check_cancelled(run)
+    model = STAGE_MODELS["insight"]
+    run["llm_calls"] += 1
+    inputs = {
+        "query": user_query,
+        "results_summary": results_summary,
+        "format_instructions": p.insight_parser.get_format_instructions()
+    }
+    reserved = _throttle(p.insight_prompt, inputs, span)
+    start = time.perf_counter()
+    merged, text = None, ""
+    for chunk in get_llm(model).stream(p.insight_prompt.format_messages(**inputs)):
+        check_cancelled(run)
+        merged = chunk if merged is None else merged + chunk
+        token = chunk.content if hasattr(chunk, "content") else str(chunk)
+        text += token
+        yield token
+    tokens = _record_usage(span, p.insight_prompt, inputs, merged, text, reserved)
+    run["tracer"].record_call("insight", model, (time.perf_counter() - start) * 1000, *tokens)
+    if span is not None:
+        span["model"] = model
+
+def _final_result(final_insights: Dict[str, Any], step_infos: List[Dict[str, Any]],
+                  compactions: List[Dict[str, Any]], run: Dict[str, Any], **extra) -> Dict[str, Any]:
+    return {
+        "success": True,
+        "insight": final_insights.get("summary", "No summary generated"),
+        "key_insights": final_insights.get("key_insights", []),
+        "recommendations": final_insights.get("recommendations", []),
+        "steps": step_infos,
+        "compaction": summarize_compaction(compactions),
+        "llm_calls": run["llm_calls"],
+        "sql_repairs": run["sql_repairs"],
+        **extra
+    }
+
+def _failed_result(error: str, run: Dict[str, Any]) -> Dict[str, Any]:
+    return {"success": False, "error": error, "llm_calls": run["llm_calls"]}
+
+def _complete(result: Dict[str, Any], run: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Builds the final event, closing and logging the run's trace.
+    """
+    result["trace"] = run["tracer"].finish(result.get("success", False))
+    return {"type": "complete", "result": result}
+
+def _insight_events(user_query: str, results_summary: str, run: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Streams insight tokens as events and finishes with the parsed insight JSON.
+    """
+    raw_insight = ""
+    with run["tracer"].span("insight") as span:
+        for token in stream_insights(user_query, results_summary, run, span):
+            raw_insight += token
+            yield {"type": "insight_token", "token": token}
+    yield {"type": "insight_ready", "insights": extract_json_from_text(raw_insight)}
+
+def template_workflow_stream(user_query: str, template: Dict[str, str], executor: Any,
+                             include_uploaded: bool = True, with_insights: bool = True,
+                             result_token_budget: int = RESULT_TOKEN_BUDGET,
+                             run: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Fast path for questions matched by a pre-approved SQL template.
+    Skips decomposition, SQL generation and compliance review (templates are
+    aggregation-only by construction) and goes straight to execution.
+    Raises before any step_finished event if the template query fails.
+    """
+    run = run if run is not None else new_run(user_query)
+    sql = template["sql"]
+    yield {"type": "plan_ready", "steps": [{"step": 1, "description": template["description"]}],
+           "fast_path": template["template"]}
+    yield {"type": "step_started", "step": 1, "description": template["description"]}
+
+    check_cancelled(run)
+    with run["tracer"].span("execution", step=1) as span:
+        df = executor.execute_combined_query(sql, include_uploaded=include_uploaded)
+        span["rows"] = len(df)
+    step_info = {"step": 1, "description": template["description"], "sql": sql, "data": df}
+    yield {"type": "step_finished", "status": "ok", **step_info}
+
+    compactions = []
+    if with_insights:
+        compacted = compact_dataframe(df, result_token_budget)
+        compactions.append(compacted)
+        results_summary = f"Step 1: {template['description']}\nSQL: {sql}\nResult Data:\n{compacted['text']}\n\n"
+        for event in _insight_events(user_query, results_summary, run):
+            if event["type"] == "insight_ready":
+                final_insights = event["insights"]
+            else:
+                yield event
+    else:
+        final_insights = {
+            "summary": f"{template['description']}: {df.to_string(index=False)}" if not df.empty else "No data returned.",
+            "key_insights": [],
+            "recommendations": []
+        }
+
+    yield _complete(_final_result(final_insights, [step_info], compactions, run, fast_path=template["template"]), run)
+
+# --- Planners ---
+
+def plan_multi(user_query: str, run: Dict[str, Any], span: Optional[Dict[str, Any]] = None):
+    """
+    Decomposition call only; SQL is generated per step afterwards.
+    Returns (DecompositionPlan, error_message).
+    """
+    p = _prompts()
+    raw_plan = _invoke(p.decomposition_prompt, {
+        "query": user_query,
+        "format_instructions": p.decomposition_parser.get_format_instructions()
+    }, run, span, stage="decomposition")
+    
+    plan_dict = extract_json_from_text(raw_plan)
+    
+    if not plan_dict or "steps" not in plan_dict:
+        return None, f"Failed to understand query. Raw output: {raw_plan}"
+    
+    # Convert to objects
+    try:
+        steps = [p.QueryStep(**s) for s in plan_dict["steps"]]
+        return p.DecompositionPlan(steps=steps), None
+    except:
+        return None, "Failed to parse plan structure."
+
+def plan_single(user_query: str, run: Dict[str, Any], span: Optional[Dict[str, Any]] = None):
+    """
+    Asks for the plan and every step's SQL in one round trip.
+    Returns (DecompositionPlan, {step_id: sql}) or (None, {}) if the response
+    does not validate against DecompositionPlan/SQLQuery.
+    """
+    p = _prompts()
+    raw_plan = _invoke(p.plan_with_sql_prompt, {
+        "query": user_query,
+        "format_instructions": p.plan_with_sql_parser.get_format_instructions()
+    }, run, span, stage="plan_single")
+    
+    plan_dict = extract_json_from_text(raw_plan)
+    try:
+        steps = []
+        planned_sql = {}
+        for s in plan_dict["steps"]:
+            step = p.QueryStep(**s)
+            query = p.SQLQuery(sql=s["sql"], explanation=s.get("explanation", ""))
+            sql = query.sql.strip().rstrip(';')
+            if not sql:
+                raise ValueError(f"Step {step.step_id} has no SQL")
+            steps.append(step)
+            planned_sql[step.step_id] = sql
+        if not steps:
+            raise ValueError("Empty plan")
+        return p.DecompositionPlan(steps=steps), planned_sql
+    except Exception as e:
+        print(f"Single-call plan rejected, falling back to multi-call planner: {e}")
+        return None, {}
+
+def generate_sql(step, run: Dict[str, Any], span: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Simple single-table steps go to the "sql_generation_simple" model and
+    escalate to LLM_MODEL if no SQL comes back; validation failures are
+    repaired by the "sql_repair" model.
+    """
+    p = _prompts()
+    stage = "sql_generation_simple" if is_simple_step(step) else "sql_generation"
+    sql_response = _invoke_json(p.sql_gen_prompt, {
+        "step_description": step.description,
+        "format_instructions": p.sql_parser.get_format_instructions()
+    }, run, span, stage, ["sql"])
+    return str(sql_response.get("sql") or "").strip().rstrip(';')
+
+def repair_sql(step, sql: str, error: str, run: Dict[str, Any], span: Optional[Dict[str, Any]] = None) -> str:
+    p = _prompts()
+    raw_sql_response = _invoke(p.sql_repair_prompt, {
+        "step_description": step.description,
+        "sql": sql,
+        "error": error,
+        "format_instructions": p.sql_parser.get_format_instructions()
+    }, run, span, stage="sql_repair")
+    
+    sql_response = extract_json_from_text(raw_sql_response)
+    if not isinstance(sql_response, dict):
+        return ""
+    return str(sql_response.get("sql") or "").strip().rstrip(';')
+
+def validate_and_repair_sql(step, sql: str, run: Dict[str, Any], max_repairs: int = MAX_SQL_REPAIRS,
+                            span: Optional[Dict[str, Any]] = None):
+    """
+    Validates SQL locally (DuckDB EXPLAIN on an empty catalog) and feeds
+    errors back to the SQL agent up to `max_repairs` times.
+    Returns (sql, error_message); error_message is None once the SQL is valid.
+    """
+    validator = get_sql_validator()
+    for attempt in range(max_repairs + 1):
+        is_valid, error = validator.validate(sql)
+        if is_valid:
+            return sql, None
+        if attempt == max_repairs:
+            break
+        run["sql_repairs"] += 1
+        if span is not None:
+            span["retries"] += 1
+        repaired = repair_sql(step, sql, error, run, span)
+        if not repaired:
+            break
+        sql = repaired
+    return sql, error
+
+# --- Compliance ---
+
+COMPLIANCE_MODES = ("batched", "per_step")
+
+def review_step(step, sql: str, run: Dict[str, Any], span: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    p = _prompts()
+    return _invoke_json(p.compliance_prompt, {
+        "sql": sql,
+        "step_description": step.description,
+        "format_instructions": p.compliance_parser.get_format_instructions()
+    }, run, span, "compliance", ["allowed"])
+
+def review_batch(items: List[Any], run: Dict[str, Any], span: Optional[Dict[str, Any]] = None):
+    """
+    Reviews every (step, sql) pair of a plan in one call.
+    Returns {step_id: {"allowed", "reason"}}, or None if the response does not
+    parse into exactly one verdict per step.
+    """
+    p = _prompts()
+    queries = "\n\n".join(f"Step {step.step_id}\nTask Description: {step.description}\nSQL Query: {sql}"
+                           for step, sql in items)
+    response = _invoke_json(p.batch_compliance_prompt, {
+        "queries": queries,
+        "format_instructions": p.batch_compliance_parser.get_format_instructions()
+    }, run, span, "compliance", ["reviews"])
+    
+    try:
+        reviews = [p.StepComplianceReview(**r) for r in response["reviews"]]
+    except Exception as e:
+        print(f"Batched compliance output rejected: {e}")
+        return None
+    
+    verdicts = {r.step_id: {"allowed": r.allowed, "reason": r.reason} for r in reviews}
+    if len(reviews) != len(items) or set(verdicts) != {step.step_id for step, _ in items}:
+        print("Batched compliance verdicts do not match the plan steps")
+        return None
+    return verdicts
+
+def review_compliance(items: List[Any], run: Dict[str, Any], mode: str = "batched"):
+    """
+    Reviews the SQL of every (step, sql) pair, in one call when mode is
+    "batched" and per step otherwise or when the batched output is unusable.
+    Returns ({step_id: review}, stats); a review is {"allowed", "reason"} or
+    {"error"} when the audit itself failed.
+    """
+    tracer = run["tracer"]
+    calls_before = run["llm_calls"]
+    reviews = {}
+    used = mode if len(items) > 1 else "per_step"
+    
+    if used == "batched":
+        try:
+            with tracer.span("compliance", mode="batched", steps=len(items)) as span:
+                reviews = review_batch(items, run, span) or {}
+        except WorkflowCancelled:
+            raise
+        except Exception as e:
+            print(f"Batched compliance review failed: {e}")
+        if not reviews:
+            used = "batched->per_step"
+    
+    for step, sql in items:
+        if step.step_id in reviews:
+            continue
+        try:
+            with tracer.span("compliance", step=step.step_id, mode="per_step") as span:
+                reviews[step.step_id] = review_step(step, sql, run, span)
+        except WorkflowCancelled:
+            raise
+        except Exception as e:
+            reviews[step.step_id] = {"error": str(e)}
+    
+    calls = run["llm_calls"] - calls_before
+    return reviews, {
+        "mode": used,
+        "reviewed": len(items),
+        "llm_calls": calls,
+        "round_trips_saved": max(0, len(items) - calls),
+        "latency_ms": round(sum(s["duration_ms"] for s in tracer.spans if s["stage"] == "compliance"), 1)
+    }
+
 # --- Main Workflow ---
 
-def agent_workflow(user_query: str, executor: Any, include_uploaded: bool = True) -> Dict[str, Any]:
+PLANNER_MODES = ("multi", "single")
+
+def agent_workflow_stream(user_query: str, executor: Any, include_uploaded: bool = True,
+                          use_templates: bool = True, template_insights: bool = True,
+                          result_token_budget: int = RESULT_TOKEN_BUDGET,
+                          planner_mode: str = "multi", use_question_cache: bool = True,
+                          compliance_mode: str = "batched",
+                          cancel_event: Optional[Any] = None) -> Iterator[Dict[str, Any]]:
     """
-    Orchestrates the multi-step agent workflow with robust manual parsing.
+    Orchestrates the multi-step agent workflow, yielding progress events:
+    - plan_ready: {"steps": [{"step", "description"}], "fast_path"}
+    - step_started: {"step", "description"}
+    - step_finished: {"step", "description", "status", "sql", "data", "message"}
+    - insight_token: {"token"} raw insight agent output as it is generated
+    - complete: {"result"} the same dict `agent_workflow` returns (always last)
+    A fast-path fallback may emit a second plan_ready that replaces the first.
+    planner_mode "single" asks for plan and SQL in one call and falls back to
+    the "multi" flow (one decomposition call plus one SQL call per step).
+    A rephrasing of a previously answered question reuses its cached plan and
+    SQL, skipping the planning and SQL generation calls; the SQL is still
+    validated and reviewed for compliance.
+    SQL for all steps is prepared first, then reviewed (one compliance call for
+    the whole plan in "batched" mode), then executed.
+    Setting `cancel_event` stops the run before its next LLM call or query.
     """
-    results_accumulator = []
     step_infos = []
+    compactions = []
+    run = new_run(user_query, cancel_event)
+    tracer = run["tracer"]
+    shared = None
     
     try:
-        # 1. Decomposition
-        decomposer_chain = decomposition_prompt | llm | StrOutputParser()
-        raw_plan = decomposer_chain.invoke({
-            "query": user_query,
-            "format_instructions": decomposition_parser.get_format_instructions()
-        })
-        
-        plan_dict = extract_json_from_text(raw_plan)
+        if planner_mode not in PLANNER_MODES:
+            raise ValueError(f"Unknown planner mode: {planner_mode}")
+        if compliance_mode not in COMPLIANCE_MODES:
+            raise ValueError(f"Unknown compliance mode: {compliance_mode}")
         
-        if not plan_dict or "steps" not in plan_dict:
-             return {"success": False, "error": f"Failed to understand query. Raw output: {raw_plan}"}
-             
-        # Convert to objects
-        try:
-            steps = [QueryStep(**s) for s in plan_dict["steps"]]
-            plan_obj = DecompositionPlan(steps=steps)
-        except:
-             return {"success": False, "error": "Failed to parse plan structure."}
-
-        # 2. Execution Loop
-        sql_chain = sql_gen_prompt | llm | StrOutputParser()
-        compliance_chain = compliance_prompt | llm | StrOutputParser()
+        # 0. Template Fast Path
+        with tracer.span("template_match") as span:
+            template = match_template(user_query) if use_templates else None
+            span["cache_hit"] = template is not None
+        if template:
+            executed = False
+            try:
+                for event in template_workflow_stream(user_query, template, executor, include_uploaded,
+                                                      template_insights, result_token_budget, run):
+                    executed = executed or event["type"] == "step_finished"
+                    yield event
+                return
+            except WorkflowCancelled:
+                raise
+            except Exception as e:
+                if executed:
+                    raise
+                # Fall back to the full agent workflow if the template query failed
+                print(f"Template fast path failed ({template['template']}): {e}")
+
+        p = _prompts()
         
-        combined_df = pd.DataFrame()
+        # 0b. Near-duplicate question cache
+        with tracer.span("question_cache") as span:
+            cached = get_question_cache().lookup(user_query) if use_question_cache else None
+            span["cache_hit"] = cached is not None
+            if cached:
+                span["similarity"] = cached["similarity"]
         
+        # 1. Decomposition
+        plan_obj, planned_sql = None, {}
+        planner_used = "multi"
+        if cached:
+            plan_obj = p.DecompositionPlan(steps=[p.QueryStep(**s) for s in cached["plan"]])
+            planned_sql = cached["sql"]
+            planner_used = "cache"
+        else:
+            with tracer.span("decomposition", planner=planner_mode) as span:
+                if planner_mode == "single":
+                    plan_obj, planned_sql = plan_single(user_query, run, span)
+                    planner_used = "single" if plan_obj else "single->multi"
+                    span["retries"] += int(plan_obj is None)
+                
+                if plan_obj is None:
+                    plan_obj, error = plan_multi(user_query, run, span)
+        if plan_obj is None:
+            yield _complete(_failed_result(error, run), run)
+            return
+
+        yield {"type": "plan_ready", "steps": [{"step": s.step_id, "description": s.description} for s in plan_obj.steps],
+               "fast_path": None}
+
+        # 2a. SQL for every step: generate (unless planned/cached), validate & repair locally
+        step_results = {}
+        ready = []
         for step in plan_obj.steps:
-            # Generate SQL
-            raw_sql_response = sql_chain.invoke({
-                "step_description": step.description,
-                "format_instructions": sql_parser.get_format_instructions()
-            })
+            yield {"type": "step_started", "step": step.step_id, "description": step.description}
+            step_event = {"type": "step_finished", "step": step.step_id, "description": step.description,
+                          "sql": None, "data": None}
             
-            sql_response = extract_json_from_text(raw_sql_response)
-            sql = sql_response.get("sql", "").strip().rstrip(';')
+            # Generate SQL (already known when the single-call planner succeeded)
+            with tracer.span("sql_generation", step=step.step_id) as span:
+                sql = planned_sql.get(step.step_id)
+                span["from_plan"] = bool(sql)
+                if not sql:
+                    sql = generate_sql(step, run, span)
             
             if not sql:
-                 results_accumulator.append(f"Step {step.step_id} Failed: No SQL generated.\n")
+                 step_results[step.step_id] = f"Step {step.step_id} Failed: No SQL generated.\n"
+                 yield {**step_event, "status": "failed", "message": "No SQL generated."}
                  continue
             
-            # --- COMPLIANCE CHECK ---
-            try:
-                raw_compliance = compliance_chain.invoke({
-                    "sql": sql,
-                    "step_description": step.description,
-                    "format_instructions": compliance_parser.get_format_instructions()
-                })
-                compliance_result = extract_json_from_text(raw_compliance)
-                
-                if not compliance_result.get("allowed", False):
-                    reason = compliance_result.get("reason", "Unknown safety violation")
-                    results_accumulator.append(f"Step {step.step_id} BLOCKED by Compliance Agent: {reason}\n")
-                    continue
-            except Exception as e:
-                 # Fail safe: if compliance check fails, assume unsafe
-                 results_accumulator.append(f"Step {step.step_id} Failed: Compliance Audit Error ({str(e)})\n")
+            # Local validation & repair, so no network time is spent on broken SQL
+            with tracer.span("sql_validation", step=step.step_id) as span:
+                sql, validation_error = validate_and_repair_sql(step, sql, run, span=span)
+            if validation_error:
+                 step_event["sql"] = sql
+                 step_results[step.step_id] = f"Step {step.step_id} Failed: Invalid SQL ({validation_error})\n"
+                 yield {**step_event, "status": "failed", "message": f"Invalid SQL: {validation_error}"}
                  continue
-            
-            # Execute
+            step_event["sql"] = sql
+            ready.append((step, sql, step_event))
+        
+        # 2b. --- COMPLIANCE CHECK --- (cached plans too: policy may have changed since)
+        reviews, compliance = review_compliance([(step, sql) for step, sql, _ in ready], run, compliance_mode)
+        
+        approved = []
+        for step, sql, step_event in ready:
+            compliance_result = reviews[step.step_id]
+            if "error" in compliance_result:
+                 # Fail safe: if compliance check fails, assume unsafe
+                 step_results[step.step_id] = f"Step {step.step_id} Failed: Compliance Audit Error ({compliance_result['error']})\n"
+                 yield {**step_event, "status": "failed", "message": f"Compliance Audit Error ({compliance_result['error']})"}
+            elif not compliance_result.get("allowed", False):
+                reason = compliance_result.get("reason", "Unknown safety violation")
+                step_results[step.step_id] = f"Step {step.step_id} BLOCKED by Compliance Agent: {reason}\n"
+                yield {**step_event, "status": "blocked", "message": reason}
+            else:
+                approved.append((step, sql, step_event))
+        
+        # 2c. Execute approved steps; they share one federated fetch, identical SQL and filtered cohorts
+        step_token_budget = max(1, result_token_budget // max(1, len(plan_obj.steps)))
+        shared = SharedExecution(executor, include_uploaded)
+        shared.prepare(sql for _, sql, _ in approved)
+        
+        for step, sql, step_event in approved:
+            check_cancelled(run)
             try:
-                # Use the passed flag
-                df = executor.execute_combined_query(sql, include_uploaded=include_uploaded)
+                with tracer.span("execution", step=step.step_id) as span:
+                    df = shared.execute(sql, span)
+                    span["rows"] = len(df)
                 
                 step_infos.append({
                     "step": step.step_id,
@@ -261,32 +714,58 @@ def agent_workflow(user_query: str, executor: Any, include_uploaded: bool = True
                     "data": df
                 })
                 
-                results_text = f"Step {step.step_id}: {step.description}\nSQL: {sql}\nResult Data:\n{df.to_string(index=False)}\n\n"
-                results_accumulator.append(results_text)
+                compacted = compact_dataframe(df, step_token_budget)
+                compactions.append(compacted)
+                
+                step_results[step.step_id] = f"Step {step.step_id}: {step.description}\nSQL: {sql}\nResult Data:\n{compacted['text']}\n\n"
+                yield {**step_event, "status": "ok", "data": df}
                     
             except Exception as e:
-                results_accumulator.append(f"Step {step.step_id} Failed: {str(e)}\n")
+                step_results[step.step_id] = f"Step {step.step_id} Failed: {str(e)}\n"
+                yield {**step_event, "status": "failed", "message": str(e)}
+        
+        results_accumulator = [step_results[s.step_id] for s in plan_obj.steps if s.step_id in step_results]
 
         # 3. Insights Generation
-        insight_chain = insight_prompt | llm | StrOutputParser()
-        raw_insight = insight_chain.invoke({
-            "query": user_query,
-            "results_summary": "".join(results_accumulator),
-            "format_instructions": insight_parser.get_format_instructions()
-        })
+        final_insights = {}
+        for event in _insight_events(user_query, "".join(results_accumulator), run):
+            if event["type"] == "insight_ready":
+                final_insights = event["insights"]
+            else:
+                yield event
         
-        final_insights = extract_json_from_text(raw_insight)
+        # Remember fully successful plans for rephrasings of this question
+        if use_question_cache and not cached and step_infos and len(step_infos) == len(plan_obj.steps):
+            get_question_cache().add(user_query, [s.model_dump() for s in plan_obj.steps],
+                                     {info["step"]: info["sql"] for info in step_infos})
         
-        return {
-            "success": True,
-            "insight": final_insights.get("summary", "No summary generated"),
-            "key_insights": final_insights.get("key_insights", []),
-            "recommendations": final_insights.get("recommendations", []),
-            "steps": step_infos
-        }
+        extra = {"planner": planner_used, "compliance": compliance, "shared_execution": shared.stats}
+        if cached:
+            extra["cached_from"] = {"question": cached["question"], "similarity": cached["similarity"]}
+        yield _complete(_final_result(final_insights, step_infos, compactions, run, **extra), run)
 
+    except WorkflowCancelled as e:
+        yield _complete({**_failed_result(str(e), run), "cancelled": True}, run)
     except Exception as e:
-        return {
-            "success": False,
-            "error": f"Workflow Error: {str(e)}"
-        }
+        yield _complete(_failed_result(f"Workflow Error: {str(e)}", run), run)
+    finally:
+        if shared is not None:
+            shared.close()
+
+def agent_workflow(user_query: str, executor: Any, include_uploaded: bool = True,
+                   use_templates: bool = True, template_insights: bool = True,
+                   result_token_budget: int = RESULT_TOKEN_BUDGET,
+                   planner_mode: str = "multi", use_question_cache: bool = True,
+                   compliance_mode: str = "batched") -> Dict[str, Any]:
+    """
+    Runs the agent workflow to completion and returns the final result.
+    Questions matching a SQL template skip the decomposition and SQL agents.
+    Step results are compacted to fit `result_token_budget` in the insight prompt.
+    """
+    result = {"success": False, "error": "Workflow produced no result"}
+    for event in agent_workflow_stream(user_query, executor, include_uploaded, use_templates,
+                                       template_insights, result_token_budget, planner_mode,
+                                       use_question_cache, compliance_mode):
+        if event["type"] == "complete":
+            result = event["result"]
+    return result
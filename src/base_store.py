@@ -0,0 +1,118 @@
+import os
+import time
+import glob
+import tempfile
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import duckdb
+import pandas as pd
+from src.data_preprocessor import DataPreprocessor
+from src.zone_maps import compute_table_stats
+
+# Process-wide snapshot of the Supabase base tables, shared by every session.
+# Each snapshot is written once to its own DuckDB file; session connections
+# ATTACH it READ_ONLY and query it in place, so concurrent users share one
+# columnar copy instead of each holding pandas frames of the base data.
+
+BASE_TABLES = ('patients', 'activity')
+
+BASE_STORE_DIR = os.getenv('BASE_STORE_DIR') or os.path.join(tempfile.gettempdir(), 'neurohealth_base')
+
+# Snapshots older than this are rebuilt on next use
+BASE_STORE_TTL_S = int(os.getenv('BASE_STORE_TTL_S', 600))
+
+# Same cap the federated fetch has always used
+BASE_ROW_LIMIT = 20000
+
+def fetch_supabase_table(table: str) -> pd.DataFrame:
+    from src.db_manager import DatabaseManager
+    return DatabaseManager().execute_sql(f"SELECT * FROM {table} LIMIT {BASE_ROW_LIMIT}")
+
+class BaseDataStore:
+    """
+    Builds and refreshes versioned read-only snapshots. snapshot() returns
+    (alias, path, tables, stats) for the current one; callers attach it with
+    attach(). stats holds each table's zone maps (src.zone_maps).
+    """
+
+    def __init__(self, fetch: Callable[[str], pd.DataFrame] = fetch_supabase_table,
+                 directory: str = BASE_STORE_DIR, ttl_s: int = BASE_STORE_TTL_S):
+        self.fetch = fetch
+        self.directory = directory
+        self.ttl_s = ttl_s
+        self.version = 0
+        self.path: Optional[str] = None
+        self.tables: List[str] = []
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.built_at = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _build(self):
+        version = self.version + 1
+        path = os.path.join(self.directory, f"base_{os.getpid()}_{version}.duckdb")
+        if os.path.exists(path):
+            os.remove(path)
+
+        conn = duckdb.connect(path)
+        tables, stats = [], {}
+        try:
+            for table in BASE_TABLES:
+                try:
+                    df = self.fetch(table)
+                except Exception as e:
+                    print(f"Base store {table} fetch error: {e}")
+                    continue
+                if not df.empty:
+                    conn.execute(f"CREATE TABLE {table} AS SELECT * FROM df")
+                    compacted = DataPreprocessor().compact_table(conn, table)
+                    stats[table] = compute_table_stats(conn, table)
+                    print(f"Base store {table}: {len(df)} rows, compacted {compacted}")
+                    tables.append(table)
+        finally:
+            conn.close()
+
+        if not tables:
+            # Supabase unreachable or empty: nothing is cached, so the next
+            # access retries; meanwhile any previous snapshot keeps serving
+            os.remove(path)
+            return
+
+        self.version, self.path, self.tables, self.stats, self.built_at = version, path, tables, stats, time.time()
+        # Keep the previous snapshot for queries still attached to it
+        for old in glob.glob(os.path.join(self.directory, f"base_{os.getpid()}_*.duckdb")):
+            if int(old.rsplit('_', 1)[1].split('.')[0]) < version - 1:
+                try:
+                    os.remove(old)
+                except OSError as e:
+                    print(f"Base store cleanup error: {e}")
+
+    def snapshot(self) -> Tuple[str, Optional[str], List[str], Dict[str, Dict[str, Any]]]:
+        with self.lock:
+            if self.path is None or time.time() - self.built_at > self.ttl_s:
+                self._build()
+            return f"_base_{self.version}", self.path, list(self.tables), self.stats
+
+    def attach(self, conn) -> Tuple[str, List[str], Dict[str, Dict[str, Any]]]:
+        """
+        Attaches the current snapshot READ_ONLY to `conn`'s database (once per
+        version) and detaches versions older than the previous one.
+        Returns (alias, tables, stats).
+        """
+        alias, path, tables, stats = self.snapshot()
+        if path is None:
+            return alias, [], {}
+        conn.execute(f"ATTACH IF NOT EXISTS '{path}' AS {alias} (READ_ONLY)")
+        for (name,) in conn.execute("SELECT database_name FROM duckdb_databases() "
+                                    "WHERE database_name LIKE '\\_base\\_%' ESCAPE '\\'").fetchall():
+            if int(name.rsplit('_', 1)[1]) < self.version - 1:
+                try:
+                    conn.execute(f"DETACH {name}")
+                except Exception as e:
+                    print(f"Base store detach error: {e}")
+        return alias, tables, stats
+
+@lru_cache(maxsize=None)
+def get_base_store() -> BaseDataStore:
+    return BaseDataStore()
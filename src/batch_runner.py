@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+import pandas as pd
+import src.agents as agents
+from src.plan_optimizer import normalize_sql
+
+# Batch mode for agent_workflow: answers a file of questions concurrently
+# while staying under the Groq rate limits.
+#
+#   python -m src.batch_runner questions.txt --out results.jsonl --workers 4
+#   python -m src.batch_runner questions.txt --replay fixtures/llm --synthetic 2000
+#
+# or from Python:
+#
+#   from src.batch_runner import run_batch
+#   df = run_batch(["How many patients smoke?", ...], executor)
+
+# Groq limits for the account/model (free tier defaults for qwen3-32b)
+GROQ_REQUESTS_PER_MINUTE = int(os.getenv('GROQ_REQUESTS_PER_MINUTE', 60))
+GROQ_TOKENS_PER_MINUTE = int(os.getenv('GROQ_TOKENS_PER_MINUTE', 6000))
+
+class TokenBucket:
+    """
+    Classic token bucket: `capacity` units, refilled continuously over `period_s`.
+    The level may go negative when actual usage exceeds a reservation.
+    """
+
+    def __init__(self, capacity: float, period_s: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period_s
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # A request bigger than the whole bucket only waits for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float):
+        self.level = min(self.capacity, self.level - amount)
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min buckets shared by all worker threads.
+    Callers reserve an estimate with acquire() and correct it with settle()
+    once the real token usage is known.
+    """
+
+    def __init__(self, requests_per_minute: int = GROQ_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = GROQ_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = threading.Lock()
+        self.waited_s = 0.0
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Blocks until one request and `tokens` tokens are available.
+        Returns the seconds spent waiting.
+        """
+        start = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(tokens)
+                    waited = now - start
+                    self.waited_s += waited
+                    return waited
+            time.sleep(wait)
+
+    def settle(self, reserved: int, actual: int):
+        with self.lock:
+            self.tokens.refill(time.monotonic())
+            self.tokens.consume(actual - reserved)
+
+class SharedQueryCache:
+    """
+    Executor wrapper that runs each distinct SQL statement once per batch.
+    Concurrent requests for the same SQL wait for the first one instead of
+    hitting the database again.
+    """
+
+    def __init__(self, executor: Any):
+        self.executor = executor
+        self.entries: Dict[Any, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def execute_combined_query(self, sql_query: str, include_uploaded: bool = True) -> pd.DataFrame:
+        key = (normalize_sql(sql_query), include_uploaded)
+        with self.lock:
+            entry = self.entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self.entries[key] = {"done": threading.Event(), "df": None, "error": None}
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if owner:
+            try:
+                entry["df"] = self.executor.execute_combined_query(sql_query, include_uploaded=include_uploaded)
+            except Exception as e:
+                entry["error"] = e
+                # Let a later step retry instead of caching the failure
+                with self.lock:
+                    self.entries.pop(key, None)
+            finally:
+                entry["done"].set()
+        else:
+            entry["done"].wait()
+
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["df"]
+
+# --- Batch Execution ---
+
+def _question_key(question: str) -> str:
+    return " ".join(question.lower().split()).rstrip('?.! ')
+
+def _result_row(index: int, question: str, result: Dict[str, Any], queued_ms: float,
+                total_ms: float) -> Dict[str, Any]:
+    trace = result.get("trace", {})
+    spans = trace.get("spans", [])
+    row = {
+        "index": index,
+        "question": question,
+        "success": result.get("success", False),
+        "insight": result.get("insight"),
+        "key_insights": result.get("key_insights", []),
+        "recommendations": result.get("recommendations", []),
+        "error": result.get("error"),
+        "planner": result.get("planner"),
+        "fast_path": result.get("fast_path"),
+        "llm_calls": result.get("llm_calls", 0),
+        "prompt_tokens": trace.get("prompt_tokens", 0),
+        "completion_tokens": trace.get("completion_tokens", 0),
+        "queued_ms": round(queued_ms, 1),
+        "total_ms": round(total_ms, 1),
+        "rate_limit_wait_ms": round(sum(s.get("rate_limit_wait_ms", 0.0) for s in spans), 1),
+        "steps": [{
+            "step": s["step"],
+            "description": s["description"],
+            "sql": s["sql"],
+            "rows": len(s["data"]),
+            "data": s["data"].to_dict("records")
+        } for s in result.get("steps", [])],
+        "duplicate_of": None
+    }
+    for stage, stats in trace.get("stages", {}).items():
+        row[f"{stage}_ms"] = stats["duration_ms"]
+    return row
+
+def run_batch(questions: List[str], executor: Any, workers: int = 4,
+              requests_per_minute: int = GROQ_REQUESTS_PER_MINUTE,
+              tokens_per_minute: int = GROQ_TOKENS_PER_MINUTE,
+              include_uploaded: bool = False, **workflow_kwargs) -> pd.DataFrame:
+    """
+    Runs agent_workflow for every question on a thread pool, throttled by a
+    shared requests/min + tokens/min limiter. Repeated questions run once,
+    identical SQL runs once across the batch and rephrasings share plans via
+    the question cache. Returns one row per input question, in input order.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    query_cache = SharedQueryCache(executor)
+
+    # Deduplicate identical questions; the copies point at the first occurrence
+    first_index: Dict[str, int] = {}
+    unique: List[int] = []
+    for i, question in enumerate(questions):
+        key = _question_key(question)
+        if key not in first_index:
+            first_index[key] = i
+            unique.append(i)
+
+    submitted_at = time.perf_counter()
+
+    def answer(index: int) -> Dict[str, Any]:
+        question = questions[index]
+        start = time.perf_counter()
+        # Throttles this worker thread only; other callers in the process are unaffected
+        previous = agents.set_rate_limiter(limiter)
+        try:
+            result = agents.agent_workflow(question, query_cache, include_uploaded=include_uploaded,
+                                           **workflow_kwargs)
+        except Exception as e:
+            result = {"success": False, "error": f"Batch Error: {str(e)}"}
+        finally:
+            agents.set_rate_limiter(previous)
+        end = time.perf_counter()
+        print(f"[{'OK' if result.get('success') else '!!'}] {question[:70]} ({(end - start):.1f}s)")
+        return _result_row(index, question, result, (start - submitted_at) * 1000, (end - start) * 1000)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        answered = dict(zip(unique, pool.map(answer, unique)))
+
+    rows = []
+    for i, question in enumerate(questions):
+        source = first_index[_question_key(question)]
+        row = dict(answered[source], index=i, question=question)
+        if source != i:
+            row["duplicate_of"] = source
+        rows.append(row)
+
+    print(f"[*] {len(questions)} questions ({len(questions) - len(unique)} duplicates), "
+          f"SQL cache {query_cache.hits} hits / {query_cache.misses} queries, "
+          f"rate limit wait {limiter.waited_s:.1f}s")
+    df = pd.DataFrame(rows)
+    df["duplicate_of"] = df["duplicate_of"].astype("Int64")
+    return df
+
+# --- I/O ---
+
+def read_questions(path: str) -> List[str]:
+    """
+    Reads questions from .txt (one per line, '#' comments), .csv or .jsonl
+    (a 'question' column/field).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return pd.read_csv(path)['question'].dropna().astype(str).tolist()
+    if ext in ('.jsonl', '.ndjson'):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [json.loads(line)['question'] for line in f if line.strip()]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def write_results(df: pd.DataFrame, path: str):
+    """
+    Writes JSONL, or Parquet for a .parquet path (nested fields as JSON text).
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.lower().endswith('.parquet'):
+        flat = df.copy()
+        for col in ("key_insights", "recommendations", "steps"):
+            flat[col] = flat[col].apply(lambda v: json.dumps(v, default=str))
+        flat.to_parquet(path, index=False)
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in df.to_dict("records"):
+            clean = {k: (None if not isinstance(v, (list, dict)) and pd.isna(v) else v) for k, v in record.items()}
+            f.write(json.dumps(clean, default=str, ensure_ascii=False) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a file of questions with the agent workflow")
+    parser.add_argument("questions", help="Questions file (.txt, .csv or .jsonl)")
+    parser.add_argument("--out", default="batch_results.jsonl", help="Output .jsonl or .parquet")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=GROQ_REQUESTS_PER_MINUTE, help="LLM requests per minute")
+    parser.add_argument("--tpm", type=int, default=GROQ_TOKENS_PER_MINUTE, help="LLM tokens per minute")
+    parser.add_argument("--planner", choices=agents.PLANNER_MODES, default="multi")
+    parser.add_argument("--no-templates", action="store_true", help="Disable the template fast path")
+    parser.add_argument("--replay", default=None, help="Serve LLM calls from recorded fixtures in this directory")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Run queries on N synthetic patients in DuckDB instead of Supabase")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        from src.bench_agent import LocalExecutor, build_synthetic_data
+        executor = LocalExecutor(*build_synthetic_data(args.synthetic))
+    else:
+        from src.query_executor import MultiSourceQueryExecutor
+        executor = MultiSourceQueryExecutor()
+
+    if args.replay:
+        from src.llm_backends import ReplayLLM
+        agents.set_llm_backend(ReplayLLM(args.replay, latency_scale=0.0))
+
+    questions = read_questions(args.questions)
+    print(f"[*] Running {len(questions)} questions with {args.workers} workers "
+          f"({args.rpm} req/min, {args.tpm} tokens/min)")
+    df = run_batch(questions, executor, workers=args.workers, requests_per_minute=args.rpm,
+                   tokens_per_minute=args.tpm, planner_mode=args.planner,
+                   use_templates=not args.no_templates)
+    write_results(df, args.out)
+    print(f"[OK] {int(df['success'].sum())}/{len(df)} answered, results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import argparse
+import time
+import duckdb
+import numpy as np
+import pandas as pd
+import src.agents as agents
+import src.tracing as tracing
+from src.llm_backends import DEFAULT_FIXTURE_DIR, RecordingLLM, ReplayLLM
+from src.sql_validator import get_sql_validator
+
+# Offline benchmark of the agent pipeline on a fixed question corpus.
+#
+#   python -m src.bench_agent --record              # capture fixtures (needs GROQ_API_KEY)
+#   python -m src.bench_agent --latency 0           # replay: pure orchestration cost
+#   python -m src.bench_agent --latency-scale 1.0   # replay with recorded LLM latency
+
+QUESTIONS = [
+    "What is the average BMI of patients with chronic kidney disease?",
+    "How many patients have both high stress and smoking habits?",
+    "What is the correlation between age and chronic kidney disease?",
+    "Show me the distribution of patients by stress level",
+    "What percentage of patients have blood pressure abnormalities?",
+    "Compare the average physical activity of smokers and non-smokers",
+    "What are the main risk factors among patients with blood pressure abnormalities?",
+    "How do stress level and BMI differ between patients with and without chronic kidney disease?",
+]
+
+def build_synthetic_data(n_patients: int = 2000, days: int = 10, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    sex = rng.integers(0, 2, n_patients)
+    patients = pd.DataFrame({
+        'patient_number': np.arange(1, n_patients + 1),
+        'blood_pressure_abnormality': rng.integers(0, 2, n_patients),
+        'level_of_hemoglobin': rng.normal(11.5, 2.0, n_patients).round(2),
+        'genetic_pedigree_coefficient': rng.random(n_patients).round(2),
+        'age': rng.integers(18, 90, n_patients),
+        'bmi': rng.integers(15, 45, n_patients),
+        'sex': sex,
+        'pregnancy': np.where(sex == 1, rng.integers(0, 2, n_patients), 0).astype(float),
+        'smoking': rng.integers(0, 2, n_patients),
+        'salt_content_in_the_diet': rng.integers(20, 50000, n_patients),
+        'alcohol_consumption_per_day': rng.integers(0, 500, n_patients).astype(float),
+        'level_of_stress': rng.integers(1, 4, n_patients),
+        'chronic_kidney_disease': rng.integers(0, 2, n_patients),
+        'adrenal_and_thyroid_disorders': rng.integers(0, 2, n_patients),
+    })
+    activity = pd.DataFrame({
+        'patient_number': np.repeat(patients['patient_number'].values, days),
+        'day_number': np.tile(np.arange(1, days + 1), n_patients),
+        'physical_activity': rng.integers(0, 50000, n_patients * days).astype(float),
+    })
+    return patients, activity
+
+class LocalExecutor:
+    """
+    Stand-in for MultiSourceQueryExecutor that runs queries on synthetic data
+    in DuckDB, so executor time is measured without Supabase.
+    """
+
+    def __init__(self, patients: pd.DataFrame, activity: pd.DataFrame):
+        self.conn = duckdb.connect(':memory:')
+        self.conn.execute("CREATE TABLE patients AS SELECT * FROM patients")
+        self.conn.execute("CREATE TABLE activity AS SELECT * FROM activity")
+        self.elapsed_s = 0.0
+
+    def execute_combined_query(self, sql_query: str, include_uploaded: bool = True) -> pd.DataFrame:
+        # A cursor per query keeps concurrent callers (batch runner) safe
+        cursor = self.conn.cursor()
+        try:
+            return self._timed(cursor, sql_query).df()
+        finally:
+            cursor.close()
+
+    def open_engine(self, include_uploaded: bool = True) -> "LocalEngine":
+        return LocalEngine(self)
+
+    def _timed(self, conn, sql_query: str):
+        start = time.perf_counter()
+        try:
+            return conn.execute(sql_query)
+        finally:
+            self.elapsed_s += time.perf_counter() - start
+
+class LocalEngine:
+    """
+    Request-scoped engine for LocalExecutor (same interface as
+    FederatedEngine); temp tables live on its own cursor.
+    """
+
+    def __init__(self, executor: LocalExecutor):
+        self.executor = executor
+        self.conn = executor.conn.cursor()
+
+    def execute(self, sql_query: str) -> pd.DataFrame:
+        return self.executor._timed(self.conn, sql_query).df()
+
+    def materialize(self, table_name: str, sql_query: str):
+        self.executor._timed(self.conn, f"CREATE TEMP TABLE {table_name} AS {sql_query}")
+
+    def close(self):
+        self.conn.close()
+
+class TimedLLM:
+    """
+    Measures wall time spent inside the wrapped backend. Per-model views from
+    for_model() add their time to the TimedLLM they came from.
+    """
+
+    def __init__(self, inner, parent: "TimedLLM" = None):
+        self.inner = inner
+        self.parent = parent
+        self.elapsed_s = 0.0
+
+    def for_model(self, model: str) -> "TimedLLM":
+        # Lets agents.get_llm route each stage through the wrapped backend
+        if not hasattr(self.inner, "for_model"):
+            return self
+        return TimedLLM(self.inner.for_model(model), self.parent or self)
+
+    def _add(self, seconds: float):
+        (self.parent or self).elapsed_s += seconds
+
+    def invoke(self, messages):
+        start = time.perf_counter()
+        try:
+            return self.inner.invoke(messages)
+        finally:
+            self._add(time.perf_counter() - start)
+
+    def stream(self, messages):
+        start = time.perf_counter()
+        try:
+            for chunk in self.inner.stream(messages):
+                self._add(time.perf_counter() - start)
+                yield chunk
+                start = time.perf_counter()
+        finally:
+            self._add(time.perf_counter() - start)
+
+def run_benchmark(backend, questions=QUESTIONS, repeat: int = 3, planner_mode: str = "multi",
+                  use_templates: bool = True, n_patients: int = 2000,
+                  compliance_mode: str = "batched") -> pd.DataFrame:
+    """
+    Runs every question `repeat` times and splits wall time into LLM wait,
+    executor, JSON parsing (extract_json_from_text) and orchestration overhead.
+    """
+    patients, activity = build_synthetic_data(n_patients)
+    executor = LocalExecutor(patients, activity)
+    timed = TimedLLM(backend)
+    agents.set_llm_backend(timed)
+
+    parse_time = {"s": 0.0}
+    original_parse = agents.extract_json_from_text
+
+    def timed_parse(text):
+        start = time.perf_counter()
+        try:
+            return original_parse(text)
+        finally:
+            parse_time["s"] += time.perf_counter() - start
+
+    agents.extract_json_from_text = timed_parse
+    # Warm up one-time costs (lazy langchain import, validator catalog)
+    agents._prompts()
+    get_sql_validator()
+    rows = []
+    try:
+        for question in questions:
+            for i in range(repeat):
+                timed.elapsed_s = executor.elapsed_s = parse_time["s"] = 0.0
+                start = time.perf_counter()
+                result = agents.agent_workflow(question, executor, include_uploaded=False,
+                                               use_templates=use_templates, planner_mode=planner_mode,
+                                               use_question_cache=False, compliance_mode=compliance_mode)
+                total = time.perf_counter() - start
+                rows.append({
+                    "question": question[:60],
+                    "run": i,
+                    "success": result["success"],
+                    "llm_calls": result.get("llm_calls", 0),
+                    "compliance_calls": result.get("compliance", {}).get("llm_calls", 0),
+                    "compliance_ms": result.get("compliance", {}).get("latency_ms", 0.0),
+                    "total_ms": total * 1000,
+                    "llm_ms": timed.elapsed_s * 1000,
+                    "executor_ms": executor.elapsed_s * 1000,
+                    "parse_ms": parse_time["s"] * 1000,
+                    "overhead_ms": (total - timed.elapsed_s - executor.elapsed_s - parse_time["s"]) * 1000,
+                    "error": result.get("error", "")
+                })
+    finally:
+        agents.extract_json_from_text = original_parse
+        agents.set_llm_backend(None)
+
+    return pd.DataFrame(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline with recorded LLM responses")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURE_DIR, help="Fixture directory")
+    parser.add_argument("--record", action="store_true", help="Call Groq and record responses as fixtures")
+    parser.add_argument("--latency", type=float, default=None, help="Synthetic latency per replayed call (seconds)")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="Multiplier for recorded latency when --latency is not set")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--planner", choices=agents.PLANNER_MODES, default="multi")
+    parser.add_argument("--no-templates", action="store_true", help="Disable the template fast path")
+    parser.add_argument("--compliance", choices=agents.COMPLIANCE_MODES, default="batched",
+                        help="Review all plan steps in one call or one call per step")
+    parser.add_argument("--patients", type=int, default=2000, help="Synthetic patients rows")
+    parser.add_argument("--trace-log", default="", help="Append agent traces to this file (default: off)")
+    parser.add_argument("--out", default=None, help="Write per-run results to this CSV")
+    args = parser.parse_args()
+
+    tracing.TRACE_LOG_PATH = args.trace_log
+
+    if args.record:
+        backend = RecordingLLM(agents.get_groq_llm(), args.fixtures, model_factory=agents.get_groq_llm,
+                               model=agents.LLM_MODEL)
+        repeat = 1
+    else:
+        backend = ReplayLLM(args.fixtures, latency_s=args.latency, latency_scale=args.latency_scale)
+        repeat = args.repeat
+
+    df = run_benchmark(backend, repeat=repeat, planner_mode=args.planner,
+                       use_templates=not args.no_templates, n_patients=args.patients,
+                       compliance_mode=args.compliance)
+
+    metrics = ["total_ms", "llm_ms", "compliance_ms", "executor_ms", "parse_ms", "overhead_ms"]
+    print("\n[*] Per-question mean (ms):")
+    print(df.groupby("question", sort=False)[["llm_calls", "compliance_calls"] + metrics].mean().round(2).to_string())
+    print("\n[*] Overall:")
+    print(df[metrics].describe(percentiles=[0.5, 0.95]).loc[["mean", "50%", "95%", "max"]].round(2).to_string())
+
+    failed = df[~df["success"]]
+    if not failed.empty:
+        print(f"\n[!] {len(failed)} failed runs:")
+        print(failed[["question", "error"]].drop_duplicates().to_string(index=False))
+
+    if args.out:
+        df.to_csv(args.out, index=False)
+        print(f"\n[OK] Results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
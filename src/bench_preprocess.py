@@ -0,0 +1,133 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from src.data_preprocessor import DataPreprocessor
+
+# Benchmark of patients preprocessing: the previous row-wise implementation
+# against the vectorized DataPreprocessor.preprocess_patients_data.
+#
+#   python -m src.bench_preprocess                          # 10k, 1M, 10M rows
+#   python -m src.bench_preprocess --sizes 10000 100000 --repeat 5
+#   python -m src.bench_preprocess --legacy-max-rows 10000000   # row-wise at 10M too (slow)
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+
+# Share of missing values injected into each imputed column
+NULL_RATE = 0.05
+
+def legacy_preprocess_patients_data(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The previous implementation: full copy, row-wise apply for pregnancy.
+    Its chained `df[col].fillna(..., inplace=True)` calls are written as
+    assignments, since under copy-on-write (pandas 3) the chained form
+    silently fills nothing.
+    """
+    df_clean = df.copy()
+    if 'pregnancy' in df_clean.columns and 'sex' in df_clean.columns:
+        df_clean['pregnancy'] = df_clean.apply(
+            lambda row: 0 if row['sex'] == 0 else row.get('pregnancy', 0),
+            axis=1
+        )
+        df_clean['pregnancy'] = df_clean['pregnancy'].fillna(0)
+    for col in ('alcohol_consumption_per_day', 'genetic_pedigree_coefficient', 'salt_content_in_the_diet'):
+        if col in df_clean.columns:
+            df_clean[col] = df_clean[col].fillna(df_clean[col].median())
+    if 'bmi' in df_clean.columns:
+        df_clean['bmi'] = df_clean['bmi'].fillna(df_clean['bmi'].mean())
+    if 'smoking' in df_clean.columns:
+        df_clean['smoking'] = df_clean['smoking'].fillna(0)
+    return df_clean
+
+def build_patients(n: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    sex = rng.integers(0, 2, n)
+
+    def with_nulls(values):
+        values = values.astype(float)
+        values[rng.random(n) < NULL_RATE] = np.nan
+        return values
+
+    return pd.DataFrame({
+        'patient_number': np.arange(1, n + 1),
+        'blood_pressure_abnormality': rng.integers(0, 2, n),
+        'level_of_hemoglobin': rng.normal(11.5, 2.0, n).round(2),
+        'genetic_pedigree_coefficient': with_nulls(rng.random(n).round(2)),
+        'age': rng.integers(18, 90, n),
+        'bmi': with_nulls(rng.integers(15, 45, n)),
+        'sex': sex,
+        'pregnancy': with_nulls(rng.integers(0, 2, n)),
+        'smoking': with_nulls(rng.integers(0, 2, n)),
+        'salt_content_in_the_diet': with_nulls(rng.integers(20, 50000, n)),
+        'alcohol_consumption_per_day': with_nulls(rng.integers(0, 500, n)),
+        'level_of_stress': rng.integers(1, 4, n),
+        'chronic_kidney_disease': rng.integers(0, 2, n),
+        'adrenal_and_thyroid_disorders': rng.integers(0, 2, n),
+    })
+
+def measure(fn, df: pd.DataFrame, repeat: int):
+    """
+    (best seconds, peak MB allocated above the input, result). Timing runs
+    without tracemalloc, which slows allocation-heavy code; one extra run
+    measures the peak.
+    """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(df)
+        best = min(best, time.perf_counter() - start)
+    del result
+    tracemalloc.start()
+    result = fn(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1e6, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark row-wise vs vectorized patients preprocessing")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Row counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per size (best is reported)")
+    parser.add_argument("--legacy-max-rows", type=int, default=1_000_000,
+                        help="Skip the row-wise implementation above this many rows")
+    parser.add_argument("--out", default=None, help="Write results to this CSV")
+    args = parser.parse_args()
+
+    preprocessor = DataPreprocessor()
+    implementations = {
+        'legacy': legacy_preprocess_patients_data,
+        'vectorized': preprocessor.preprocess_patients_data,
+    }
+
+    rows = []
+    for n in args.sizes:
+        df = build_patients(n)
+        print(f"[*] {n:,} rows ({df.memory_usage(deep=True).sum() / 1e6:.0f} MB input)")
+        results = {}
+        for name, fn in implementations.items():
+            if name == 'legacy' and n > args.legacy_max_rows:
+                print(f"    {name:<10} skipped (--legacy-max-rows {args.legacy_max_rows:,})")
+                continue
+            # Row-wise apply is too slow to repeat at scale
+            seconds, peak_mb, results[name] = measure(fn, df, args.repeat if name != 'legacy' or n <= 10_000 else 1)
+            rows.append({'rows': n, 'implementation': name, 'seconds': round(seconds, 4),
+                         'rows_per_s': round(n / seconds), 'peak_mb': round(peak_mb, 1)})
+            print(f"    {name:<10} {seconds:8.3f} s  {n / seconds:14,.0f} rows/s  peak {peak_mb:8.1f} MB")
+
+        if len(results) == 2:
+            # Values must match; dtypes may differ where apply upcast pregnancy to float
+            pd.testing.assert_frame_equal(results['legacy'], results['vectorized'], check_dtype=False)
+            print("    [OK] outputs identical")
+        del df, results
+
+    df = pd.DataFrame(rows)
+    if not df.empty and df['implementation'].nunique() == 2:
+        speedup = df.pivot(index='rows', columns='implementation', values='seconds').dropna()
+        print("\n[*] Speedup (legacy / vectorized):")
+        print((speedup['legacy'] / speedup['vectorized']).round(1).to_string())
+    if args.out:
+        df.to_csv(args.out, index=False)
+        print(f"\n[OK] Results written to {args.out}")
+
+if __name__ == "__main__":
+    main()
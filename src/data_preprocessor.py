@@ -13,6 +13,14 @@ class DataPreprocessor:
         'patient_number', 'day_number', 'physical_activity'
     ]
     
+    # Every column of the base tables; columnar uploads are projected to these
+    PATIENTS_SCHEMA_COLS = PATIENTS_REQUIRED_COLS + [
+        'pregnancy', 'alcohol_consumption_per_day', 'level_of_hemoglobin',
+        'genetic_pedigree_coefficient', 'salt_content_in_the_diet'
+    ]
+    
+    ACTIVITY_SCHEMA_COLS = ACTIVITY_REQUIRED_COLS
+    
     def normalize_columns(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Normalizes column names to match the required schema.
@@ -127,22 +135,24 @@ class DataPreprocessor:
             
         return 'unknown'
     
+    # Keywords to look for in a header row
+    HEADER_KEYWORDS = set([
+        'patient', 'age', 'bmi', 'sex', 'gender', 'kidney', 'blood', 'pressure', 'stress',
+        'day', 'activity', 'steps'
+    ])
+    
+    def _header_matches(self, values) -> int:
+        row_str = " ".join([str(x).lower() for x in values])
+        return sum(1 for k in self.HEADER_KEYWORDS if k in row_str)
+    
     def find_best_header_row(self, df: pd.DataFrame) -> tuple[int, pd.DataFrame]:
         """
         Scans the dataframe to find the most likely header row.
         Returns (row_index_to_promote, dataframe_with_promoted_header)
         If no better header found, returns (-1, df)
         """
-        # Keywords to look for in a header row
-        patients_keywords = ['patient', 'age', 'bmi', 'sex', 'gender', 'kidney', 'blood', 'pressure', 'stress']
-        activity_keywords = ['patient', 'day', 'activity', 'steps']
-        all_keywords = set(patients_keywords + activity_keywords)
-        
         # Check current columns first
-        curr_cols_str = " ".join([str(c).lower() for c in df.columns])
-        curr_matches = sum(1 for k in all_keywords if k in curr_cols_str)
-        
-        if curr_matches >= 3:
+        if self._header_matches(df.columns) >= 3:
             return -1, df
             
         best_row_idx = -1
@@ -150,8 +160,7 @@ class DataPreprocessor:
         
         # Scan first 10 rows
         for i, row in df.head(10).iterrows():
-            row_str = " ".join([str(x).lower() for x in row.values])
-            matches = sum(1 for k in all_keywords if k in row_str)
+            matches = self._header_matches(row.values)
             
             if matches > max_matches and matches >= 2:
                 max_matches = matches
@@ -166,6 +175,22 @@ class DataPreprocessor:
             return best_row_idx, df_new
             
         return -1, df
+    
+    def find_header_line(self, lines: list) -> int:
+        """
+        find_best_header_row for raw split lines (see DataFileReader.sniff_text).
+        Returns the index of the header line, 0 when the first line is kept.
+        """
+        if not lines or self._header_matches(lines[0]) >= 3:
+            return 0
+        
+        best_line, max_matches = 0, 0
+        for i, values in enumerate(lines[1:11], start=1):
+            matches = self._header_matches(values)
+            if matches > max_matches and matches >= 2:
+                max_matches = matches
+                best_line = i
+        return best_line
 
     def normalize_columns(self, df: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
         """
@@ -292,47 +317,151 @@ class DataPreprocessor:
         return df, mapping_log
 
     def preprocess_patients_data(self, df: pd.DataFrame):
-        df_clean = df.copy()
+        """
+        Vectorized: column-wise masks and fills instead of a row-wise apply.
+        The input is left untouched; only the filled columns are new arrays,
+        the rest are shared with `df` (copy-on-write).
+        """
+        updates = {}
         
         # Handle values
-        if 'pregnancy' in df_clean.columns and 'sex' in df_clean.columns:
-            df_clean['pregnancy'] = df_clean.apply(
-                lambda row: 0 if row['sex'] == 0 else row.get('pregnancy', 0),
-                axis=1
-            )
-            df_clean['pregnancy'] = df_clean['pregnancy'].fillna(0)
-        
-        if 'alcohol_consumption_per_day' in df_clean.columns:
-            median_val = df_clean['alcohol_consumption_per_day'].median()
-            df_clean['alcohol_consumption_per_day'].fillna(median_val, inplace=True)
-        
-        if 'genetic_pedigree_coefficient' in df_clean.columns:
-            median_val = df_clean['genetic_pedigree_coefficient'].median()
-            df_clean['genetic_pedigree_coefficient'].fillna(median_val, inplace=True)
-        
-        if 'bmi' in df_clean.columns:
-            mean_val = df_clean['bmi'].mean()
-            df_clean['bmi'].fillna(mean_val, inplace=True)
+        if 'pregnancy' in df.columns and 'sex' in df.columns:
+            updates['pregnancy'] = df['pregnancy'].where(df['sex'].ne(0), 0).fillna(0)
         
-        if 'smoking' in df_clean.columns:
-            df_clean['smoking'].fillna(0, inplace=True)
+        fills = {
+            'alcohol_consumption_per_day': 'median',
+            'genetic_pedigree_coefficient': 'median',
+            'bmi': 'mean',
+            'salt_content_in_the_diet': 'median'
+        }
+        for col, agg in fills.items():
+            if col in df.columns and df[col].hasnans:
+                updates[col] = df[col].fillna(getattr(df[col], agg)())
         
-        if 'salt_content_in_the_diet' in df_clean.columns:
-            median_val = df_clean['salt_content_in_the_diet'].median()
-            df_clean['salt_content_in_the_diet'].fillna(median_val, inplace=True)
+        if 'smoking' in df.columns and df['smoking'].hasnans:
+            updates['smoking'] = df['smoking'].fillna(0)
         
-        return df_clean
+        return df.assign(**updates)
     
     def preprocess_activity_data(self, df: pd.DataFrame):
-        df_clean = df.copy()
+        df_clean = df
         
         if 'day_number' in df_clean.columns:
             df_clean = df_clean[df_clean['day_number'] > 0]
         
         if 'physical_activity' in df_clean.columns:
             median_val = df_clean['physical_activity'].median()
-            df_clean['physical_activity'].fillna(median_val, inplace=True)
+            df_clean = df_clean.assign(physical_activity=df_clean['physical_activity'].fillna(median_val))
         
         return df_clean
 
 
+
+    # --- SQL Preprocessing ---
+    # Same rules as the pandas versions above, as a SELECT over a DuckDB table,
+    # so large uploads are cleaned without leaving the database.
+    
+    def _fill_values(self, conn, table: str, fills: dict, where: str = "") -> dict:
+        # One scan for all medians/means; returns {column: (value, type)} for
+        # the columns that actually have NULLs, so the rest keep their type untouched
+        exprs = [f'COUNT(*) - COUNT("{col}")' for col in fills] + [f'{agg}("{col}")' for col, agg in fills.items()]
+        row = conn.execute(f'SELECT {", ".join(exprs)} FROM {table} {where}').fetchone()
+        types = {name: col_type for name, col_type, *_ in conn.execute(f"DESCRIBE SELECT * FROM {table}").fetchall()}
+        return {col: (value, types[col]) for col, nulls, value in zip(fills, row[:len(fills)], row[len(fills):])
+                if nulls and value is not None}
+    
+    @staticmethod
+    def _coalesce(col: str, fill: tuple) -> str:
+        # Cast to the column's own type so e.g. BIGINT doesn't widen to DECIMAL
+        # (integer columns get the median rounded)
+        value, col_type = fill
+        return f'COALESCE("{col}", CAST({float(value)!r} AS {col_type})) AS "{col}"'
+    
+    def preprocess_patients_sql(self, conn, table: str, columns: list) -> str:
+        fills = {col: agg for col, agg in [
+            ('alcohol_consumption_per_day', 'MEDIAN'),
+            ('genetic_pedigree_coefficient', 'MEDIAN'),
+            ('bmi', 'AVG'),
+            ('salt_content_in_the_diet', 'MEDIAN')
+        ] if col in columns}
+        values = self._fill_values(conn, table, fills) if fills else {}
+        
+        select = []
+        for col in columns:
+            if col == 'pregnancy' and 'sex' in columns:
+                select.append('CASE WHEN "sex" = 0 THEN 0 ELSE COALESCE("pregnancy", 0) END AS "pregnancy"')
+            elif col == 'smoking':
+                select.append('COALESCE("smoking", 0) AS "smoking"')
+            elif col in values:
+                select.append(self._coalesce(col, values[col]))
+            else:
+                select.append(f'"{col}"')
+        return f'SELECT {", ".join(select)} FROM {table}'
+    
+    def preprocess_activity_sql(self, conn, table: str, columns: list) -> str:
+        where = 'WHERE "day_number" > 0' if 'day_number' in columns else ''
+        values = {}
+        if 'physical_activity' in columns:
+            values = self._fill_values(conn, table, {'physical_activity': 'MEDIAN'}, where)
+        
+        select = [self._coalesce(col, values[col]) if col in values else f'"{col}"' for col in columns]
+        return f'SELECT {", ".join(select)} FROM {table} {where}'
+
+    # --- Type Compaction ---
+    # Narrowest lossless storage types for a DuckDB table: numeric text back to
+    # numbers, integral columns to TINYINT/SMALLINT/INTEGER (0/1 flags and
+    # stress levels end up as TINYINT), doubles to FLOAT only when every value
+    # survives the round trip. Queries see the usual wide types again through
+    # the federated views (see MultiSourceQueryExecutor.source_query).
+    
+    INT_TYPES = [('TINYINT', -128, 127), ('SMALLINT', -32768, 32767), ('INTEGER', -2**31, 2**31 - 1)]
+    TYPE_WIDTHS = {'TINYINT': 1, 'SMALLINT': 2, 'INTEGER': 4, 'FLOAT': 4, 'BIGINT': 8, 'DOUBLE': 8, 'HUGEINT': 16}
+    NUMERIC_TYPES = tuple(TYPE_WIDTHS)
+    
+    def compact_table(self, conn, table: str) -> dict:
+        """
+        Converts `table`'s columns in place. Returns {column: new_type} for
+        the columns that changed.
+        """
+        types = dict(conn.execute(
+            "SELECT column_name, data_type FROM duckdb_columns() "
+            "WHERE table_name = ? AND database_name = current_database() AND schema_name = 'main'",
+            [table]).fetchall())
+        changes = {}
+        
+        # 1. Numbers stored as text (e.g. columns under a promoted header row)
+        texts = [col for col, t in types.items() if t == 'VARCHAR']
+        if texts:
+            checks = conn.execute("SELECT " + ", ".join(
+                f'COUNT("{c}") > 0 AND COUNT("{c}") = COUNT(TRY_CAST("{c}" AS DOUBLE))' for c in texts
+            ) + f" FROM {table}").fetchone()
+            for col, numeric in zip(texts, checks):
+                if numeric:
+                    conn.execute(f'ALTER TABLE {table} ALTER COLUMN "{col}" SET DATA TYPE DOUBLE '
+                                 f'USING TRY_CAST("{col}" AS DOUBLE)')
+                    types[col] = changes[col] = 'DOUBLE'
+        
+        # 2. Narrow numeric columns, one scan for all of them
+        numeric = [col for col, t in types.items() if t in self.NUMERIC_TYPES]
+        if not numeric:
+            return changes
+        exprs = []
+        for col in numeric:
+            exprs += [f'MIN("{col}")', f'MAX("{col}")',
+                      f'COALESCE(BOOL_AND("{col}" = ROUND("{col}")), false)',
+                      f'COALESCE(BOOL_AND(CAST(CAST("{col}" AS FLOAT) AS DOUBLE) = "{col}"), false)']
+        stats = conn.execute(f"SELECT {', '.join(exprs)} FROM {table}").fetchone()
+        
+        for i, col in enumerate(numeric):
+            low, high, integral, fits_float = stats[i * 4:i * 4 + 4]
+            if low is None:
+                continue
+            new_type = None
+            if integral:
+                new_type = next((name for name, lo, hi in self.INT_TYPES if lo <= low and high <= hi), None)
+            elif fits_float and types[col] == 'DOUBLE':
+                new_type = 'FLOAT'
+            if new_type and self.TYPE_WIDTHS[new_type] < self.TYPE_WIDTHS[types[col]]:
+                conn.execute(f'ALTER TABLE {table} ALTER COLUMN "{col}" SET DATA TYPE {new_type}')
+                changes[col] = new_type
+        return changes
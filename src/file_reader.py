@@ -1,6 +1,18 @@
 import pandas as pd
 import io
 
+# Formats DuckDB can read straight from the uploaded bytes (see
+# src.ingestion.load_text_file); the rest go through pandas
+NATIVE_FORMATS = ['csv', 'txt']
+
+# Columnar formats, read with pyarrow (column-projected, zero-copy) and
+# scanned by DuckDB as Arrow
+ARROW_FORMATS = ['parquet', 'feather', 'arrow', 'ipc']
+ARROW_FORMAT_NAMES = {'parquet': 'Parquet', 'feather': 'Feather', 'arrow': 'Arrow IPC', 'ipc': 'Arrow IPC'}
+
+# How much of a file is decoded to sniff its separator, header row and encoding
+SNIFF_BYTES = 64 * 1024
+
 class DataFileReader:
     
     @staticmethod
@@ -20,6 +32,91 @@ class DataFileReader:
         
         return ','
     
+    @staticmethod
+    def sniff_text(head: bytes):
+        """
+        Sniffs the first bytes of a delimited text file.
+        Returns (separator, encoding, lines) where lines are the first complete
+        lines split on the separator, for header detection.
+        """
+        # Cut at the last newline so a multi-byte character is never split
+        if len(head) >= SNIFF_BYTES and b'\n' in head:
+            head = head[:head.rindex(b'\n')]
+        try:
+            content, encoding = head.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            content, encoding = head.decode('latin-1'), 'latin-1'
+        
+        separator = DataFileReader.detect_separator(content)
+        lines = [line.rstrip('\r').split(separator) for line in content.split('\n') if line.strip()]
+        return separator, encoding, lines
+    
+    @staticmethod
+    def _arrow_source(uploaded_file):
+        # Zero-copy view of uploaded bytes; files on disk are memory-mapped
+        import pyarrow as pa
+        if isinstance(uploaded_file, str):
+            return pa.memory_map(uploaded_file, 'r')
+        return pa.BufferReader(pa.py_buffer(uploaded_file.getbuffer()))
+    
+    @staticmethod
+    def _file_extension(uploaded_file) -> str:
+        name = uploaded_file if isinstance(uploaded_file, str) else uploaded_file.name
+        return name.split('.')[-1].lower()
+    
+    @staticmethod
+    def read_arrow_schema(uploaded_file) -> list:
+        """
+        Column names of a Parquet/Feather/Arrow IPC file, from its footer only.
+        """
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+        import pyarrow.ipc as ipc
+        source = DataFileReader._arrow_source(uploaded_file)
+        if DataFileReader._file_extension(uploaded_file) == 'parquet':
+            return pq.read_schema(source).names
+        if source.read(4) == b'FEA1':
+            # Feather v1 (pre-Arrow IPC) has no schema-only reader; its
+            # tables are small legacy files, so read it whole
+            source.seek(0)
+            return feather.read_table(source, memory_map=False).schema.names
+        source.seek(0)
+        try:
+            return ipc.open_file(source).schema.names
+        except Exception:
+            # Arrow IPC stream format (no footer)
+            source.seek(0)
+            return ipc.open_stream(source).schema.names
+    
+    @staticmethod
+    def read_arrow_table(uploaded_file, columns=None):
+        """
+        Reads a Parquet/Feather/Arrow IPC file as a pyarrow Table. Only
+        `columns` are decoded; uncompressed IPC buffers are used in place.
+        """
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+        import pyarrow.ipc as ipc
+        source = DataFileReader._arrow_source(uploaded_file)
+        if DataFileReader._file_extension(uploaded_file) == 'parquet':
+            return pq.read_table(source, columns=columns)
+        try:
+            return feather.read_table(source, columns=columns, memory_map=False)
+        except Exception:
+            source.seek(0)
+            table = ipc.open_stream(source).read_all()
+            return table.select(columns) if columns is not None else table
+    
+    @staticmethod
+    def read_text_chunks(uploaded_file, separator: str, encoding: str, skiprows: int, chunk_rows: int):
+        """
+        Iterates over a delimited text file `chunk_rows` rows at a time,
+        with the header on line `skiprows`.
+        """
+        uploaded_file.seek(0)
+        return pd.read_csv(uploaded_file, sep=separator, encoding=encoding, skiprows=skiprows,
+                           chunksize=chunk_rows)
+    
     @staticmethod
     def read_file(uploaded_file, sheet_name=None):
         file_extension = uploaded_file.name.split('.')[-1].lower()
@@ -46,6 +143,10 @@ class DataFileReader:
                 df = pd.read_json(uploaded_file)
                 return df, "JSON"
             
+            elif file_extension in ARROW_FORMATS:
+                df = DataFileReader.read_arrow_table(uploaded_file).to_pandas()
+                return df, ARROW_FORMAT_NAMES[file_extension]
+            
             elif file_extension == 'txt':
                 content = uploaded_file.getvalue().decode('utf-8')
                 separator = DataFileReader.detect_separator(content)
@@ -68,4 +169,4 @@ class DataFileReader:
     
     @staticmethod
     def get_supported_formats():
-        return ['csv', 'xlsx', 'xls', 'json', 'txt']
+        return ['csv', 'xlsx', 'xls', 'json', 'txt'] + ARROW_FORMATS
@@ -0,0 +1,482 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import pandas as pd
+from src.file_reader import DataFileReader, NATIVE_FORMATS, ARROW_FORMATS, ARROW_FORMAT_NAMES, SNIFF_BYTES
+from src.data_preprocessor import DataPreprocessor
+from src.session_db import estimate_table_bytes
+from src.zone_maps import compute_table_stats
+
+# Upload pipeline for the sidebar: every file is read, header-detected,
+# normalized, validated and preprocessed on its own worker thread, into a
+# private staging table. The staged tables are then registered in one
+# transaction, so a batch of uploads appears all at once or not at all.
+#
+# Threads rather than processes: DuckDB and the pandas parsers release the
+# GIL for the heavy work, and a DuckDB connection can't be shared across
+# processes.
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+
+# Rows per chunk when a text file has to go through pandas; bounds peak memory
+# to a few chunks regardless of file size
+INGEST_CHUNK_ROWS = int(os.getenv('INGEST_CHUNK_ROWS', 100000))
+
+# Preprocessed uploads are kept as Parquet, keyed by content hash, so the
+# same bytes are parsed once per process whichever session uploads them
+INGEST_CACHE_DIR = os.getenv('INGEST_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'neurohealth_ingest_cache')
+INGEST_CACHE_SIZE = int(os.getenv('INGEST_CACHE_SIZE', 50))
+
+STAGING_PREFIX = '_staging_'
+
+def upload_table_name(uploaded_file) -> str:
+    return uploaded_file.name.rsplit('.', 1)[0].replace(' ', '_')
+
+def unique_table_name(stem: str, taken: set) -> str:
+    """stem, or stem_2, stem_3, ... if another file already uses it."""
+    name, n = stem, 1
+    while name in taken:
+        n += 1
+        name = f"{stem}_{n}"
+    return name
+
+# Streamlit reruns the script with the same uploads on every interaction;
+# hashing a large file each time would dominate, so hashes are memoized
+# by the uploader's per-upload file_id
+_hash_memo: "OrderedDict[str, str]" = OrderedDict()
+_hash_memo_lock = threading.Lock()
+
+def file_sha256(uploaded_file) -> str:
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id:
+        with _hash_memo_lock:
+            if file_id in _hash_memo:
+                return _hash_memo[file_id]
+
+    if hasattr(uploaded_file, 'getbuffer'):
+        with uploaded_file.getbuffer() as view:
+            digest = hashlib.sha256(view).hexdigest()
+    else:
+        uploaded_file.seek(0)
+        h = hashlib.sha256()
+        while chunk := uploaded_file.read(8 * 1024 * 1024):
+            h.update(chunk)
+        digest = h.hexdigest()
+
+    if file_id:
+        with _hash_memo_lock:
+            _hash_memo[file_id] = digest
+            while len(_hash_memo) > 256:
+                _hash_memo.popitem(last=False)
+    return digest
+
+class IngestCache:
+    """
+    Process-wide LRU of pipeline results keyed by (sha256, data_type).
+    Valid results keep their table as a Parquet file; invalid ones keep only
+    the validation message. A per-key lock makes concurrent uploads of the
+    same bytes wait for the first one instead of parsing twice.
+    """
+
+    def __init__(self, directory: str = INGEST_CACHE_DIR, size: int = INGEST_CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+        self.entries: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self.key_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key_lock(self, key: Tuple[str, str]) -> threading.Lock:
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.get('path') and not os.path.exists(entry['path']):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, key: Tuple[str, str], cursor, table: Optional[str], result: Dict[str, Any]):
+        entry = {k: v for k, v in result.items() if k in (
+            'file_info', 'sheet_msg', 'header_row', 'mapping_log', 'columns', 'rows', 'valid', 'message',
+            'compacted', 'bytes_before', 'bytes_after', 'stats')}
+        entry['path'] = None
+        if table:
+            entry['path'] = os.path.join(self.directory, f"{key[0]}_{key[1]}.parquet")
+            cursor.execute(f"COPY {table} TO '{entry['path']}' (FORMAT PARQUET)")
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            evicted = []
+            # Oldest first, skipping keys being loaded right now (their lock is held)
+            for old_key in list(self.entries):
+                if len(self.entries) <= self.size:
+                    break
+                if old_key == key or self.key_locks.get(old_key, threading.Lock()).locked():
+                    continue
+                old = self.entries.pop(old_key)
+                self.key_locks.pop(old_key, None)
+                evicted.append(old.get('path'))
+            # A file is only removed once no remaining entry points to it
+            referenced = {e.get('path') for e in self.entries.values()}
+            evicted = [path for path in evicted if path and path not in referenced]
+        for path in evicted:
+            if os.path.exists(path):
+                os.remove(path)
+
+@lru_cache(maxsize=None)
+def get_ingest_cache() -> IngestCache:
+    return IngestCache()
+
+def _validate(preprocessor: DataPreprocessor, df: pd.DataFrame, data_type: str):
+    if data_type == 'patients':
+        return preprocessor.validate_patients_schema(df)
+    return preprocessor.validate_activity_schema(df)
+
+# --- Loaders (run on a worker, write into `target` through their own cursor) ---
+
+def load_text_file(cursor, uploaded_file, target: str, data_type: str,
+                   preprocessor: DataPreprocessor) -> Dict[str, Any]:
+    """
+    CSV/TXT fast path: DuckDB's parallel CSV reader loads the uploaded bytes
+    with the sniffed separator and header row, then column mapping,
+    validation and imputation run as SQL. The data never goes through pandas.
+    Raises on anything the reader can't handle so the caller can fall back
+    to load_dataframe_file.
+    """
+    uploaded_file.seek(0)
+    separator, encoding, lines = DataFileReader.sniff_text(uploaded_file.read(SNIFF_BYTES))
+    header_line = preprocessor.find_header_line(lines)
+
+    # read_csv needs a path (file objects require fsspec); one sequential copy
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as tmp:
+        while chunk := uploaded_file.read(8 * 1024 * 1024):
+            tmp.write(chunk)
+    raw = f"_raw{target}"
+    try:
+        source = (f"read_csv('{tmp.name}', delim='{separator}', header=true, skip={header_line}, "
+                  f"encoding='{encoding}')")
+        original = [row[0] for row in cursor.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+        _, mapping_log = preprocessor.normalize_columns(pd.DataFrame(columns=original))
+        columns = list(mapping_log.values())
+        if len(set(columns)) != len(columns):
+            raise ValueError(f"Duplicate columns after mapping: {columns}")
+
+        result = {
+            'file_info': f"{uploaded_file.name.split('.')[-1].upper()} (separator: '{separator}', native)",
+            'header_row': header_line - 1,
+            'mapping_log': mapping_log,
+            'columns': columns,
+            'rows': 0
+        }
+        result['valid'], result['message'] = _validate(preprocessor, pd.DataFrame(columns=columns), data_type)
+        if not result['valid']:
+            return result
+
+        renamed = ", ".join(f'"{old}" AS "{new}"' for old, new in zip(original, columns))
+        cursor.execute(f"CREATE OR REPLACE TEMP TABLE {raw} AS SELECT {renamed} FROM {source}")
+        result['rows'] = _preprocess_into(cursor, raw, target, data_type, columns, preprocessor)
+        return result
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {raw}")
+        os.remove(tmp.name)
+
+def _preprocess_into(cursor, raw: str, target: str, data_type: str, columns: List[str],
+                     preprocessor: DataPreprocessor) -> int:
+    # Second pass over the loaded rows: medians/means need the whole column
+    if data_type == 'patients':
+        query = preprocessor.preprocess_patients_sql(cursor, raw, columns)
+    else:
+        query = preprocessor.preprocess_activity_sql(cursor, raw, columns)
+    cursor.execute(f"CREATE OR REPLACE TABLE {target} AS {query}")
+    return cursor.execute(f"SELECT COUNT(*) FROM {target}").fetchone()[0]
+
+def _widen_columns(cursor, table: str, chunk: pd.DataFrame):
+    """
+    Type inference runs per chunk, so a later chunk can bring floats (NaN) or
+    text into a column the first chunk created as an integer. Widens the
+    table's column type before appending.
+    """
+    table_types = dict(cursor.execute(f"SELECT column_name, data_type FROM duckdb_columns() "
+                                      f"WHERE table_name = '{table}'").fetchall())
+    for col, chunk_type, *_ in cursor.execute("DESCRIBE SELECT * FROM chunk").fetchall():
+        current = table_types.get(col)
+        if current is None or current == chunk_type or chunk_type == 'INTEGER' and current == 'BIGINT':
+            continue
+        if 'VARCHAR' in (current, chunk_type):
+            wider = 'VARCHAR'
+        elif {'DOUBLE', 'FLOAT'} & {current, chunk_type}:
+            wider = 'DOUBLE'
+        else:
+            wider = 'BIGINT'
+        if wider != current:
+            cursor.execute(f'ALTER TABLE {table} ALTER COLUMN "{col}" SET DATA TYPE {wider}')
+
+def load_text_file_chunked(cursor, uploaded_file, target: str, data_type: str,
+                           preprocessor: DataPreprocessor, chunk_rows: int = INGEST_CHUNK_ROWS) -> Dict[str, Any]:
+    """
+    Out-of-core pandas path for CSV/TXT the native reader rejects: the file is
+    parsed INGEST_CHUNK_ROWS rows at a time, each chunk normalized and
+    appended to a DuckDB table, then imputation runs as a second SQL pass.
+    Only one chunk is held in pandas at a time.
+    """
+    uploaded_file.seek(0)
+    separator, encoding, lines = DataFileReader.sniff_text(uploaded_file.read(SNIFF_BYTES))
+    header_line = preprocessor.find_header_line(lines)
+
+    raw = f"_raw{target}"
+    result = None
+    try:
+        for chunk in DataFileReader.read_text_chunks(uploaded_file, separator, encoding, header_line, chunk_rows):
+            if result is None:
+                chunk, mapping_log = preprocessor.normalize_columns(chunk)
+                columns = list(chunk.columns)
+                if len(set(columns)) != len(columns):
+                    raise ValueError(f"Duplicate columns after mapping: {columns}")
+                result = {
+                    'file_info': f"{uploaded_file.name.split('.')[-1].upper()} (separator: '{separator}', chunked)",
+                    'header_row': header_line - 1,
+                    'mapping_log': mapping_log,
+                    'columns': columns,
+                    'rows': 0
+                }
+                result['valid'], result['message'] = _validate(preprocessor, chunk, data_type)
+                if not result['valid']:
+                    return result
+                cursor.execute(f"CREATE OR REPLACE TEMP TABLE {raw} AS SELECT * FROM chunk")
+                continue
+
+            chunk.columns = columns
+            _widen_columns(cursor, raw, chunk)
+            cursor.execute(f"INSERT INTO {raw} BY NAME SELECT * FROM chunk")
+
+        if result is None:
+            raise ValueError("File is empty")
+        result['rows'] = _preprocess_into(cursor, raw, target, data_type, columns, preprocessor)
+        return result
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {raw}")
+
+def load_arrow_file(cursor, uploaded_file, target: str, data_type: str,
+                    preprocessor: DataPreprocessor) -> Dict[str, Any]:
+    """
+    Parquet/Feather/Arrow IPC path: the schema is mapped and validated from
+    the file footer, only the base-table columns are decoded, and DuckDB
+    scans the resulting Arrow table directly (no pandas conversion).
+    """
+    original = DataFileReader.read_arrow_schema(uploaded_file)
+    _, mapping_log = preprocessor.normalize_columns(pd.DataFrame(columns=original))
+    mapped = list(mapping_log.values())
+
+    result = {
+        'file_info': "",
+        'header_row': -1,
+        'mapping_log': mapping_log,
+        'columns': mapped,
+        'rows': 0
+    }
+    result['valid'], result['message'] = _validate(preprocessor, pd.DataFrame(columns=mapped), data_type)
+    if not result['valid']:
+        return result
+
+    # Column projection: first source column for each schema column
+    schema = preprocessor.PATIENTS_SCHEMA_COLS if data_type == 'patients' else preprocessor.ACTIVITY_SCHEMA_COLS
+    keep = {}
+    for col in original:
+        if mapping_log[str(col)] in schema and mapping_log[str(col)] not in keep.values():
+            keep[col] = mapping_log[str(col)]
+    columns = list(keep.values())
+    arrow_table = DataFileReader.read_arrow_table(uploaded_file, columns=list(keep)).rename_columns(columns)
+    result['columns'] = columns
+    result['file_info'] = (f"{ARROW_FORMAT_NAMES[uploaded_file.name.split('.')[-1].lower()]} "
+                           f"({len(columns)} of {len(original)} columns read)")
+
+    raw = f"_raw{target}"
+    try:
+        cursor.execute(f"CREATE OR REPLACE TEMP TABLE {raw} AS SELECT * FROM arrow_table")
+        result['rows'] = _preprocess_into(cursor, raw, target, data_type, columns, preprocessor)
+        return result
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {raw}")
+
+def load_dataframe_file(cursor, uploaded_file, target: str, data_type: str,
+                        preprocessor: DataPreprocessor) -> Dict[str, Any]:
+    """
+    pandas path for every format: read, smart header detection, normalize,
+    validate, preprocess, then copy into `target`.
+    """
+    uploaded_file.seek(0)
+    result = DataFileReader.read_file(uploaded_file)
+    sheet_msg = ""
+    if len(result) == 3:
+        df, file_info, sheet_names = result
+        if len(sheet_names) > 1:
+            sheet_msg = f" (Used sheet: '{sheet_names[0]}')"
+    else:
+        df, file_info = result
+
+    # 1. Smart Header Detection
+    row_idx, df_promoted = preprocessor.find_best_header_row(df)
+    if row_idx != -1:
+        df = df_promoted
+
+    # 2. Normalize columns
+    df, mapping_log = preprocessor.normalize_columns(df)
+
+    result = {
+        'file_info': file_info,
+        'sheet_msg': sheet_msg,
+        'header_row': row_idx,
+        'mapping_log': mapping_log,
+        'columns': list(df.columns),
+        'rows': 0
+    }
+    result['valid'], result['message'] = _validate(preprocessor, df, data_type)
+    if not result['valid']:
+        return result
+
+    if data_type == 'patients':
+        df_clean = preprocessor.preprocess_patients_data(df)
+    else:
+        df_clean = preprocessor.preprocess_activity_data(df)
+    cursor.execute(f"CREATE OR REPLACE TABLE {target} AS SELECT * FROM df_clean")
+    result['rows'] = len(df_clean)
+    return result
+
+def _run_pipeline(cursor, uploaded_file, staging: str, data_type: str,
+                  preprocessor: DataPreprocessor) -> Dict[str, Any]:
+    # Text files: DuckDB's reader, then chunked pandas; columnar files via
+    # Arrow; everything else (and anything those reject) whole through pandas
+    file_ext = uploaded_file.name.split('.')[-1].lower()
+    loaders = []
+    if file_ext in NATIVE_FORMATS:
+        loaders = [load_text_file, load_text_file_chunked]
+    elif file_ext in ARROW_FORMATS:
+        loaders = [load_arrow_file]
+    for loader in loaders:
+        try:
+            return loader(cursor, uploaded_file, staging, data_type, preprocessor)
+        except Exception as e:
+            print(f"{loader.__name__} failed for {uploaded_file.name}: {e}")
+    return load_dataframe_file(cursor, uploaded_file, staging, data_type, preprocessor)
+
+def _prepare(conn, uploaded_file, table_name: str, data_type: str, sha256: str,
+             preprocessor: DataPreprocessor) -> Dict[str, Any]:
+    """
+    Runs one file through the pipeline into its staging table, or copies the
+    cached result for the same bytes. Never raises: failures are reported in
+    the result so one bad file can't sink the batch.
+    """
+    start = time.perf_counter()
+    staging = f"{STAGING_PREFIX}{table_name}"
+    cache = get_ingest_cache()
+    key = (sha256, data_type)
+    cursor = conn.cursor()
+    result = None
+    try:
+        with cache.key_lock(key):
+            result = cache.get(key)
+            if result is not None:
+                if result['path']:
+                    cursor.execute(f"CREATE OR REPLACE TABLE {staging} AS SELECT * FROM read_parquet('{result['path']}')")
+                result['cached'] = True
+            else:
+                result = _run_pipeline(cursor, uploaded_file, staging, data_type, preprocessor)
+                if result['valid']:
+                    result['bytes_before'] = estimate_table_bytes(cursor, staging)
+                    result['compacted'] = preprocessor.compact_table(cursor, staging)
+                    result['bytes_after'] = estimate_table_bytes(cursor, staging)
+                    result['stats'] = compute_table_stats(cursor, staging)
+                cache.put(key, cursor, staging if result['valid'] else None, result)
+                result['cached'] = False
+        result['error'] = None
+    except Exception as e:
+        result = {'valid': False, 'message': str(e), 'error': str(e), 'mapping_log': {}, 'columns': [], 'rows': 0}
+    finally:
+        if not (result and result['valid']):
+            cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.close()
+
+    result.setdefault('sheet_msg', "")
+    result.setdefault('header_row', -1)
+    result.setdefault('cached', False)
+    result.pop('path', None)
+    result.update({
+        'file_name': uploaded_file.name,
+        'table_name': table_name,
+        'data_type': data_type,
+        'sha256': sha256,
+        'duplicate_of': None,
+        'staging': staging if result['valid'] else None,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 1)
+    })
+    return result
+
+# --- Pipeline ---
+
+def ingest_files(session_db, uploads: List[Tuple[Any, str]], preprocessor: Optional[DataPreprocessor] = None,
+                 workers: int = INGEST_WORKERS,
+                 on_result: Optional[Callable[[Dict[str, Any], int, int], None]] = None) -> List[Dict[str, Any]]:
+    """
+    Ingests [(uploaded_file, data_type), ...] concurrently into session_db.
+    Files are identified by content hash: a file already loaded under its own
+    name is skipped silently (Streamlit reruns), the same bytes under another
+    name are reported as a duplicate, and a different file whose name is
+    taken gets a suffixed table name. on_result(result, done, total) is called
+    on the calling thread as each file finishes, for progress UI.
+    Returns the per-file results in upload order.
+    """
+    preprocessor = preprocessor or DataPreprocessor()
+    if not uploads:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(uploads))), thread_name_prefix="ingest") as pool:
+        hashes = list(pool.map(file_sha256, [f for f, _ in uploads]))
+
+    loaded = {(meta.get('sha256'), meta['type']): (name, meta.get('source'))
+              for name, meta in session_db.get_uploaded_sources().items()}
+    taken = set(session_db.get_uploaded_sources())
+    pending = []
+    skipped = []
+    for (uploaded_file, data_type), sha256 in zip(uploads, hashes):
+        key = (sha256, data_type)
+        if key in loaded:
+            table_name, source = loaded[key]
+            if source != uploaded_file.name:
+                skipped.append({
+                    'file_name': uploaded_file.name, 'table_name': table_name, 'data_type': data_type,
+                    'sha256': sha256, 'duplicate_of': table_name, 'valid': False, 'error': None,
+                    'message': f"Same content as already loaded '{table_name}'"
+                })
+            continue
+        table_name = unique_table_name(upload_table_name(uploaded_file), taken)
+        taken.add(table_name)
+        loaded[key] = (table_name, uploaded_file.name)
+        pending.append((uploaded_file, table_name, data_type, sha256))
+
+    results: Dict[int, Dict[str, Any]] = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending))), thread_name_prefix="ingest") as pool:
+            futures = {pool.submit(_prepare, session_db.conn, f, name, data_type, sha256, preprocessor): i
+                       for i, (f, name, data_type, sha256) in enumerate(pending)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if on_result:
+                    on_result(results[futures[future]], len(results), len(pending))
+
+    ordered = [results[i] for i in range(len(pending))]
+    session_db.commit_staged([r for r in ordered if r['valid']])
+    return ordered + skipped
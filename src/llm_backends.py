@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Record/replay LLM backends for offline benchmarks and regression runs.
+# Both wrap the chat-model interface used by src.agents: invoke(messages)
+# and stream(messages), where messages are langchain chat messages.
+#
+#   from src.agents import set_llm_backend, get_groq_llm
+#   set_llm_backend(RecordingLLM(get_groq_llm(), "fixtures/llm"))   # capture
+#   set_llm_backend(ReplayLLM("fixtures/llm", latency_s=0.5))         # replay
+
+DEFAULT_FIXTURE_DIR = os.path.join('fixtures', 'llm')
+
+def fixture_key(messages: List[Any], model: Optional[str] = None) -> str:
+    """
+    Stable key for a prompt: hash of the role/content of every message, and
+    of the model when given, so an escalated call doesn't overwrite the
+    small model's fixture for the same prompt.
+    """
+    payload = [(getattr(m, "type", "human"), getattr(m, "content", str(m))) for m in messages]
+    if model:
+        payload = {"model": model, "messages": payload}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()[:24]
+
+class RecordingLLM:
+    """
+    Passes calls through to a real chat model and writes every response to
+    `<fixture_dir>/<key>.json` together with its usage and latency.
+    With `model_factory` (e.g. agents.get_groq_llm), calls routed to another
+    model are recorded from that model.
+    """
+
+    def __init__(self, inner: Any, fixture_dir: str = DEFAULT_FIXTURE_DIR,
+                 model_factory: Optional[Callable[[str], Any]] = None, model: Optional[str] = None):
+        self.inner = inner
+        self.fixture_dir = fixture_dir
+        self.model_factory = model_factory
+        self.model = model
+        self.lock = threading.Lock()
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    def for_model(self, model: str) -> "RecordingLLM":
+        if self.model_factory is None or model == self.model:
+            return self
+        return RecordingLLM(self.model_factory(model), self.fixture_dir, self.model_factory, model)
+
+    def _save(self, messages: List[Any], message: Any, latency_s: float):
+        fixture = {
+            "messages": [{"type": getattr(m, "type", "human"), "content": getattr(m, "content", str(m))} for m in messages],
+            "model": self.model,
+            "content": message.content,
+            "usage_metadata": dict(getattr(message, "usage_metadata", None) or {}),
+            "latency_s": round(latency_s, 4)
+        }
+        path = os.path.join(self.fixture_dir, f"{fixture_key(messages, self.model)}.json")
+        with self.lock:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(fixture, f, ensure_ascii=False, indent=2)
+
+    def invoke(self, messages: List[Any]) -> Any:
+        start = time.perf_counter()
+        message = self.inner.invoke(messages)
+        self._save(messages, message, time.perf_counter() - start)
+        return message
+
+    def stream(self, messages: List[Any]) -> Iterator[Any]:
+        start = time.perf_counter()
+        merged = None
+        for chunk in self.inner.stream(messages):
+            merged = chunk if merged is None else merged + chunk
+            yield chunk
+        if merged is not None:
+            self._save(messages, merged, time.perf_counter() - start)
+
+class ReplayLLM:
+    """
+    Serves recorded responses without any network access.
+    Latency is synthetic: `latency_s` per call if given, otherwise the recorded
+    latency multiplied by `latency_scale` (0 disables sleeping).
+    for_model() serves the fixtures recorded for that model; fixtures recorded
+    without a model name are used as a fallback.
+    """
+
+    def __init__(self, fixture_dir: str = DEFAULT_FIXTURE_DIR, latency_s: Optional[float] = None,
+                 latency_scale: float = 1.0, model: Optional[str] = None, parent: "ReplayLLM" = None):
+        self.fixture_dir = fixture_dir
+        self.latency_s = latency_s
+        self.latency_scale = latency_scale
+        self.model = model
+        # Per-model views count their calls on the backend they came from
+        self.parent = parent
+        self.calls = 0
+        self.wait_s = 0.0
+        self.lock = threading.Lock()
+
+    def for_model(self, model: str) -> "ReplayLLM":
+        if model == self.model:
+            return self
+        return ReplayLLM(self.fixture_dir, self.latency_s, self.latency_scale, model, self.parent or self)
+
+    def _load(self, messages: List[Any]) -> Dict[str, Any]:
+        key = fixture_key(messages, self.model)
+        path = os.path.join(self.fixture_dir, f"{key}.json")
+        if not os.path.exists(path) and self.model:
+            path = os.path.join(self.fixture_dir, f"{fixture_key(messages)}.json")
+        if not os.path.exists(path):
+            raise KeyError(f"No recorded LLM response for prompt {key} in {self.fixture_dir}; re-record the fixtures")
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _latency(self, fixture: Dict[str, Any]) -> float:
+        if self.latency_s is not None:
+            return self.latency_s
+        return fixture.get("latency_s", 0.0) * self.latency_scale
+
+    def _account(self, waited: float):
+        root = self.parent or self
+        with root.lock:
+            root.calls += 1
+            root.wait_s += waited
+
+    def invoke(self, messages: List[Any]) -> Any:
+        from langchain_core.messages import AIMessage
+        fixture = self._load(messages)
+        latency = self._latency(fixture)
+        if latency > 0:
+            time.sleep(latency)
+        self._account(latency)
+        return AIMessage(content=fixture["content"], usage_metadata=fixture.get("usage_metadata") or None)
+
+    def stream(self, messages: List[Any]) -> Iterator[Any]:
+        from langchain_core.messages import AIMessageChunk
+        fixture = self._load(messages)
+        latency = self._latency(fixture)
+        # Split the response into word-sized chunks spread over the latency
+        tokens = fixture["content"].split(' ')
+        pieces = [t + ' ' for t in tokens[:-1]] + tokens[-1:]
+        delay = latency / max(1, len(pieces))
+        for i, piece in enumerate(pieces):
+            if delay > 0:
+                time.sleep(delay)
+            last = i == len(pieces) - 1
+            yield AIMessageChunk(content=piece,
+                                 usage_metadata=(fixture.get("usage_metadata") or None) if last else None)
+        self._account(latency)
@@ -0,0 +1,153 @@
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import pandas as pd
+from src.sql_validator import SCHEMA_DDL
+
+# Shares work between the steps of one decomposed plan:
+# - identical step SQL runs once and its result is reused
+# - a filtered cohort ("FROM patients WHERE chronic_kidney_disease = 1") used by
+#   several steps is materialized once as a temp table in the federated engine
+
+TABLE_COLUMNS = {
+    table: set(re.findall(r'^\s*(\w+)\s+\w+', body, re.M))
+    for table, body in re.findall(r'CREATE TABLE (\w+) \((.*?)\);', SCHEMA_DDL, re.S)
+}
+
+# Words allowed in a shareable predicate besides the table's own columns
+PREDICATE_KEYWORDS = {'and', 'or', 'not', 'in', 'is', 'null', 'between', 'like', 'ilike', 'true', 'false'}
+
+# Clauses that end a WHERE predicate at the top level of its query
+CLAUSE_END = re.compile(r' (GROUP BY|ORDER BY|HAVING|LIMIT|OFFSET|UNION|EXCEPT|INTERSECT|WINDOW|QUALIFY)\b', re.I)
+
+COHORT_START = re.compile(r'\bFROM (' + '|'.join(TABLE_COLUMNS) + r') WHERE ', re.I)
+
+def normalize_sql(sql: str) -> str:
+    return " ".join(sql.split()).rstrip(';').strip()
+
+def _predicate_end(sql: str, start: int) -> int:
+    """
+    Index where the WHERE predicate starting at `start` ends: the closing
+    parenthesis of an enclosing subquery, a top-level clause, or end of text.
+    """
+    depth, i, in_string = 0, start, False
+    while i < len(sql):
+        ch = sql[i]
+        if in_string:
+            in_string = ch != "'"
+        elif ch == "'":
+            in_string = True
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            if depth == 0:
+                return i
+            depth -= 1
+        elif depth == 0 and ch == ' ' and CLAUSE_END.match(sql, i):
+            return i
+        i += 1
+    return i
+
+def _is_self_contained(table: str, predicate: str) -> bool:
+    """
+    True if the predicate only references the table's own columns, so it can
+    be evaluated outside the query (no correlation, functions or subqueries).
+    """
+    words = re.findall(r'[A-Za-z_]\w*', re.sub(r"'[^']*'", "''", predicate))
+    allowed = TABLE_COLUMNS[table] | PREDICATE_KEYWORDS | {table}
+    return bool(words) and all(w.lower() in allowed for w in words)
+
+def find_cohorts(sql: str) -> List[Tuple[int, int, str, str]]:
+    """
+    Returns (start, end, table, predicate) for every shareable
+    "FROM <table> WHERE <predicate>" in normalized SQL.
+    """
+    cohorts = []
+    for match in COHORT_START.finditer(sql):
+        end = _predicate_end(sql, match.end())
+        table, predicate = match.group(1).lower(), sql[match.end():end].strip()
+        if _is_self_contained(table, predicate):
+            cohorts.append((match.start(), end, table, predicate))
+    return cohorts
+
+def cohort_key(table: str, predicate: str) -> Tuple[str, str]:
+    return table, predicate if "'" in predicate else predicate.lower()
+
+class SharedExecution:
+    """
+    Request-scoped wrapper around a query executor for the steps of one plan.
+    Uses the executor's federated engine when it has one (open_engine), so base
+    tables are fetched once per request instead of once per step.
+    """
+
+    def __init__(self, executor: Any, include_uploaded: bool = True):
+        self.executor = executor
+        self.include_uploaded = include_uploaded
+        open_engine = getattr(executor, "open_engine", None)
+        self.engine = open_engine(include_uploaded) if open_engine else None
+        self.results: Dict[str, pd.DataFrame] = {}
+        self.planned = set()
+        self.cohort_uses = Counter()
+        self.cohort_tables: Dict[Tuple[str, str], str] = {}
+        self.stats = {"queries": 0, "deduplicated": 0, "cohorts_materialized": 0, "cohort_reuses": 0}
+
+    def prepare(self, sqls: Iterable[str]):
+        """
+        Registers SQL known before execution so shared cohorts are
+        materialized on first use. Without it a cohort is materialized the
+        second time it is seen.
+        """
+        for sql in sqls:
+            sql = normalize_sql(sql)
+            if sql in self.planned:
+                continue
+            self.planned.add(sql)
+            self.cohort_uses.update({cohort_key(t, p) for _, _, t, p in find_cohorts(sql)})
+
+    def _share_cohorts(self, sql: str, span: Optional[Dict[str, Any]] = None) -> str:
+        cohorts = find_cohorts(sql)
+        if sql not in self.planned:
+            self.cohort_uses.update({cohort_key(t, p) for _, _, t, p in cohorts})
+
+        # Rewrite from the end so earlier offsets stay valid
+        for start, end, table, predicate in reversed(cohorts):
+            key = cohort_key(table, predicate)
+            if self.cohort_uses[key] < 2:
+                continue
+            name = self.cohort_tables.get(key)
+            if name is None:
+                name = f"_cohort_{len(self.cohort_tables) + 1}"
+                self.engine.materialize(name, f"SELECT * FROM {table} WHERE {predicate}")
+                self.cohort_tables[key] = name
+                self.stats["cohorts_materialized"] += 1
+            else:
+                self.stats["cohort_reuses"] += 1
+            if span is not None:
+                span.setdefault("cohorts", []).append(name)
+            sql = f"{sql[:start]}FROM {name} AS {table}{sql[end:]}"
+        return sql
+
+    def execute(self, sql: str, span: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        key = normalize_sql(sql)
+        if key in self.results:
+            self.stats["deduplicated"] += 1
+            if span is not None:
+                span["cache_hit"] = True
+            return self.results[key]
+
+        self.stats["queries"] += 1
+        if self.engine is None:
+            df = self.executor.execute_combined_query(sql, include_uploaded=self.include_uploaded)
+        else:
+            try:
+                df = self.engine.execute(self._share_cohorts(key, span))
+            except Exception as e:
+                print(f"Shared execution failed, running step on its own: {e}")
+                df = self.executor.execute_combined_query(sql, include_uploaded=self.include_uploaded)
+        self.results[key] = df
+        return df
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
@@ -1,107 +1,180 @@
 import pandas as pd
 from src.db_manager import DatabaseManager
 from src.session_db import SessionDatabaseManager
-import duckdb
+
+from src.base_store import BASE_TABLES, get_base_store
+from src.zone_maps import parse_simple_query, parse_predicates, can_match, answer_from_stats
+
+# Base tables the federated engine can assemble from Supabase + session uploads
+FEDERATED_TABLES = BASE_TABLES
+
+class FederatedEngine:
+    """
+    Cursor on the session's DuckDB with the shared base-data snapshot attached
+    read-only. Each base table is exposed as a temp view, the snapshot table
+    UNION ALL BY NAME the session's uploads of that type, created the first
+    time a query needs it. Nothing is copied per request.
+
+    Simple single-table queries consult the sources' zone maps first:
+    whole-table COUNT/MIN/MAX is answered from them, and sources whose
+    ranges can't match the WHERE clause are left out of the union.
+    """
+
+    def __init__(self, executor: "MultiSourceQueryExecutor"):
+        self.executor = executor
+        self.conn = executor.session_db.conn.cursor()
+        self.base_alias, self.base_tables, self.base_stats = get_base_store().attach(self.conn)
+        self.loaded = set()
+        self.pruning = {'answered_from_stats': 0, 'sources_skipped': 0}
+
+    def _ensure_tables(self, sql_query: str):
+        # Simple keyword check, as before
+        for table in FEDERATED_TABLES:
+            if table in self.loaded or table not in sql_query.lower():
+                continue
+            source = self.executor.source_query(table, self.base_alias if table in self.base_tables else None,
+                                                conn=self.conn)
+            if source:
+                self.conn.execute(f"CREATE OR REPLACE TEMP VIEW {table} AS {source}")
+            self.loaded.add(table)
+
+    def _sources(self, table: str) -> list:
+        base_alias = self.base_alias if table in self.base_tables else None
+        return self.executor.federated_sources(table, base_alias, self.base_stats.get(table), conn=self.conn)
+
+    def _answer_from_stats(self, sql_query: str, query: dict, sources: list):
+        values = answer_from_stats(query, [stats for _, _, stats in sources])
+        if values is None:
+            return None
+        # Column names and types exactly as the query would return them; DESCRIBE only binds
+        described = self.conn.execute(f"DESCRIBE {sql_query}").fetchall()
+        if len(described) != len(values):
+            return None
+        select = ", ".join(f'CAST(? AS {col_type}) AS "{name}"' for name, col_type, *_ in described)
+        self.pruning['answered_from_stats'] += 1
+        return self.conn.execute(f"SELECT {select}", values).df()
+
+    def _prune(self, sql_query: str, query: dict, sources: list) -> str:
+        predicates = parse_predicates(query)
+        if not predicates:
+            return sql_query
+        kept = [source for source in sources if can_match(source[2], predicates)]
+        if len(kept) == len(sources):
+            return sql_query
+        self.pruning['sources_skipped'] += len(sources) - len(kept)
+        # The empty full union first keeps the view's column set and order
+        full = self.executor.source_query(query['table'], sources=sources, conn=self.conn)
+        pruned = [f"(SELECT * FROM ({full}) LIMIT 0)"]
+        if kept:
+            pruned.append(self.executor.source_query(query['table'], sources=kept, conn=self.conn))
+        return f"WITH {query['table']} AS ({' UNION ALL BY NAME '.join(pruned)}) {sql_query}"
+
+    def _plan(self, sql_query: str, answer: bool = True):
+        """
+        Returns (answer, sql): a DataFrame when the zone maps answer the query
+        outright, otherwise the SQL to run, with unmatched sources pruned.
+        """
+        self._ensure_tables(sql_query)
+        query = parse_simple_query(sql_query)
+        if query is None or query['table'] not in self.loaded:
+            return None, sql_query
+        sources = self._sources(query['table'])
+        if not sources or any(stats is None for _, _, stats in sources):
+            return None, sql_query
+        result = self._answer_from_stats(sql_query, query, sources) if answer else None
+        if result is not None:
+            return result, sql_query
+        return None, self._prune(sql_query, query, sources)
+
+    def execute(self, sql_query: str) -> pd.DataFrame:
+        result, sql_query = self._plan(sql_query)
+        if result is not None:
+            return result
+        # DuckDB handles all joins, aggregations, and window functions correctly
+        return self.conn.execute(sql_query).df()
+
+    def materialize(self, table_name: str, sql_query: str):
+        _, sql_query = self._plan(sql_query, answer=False)
+        self.conn.execute(f"CREATE TEMP TABLE {table_name} AS {sql_query}")
+
+    def close(self):
+        # Temp views and tables live on this cursor only
+        self.conn.close()
 
 class MultiSourceQueryExecutor:
-    
+
     def __init__(self):
         self.supabase_db = DatabaseManager()
         self.session_db = SessionDatabaseManager()
-    
+
+    # Catalog lookups below run on the caller's cursor (FederatedEngine.conn),
+    # or a short-lived one: engines live on job worker threads, and the
+    # session connection itself is not safe to share across threads.
+
+    def federated_sources(self, table: str, base_alias: str = None, base_stats: dict = None, conn=None) -> list:
+        """
+        (database, table, zone maps) for a base table: the shared snapshot (if
+        it has the table) plus every session table of the same type.
+        """
+        if conn is None:
+            with self.session_db.conn.cursor() as cursor:
+                return self.federated_sources(table, base_alias, base_stats, cursor)
+        database = conn.execute("SELECT current_database()").fetchone()[0]
+        sources = [(base_alias, table, base_stats)] if base_alias else []
+        uploaded = dict(self.session_db.get_uploaded_sources())
+        used = [name for name, meta in uploaded.items() if meta.get('type') == table]
+        self.session_db.touch(used)
+        sources += [(database, table_name, uploaded[table_name].get('stats')) for table_name in used]
+        return sources
+
+    def source_query(self, table: str, base_alias: str = None, sources: list = None, conn=None) -> str:
+        """
+        SQL for a base table over `sources` (default: all of them). Fully
+        qualified, since the temp view that wraps it has the same name as the
+        base table.
+        """
+        if conn is None:
+            with self.session_db.conn.cursor() as cursor:
+                return self.source_query(table, base_alias, sources, cursor)
+        if sources is None:
+            sources = self.federated_sources(table, base_alias, conn=conn)
+        return " UNION ALL BY NAME ".join(self._widened_select(conn, db, name) for db, name, _ in sources)
+
+    def _widened_select(self, conn, database: str, table_name: str) -> str:
+        # Tables are stored with compact types (DataPreprocessor.compact_table);
+        # queries get BIGINT/DOUBLE back so generated arithmetic can't overflow
+        narrow = conn.execute(
+            "SELECT column_name, data_type FROM duckdb_columns() "
+            "WHERE database_name = ? AND schema_name = 'main' AND table_name = ? "
+            "AND data_type IN ('TINYINT', 'SMALLINT', 'INTEGER', 'FLOAT')", [database, table_name]).fetchall()
+        replace = ", ".join(f'CAST("{col}" AS {"DOUBLE" if data_type == "FLOAT" else "BIGINT"}) AS "{col}"'
+                            for col, data_type in narrow)
+        return f'SELECT * {f"REPLACE ({replace}) " if replace else ""}FROM "{database}".main."{table_name}"'
+
+    def open_engine(self, include_uploaded: bool = True):
+        """
+        Returns a FederatedEngine for a batch of queries, or None when queries
+        go straight to Supabase. The caller closes it.
+        """
+        if not include_uploaded or not self.session_db.get_uploaded_sources():
+            return None
+        return FederatedEngine(self)
+
     def execute_combined_query(self, sql_query: str, include_uploaded: bool = True):
         # 1. If only Supabase is needed or no uploaded sources, run direct
-        if not include_uploaded or not self.session_db.get_uploaded_sources():
+        engine = self.open_engine(include_uploaded)
+        if engine is None:
             return self.supabase_db.execute_sql(sql_query)
-        
+
         # 2. Federated Execution: Fetch Raw -> Register -> Query
         try:
-            # A. Identify needed tables (simple keyword check)
-            need_patients = 'patients' in sql_query.lower()
-            need_activity = 'activity' in sql_query.lower()
-            
-            patients_df = pd.DataFrame()
-            activity_df = pd.DataFrame()
-            
-            # B. Fetch Patients Data
-            patients_dfs = []
-            if need_patients:
-                # 1. Fetch from Supabase
-                try:
-                    df_sup = self.supabase_db.execute_sql("SELECT * FROM patients LIMIT 20000")
-                    if not df_sup.empty:
-                        patients_dfs.append(df_sup)
-                except Exception as e:
-                    print(f"Supabase patients fetch error: {e}")
-                
-                # 2. Fetch from Session (All tables marked as 'patients')
-                uploaded = self.session_db.get_uploaded_sources()
-                for table_name, meta in uploaded.items():
-                    if meta.get('type') == 'patients':
-                        try:
-                            # Standardize columns if needed, but for now assuming preprocessor did its job
-                            df_sess = self.session_db.execute_query(f"SELECT * FROM {table_name}")
-                            if not df_sess.empty:
-                                patients_dfs.append(df_sess)
-                        except Exception as e:
-                            print(f"Session table {table_name} fetch error: {e}")
-
-                # Combine all
-                if patients_dfs:
-                    patients_df = pd.concat(patients_dfs, ignore_index=True)
-                else:
-                    patients_df = pd.DataFrame()
-            
-            # C. Fetch Activity Data
-            activity_dfs = []
-            if need_activity:
-                # 1. Fetch from Supabase
-                try:
-                    df_sup = self.supabase_db.execute_sql("SELECT * FROM activity LIMIT 20000")
-                    if not df_sup.empty:
-                        activity_dfs.append(df_sup)
-                except Exception as e:
-                    print(f"Supabase activity fetch error: {e}")
-
-                # 2. Fetch from Session
-                uploaded = self.session_db.get_uploaded_sources()
-                for table_name, meta in uploaded.items():
-                    if meta.get('type') == 'activity':
-                        try:
-                            df_sess = self.session_db.execute_query(f"SELECT * FROM {table_name}")
-                            if not df_sess.empty:
-                                activity_dfs.append(df_sess)
-                        except Exception as e:
-                            print(f"Session table {table_name} fetch error: {e}")
-                
-                if activity_dfs:
-                    activity_df = pd.concat(activity_dfs, ignore_index=True)
-                else:
-                    activity_df = pd.DataFrame()
-            
-            # D. Register in DuckDB
-            con = duckdb.connect(database=':memory:')
-            
-            if not patients_df.empty:
-                con.register('patients', patients_df)
-            
-            if not activity_df.empty:
-                con.register('activity', activity_df)
-                
-            # E. Execute the original Analytical Query against the combined view
-            # DuckDB handles all joins, aggregations, and window functions correctly
-            result_df = con.execute(sql_query).df()
-            
-            return result_df
-            
+            return engine.execute(sql_query)
         except Exception as e:
             print(f"Federated Query Execution Error: {e}")
             # Fallback to Supabase only if federation fails
             return self.supabase_db.execute_sql(sql_query)
-        
-    
-    def has_uploaded_sources(self) -> bool:
-        return len(self.session_db.get_uploaded_sources()) > 0
-    
+        finally:
+            engine.close()
+
     def has_uploaded_sources(self) -> bool:
         return len(self.session_db.get_uploaded_sources()) > 0
@@ -0,0 +1,244 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+# --- Vocabulary ---
+# Each entry maps a phrase pattern (regex, matched on the lower-cased question)
+# to a column or filter over the `patients`/`activity` schema.
+
+METRICS = {
+    'bmi': (r'\bbmi\b|body mass index', 'patients'),
+    'age': (r'\bages?\b', 'patients'),
+    'level_of_stress': (r'\bstress\b', 'patients'),
+    'level_of_hemoglobin': (r'hemoglobin|haemoglobin', 'patients'),
+    'alcohol_consumption_per_day': (r'alcohol(?: consumption)?(?: per day)?', 'patients'),
+    'salt_content_in_the_diet': (r'\bsalt\b', 'patients'),
+    'genetic_pedigree_coefficient': (r'pedigree', 'patients'),
+    'physical_activity': (r'physical activity|\bsteps\b', 'activity'),
+}
+
+COHORTS = {
+    'chronic_kidney_disease = 1': r'chronic kidney disease|kidney disease|\bckd\b',
+    'blood_pressure_abnormality = 1': r'blood pressure abnormalit\w*|abnormal blood pressure|hypertensi\w*',
+    'adrenal_and_thyroid_disorders = 1': r'thyroid|adrenal',
+    'level_of_stress = 3': r'high(?:er)? stress|highly stressed',
+    'smoking = 1': r'\bsmok(?:ers?|ing|e)\b',
+    'sex = 1': r'\bfemales?\b|\bwomen\b',
+    'sex = 0': r'\bmales?\b|\bmen\b',
+    'pregnancy = 1': r'\bpregnan\w*',
+}
+
+DIMENSIONS = {
+    'level_of_stress': r'stress(?: level)?|level of stress',
+    'sex': r'sex|gender',
+    'smoking': r'smoking(?: status| habits?)?',
+    'chronic_kidney_disease': r'chronic kidney disease|kidney disease|ckd',
+    'blood_pressure_abnormality': r'blood pressure(?: abnormality)?',
+    'adrenal_and_thyroid_disorders': r'thyroid(?: disorders?)?|adrenal(?: and thyroid disorders?)?',
+    'age_group': r'age(?: group| band| bracket)?s?',
+    'bmi_category': r'bmi(?: categor(?:y|ies))?',
+}
+
+DIMENSION_EXPRESSIONS = {
+    'age_group': """CASE
+            WHEN age < 30 THEN '< 30'
+            WHEN age < 40 THEN '30-39'
+            WHEN age < 50 THEN '40-49'
+            WHEN age < 60 THEN '50-59'
+            ELSE '60+'
+        END""",
+    'bmi_category': """CASE
+            WHEN bmi < 18.5 THEN 'Underweight'
+            WHEN bmi < 25 THEN 'Normal'
+            WHEN bmi < 30 THEN 'Overweight'
+            ELSE 'Obese'
+        END""",
+}
+
+# Words that carry no filter or metric meaning. Any other word left over after
+# removing the known vocabulary (numbers, "without", unknown diseases...) means
+# the templates cannot express the question faithfully.
+STOPWORDS = {
+    'what', 'whats', 'is', 'are', 'was', 'the', 'of', 'a', 'an', 'patients', 'patient',
+    'people', 'individuals', 'population', 'with', 'who', 'have', 'has', 'having',
+    'both', 'and', 'me', 'show', 'give', 'tell', 'among', 'in', 'for', 'by', 'across',
+    'per', 'do', 'does', 'there', 'our', 'all', 'total', 'overall', 'from',
+    'suffering', 'diagnosed', 'their', 'that', 'which', 'habits', 'habit', 'status',
+    'level', 'levels', 'disorders', 'disorder', 'value', 'values', 'dataset', 'data',
+}
+
+# Questions asking for reasoning, comparisons or trends need the full agent.
+COMPLEX_MARKERS = r'correlat\w*|\btrends?\b|compar\w*|versus|\bvs\.?\b|\bwhy\b|recommend\w*|over time|relationship|impact|predict\w*|\bor\b'
+
+AVERAGE_INTENT = r'\b(?:average|avg|mean)\b'
+PERCENT_INTENT = r'\b(?:percentage|percent|proportion|share|rate|fraction)\b|%'
+COUNT_INTENT = r'\bhow many\b|\bcount\b|\bnumber of\b'
+DISTRIBUTION_INTENT = r'\b(?:distribution|breakdown|break down|split)\b'
+
+# --- Helper Functions ---
+
+def _find_cohorts(text: str) -> List[str]:
+    return [condition for condition, pattern in COHORTS.items() if re.search(pattern, text)]
+
+def _find_metrics(text: str) -> List[str]:
+    return [column for column, (pattern, _) in METRICS.items() if re.search(pattern, text)]
+
+def _where(conditions: List[str]) -> str:
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+def _cohort_label(conditions: List[str]) -> str:
+    return " AND ".join(conditions) if conditions else "all patients"
+
+def _match_dimension(text: str) -> Tuple[Optional[str], str]:
+    """
+    Finds the grouping column of a distribution question ("... by stress
+    level", or "age distribution ..."). A phrase after "of" is a cohort
+    filter ("distribution of ckd patients"), never the grouping.
+    Returns (dimension, text_without_dimension_phrase).
+    """
+    for dimension, pattern in DIMENSIONS.items():
+        match = re.search(rf'\b(?:by|across|per)\s+(?:patients\s+by\s+)?(?:{pattern})\b', text)
+        if not match:
+            match = re.search(rf'\b(?:{pattern})(?=\s+(?:distribution|breakdown|break down|split)\b)', text)
+        if match:
+            return dimension, text[:match.start()] + text[match.end():]
+    return None, text
+
+def _is_fully_covered(text: str, grouped: bool = False) -> bool:
+    residual = text
+    vocabulary = (
+        # Multi-word cohort phrases ("high stress") go before single-word metrics
+        [AVERAGE_INTENT, PERCENT_INTENT, COUNT_INTENT, DISTRIBUTION_INTENT]
+        + list(COHORTS.values())
+        # Grouping phrases only mean something to the distribution template
+        + (list(DIMENSIONS.values()) if grouped else [])
+        + [pattern for pattern, _ in METRICS.values()]
+    )
+    for pattern in vocabulary:
+        residual = re.sub(pattern, ' ', residual)
+    return all(word in STOPWORDS for word in re.findall(r"[a-z0-9]+", residual))
+
+# --- Templates ---
+
+def _average_template(text: str) -> Optional[Dict[str, str]]:
+    metrics = _find_metrics(re.sub(COHORTS['level_of_stress = 3'], '', text))
+    if len(metrics) != 1:
+        return None
+    metric = metrics[0]
+    metric_pattern, table = METRICS[metric]
+    cohorts = _find_cohorts(re.sub(metric_pattern, '', text))
+
+    if table == 'activity':
+        conditions = []
+        if cohorts:
+            conditions.append(f"patient_number IN (SELECT patient_number FROM patients {_where(cohorts)})")
+        sql = (
+            f"SELECT AVG(physical_activity) AS avg_physical_activity, "
+            f"COUNT(DISTINCT patient_number) AS patient_count FROM activity {_where(conditions)}"
+        )
+    else:
+        sql = f"SELECT AVG({metric}) AS avg_{metric}, COUNT(*) AS patient_count FROM patients {_where(cohorts)}"
+
+    return {
+        "template": "cohort_average",
+        "description": f"Average {metric} for {_cohort_label(cohorts)}",
+        "sql": sql.strip()
+    }
+
+# Words that end the population phrase of "percentage of <population> ..."
+POPULATION_END = r'\b(?:patients|people|individuals|are|is|were|was|have|has|had|with|who|that|which)\b'
+
+def _percentage_template(text: str) -> Optional[Dict[str, str]]:
+    # The denominator population is the cohorts after "among"/"in" ("smoking
+    # rate among female patients"), after a leading cohort ("smoking rate of
+    # CKD patients"), or between "of" and the first noun/verb/"with"/"who"
+    # ("percentage of CKD patients smoke", "percentage of smokers with CKD").
+    # The remaining cohorts form the numerator. Ambiguous splits return None.
+    parts = re.split(r'\b(?:among|in)\b', text, maxsplit=1)
+    intent = re.search(PERCENT_INTENT, text)
+    head, rest = text[:intent.start()], text[intent.end():]
+    if len(parts) > 1:
+        cohorts, population = _find_cohorts(parts[0]), _find_cohorts(parts[1])
+    elif _find_cohorts(head):
+        cohorts, population = _find_cohorts(head), _find_cohorts(rest)
+    else:
+        cohorts, population = _find_cohorts(rest), []
+        for end in re.finditer(POPULATION_END, rest):
+            if _find_cohorts(rest[:end.start()]):
+                cohorts, population = _find_cohorts(rest[end.start():]), _find_cohorts(rest[:end.start()])
+                break
+        # "percentage of ckd smokers": no way to tell which is the population
+        if not population and len(cohorts) > 1:
+            return None
+    if not cohorts or set(cohorts) & set(population):
+        return None
+    condition = " AND ".join(cohorts)
+    sql = (
+        f"SELECT COUNT(*) AS total_patients, "
+        f"SUM(CASE WHEN {condition} THEN 1 ELSE 0 END) AS matching_patients, "
+        f"100.0 * SUM(CASE WHEN {condition} THEN 1 ELSE 0 END) / COUNT(*) AS percentage "
+        f"FROM patients {_where(population)}"
+    )
+    return {
+        "template": "cohort_percentage",
+        "description": f"Percentage of {_cohort_label(population)} with {condition}",
+        "sql": sql.strip()
+    }
+
+def _count_template(text: str) -> Optional[Dict[str, str]]:
+    cohorts = _find_cohorts(text)
+    sql = f"SELECT COUNT(*) AS patient_count FROM patients {_where(cohorts)}"
+    return {
+        "template": "cohort_count",
+        "description": f"Number of patients for {_cohort_label(cohorts)}",
+        "sql": sql.strip()
+    }
+
+def _distribution_template(text: str) -> Optional[Dict[str, str]]:
+    dimension, remainder = _match_dimension(text)
+    if not dimension:
+        return None
+    cohorts = _find_cohorts(remainder)
+    if dimension in DIMENSION_EXPRESSIONS:
+        expression = f"{DIMENSION_EXPRESSIONS[dimension]} AS {dimension}"
+    else:
+        expression = dimension
+    sql = f"""SELECT {expression}, COUNT(*) AS patient_count
+        FROM patients
+        {_where(cohorts)}
+        GROUP BY 1
+        ORDER BY 1"""
+    return {
+        "template": "cohort_distribution",
+        "description": f"Distribution of {_cohort_label(cohorts)} by {dimension}",
+        "sql": re.sub(r'\n\s*\n', '\n', sql)
+    }
+
+# Each intent pattern is paired with the template builder that answers it.
+TEMPLATES = [
+    (AVERAGE_INTENT, _average_template),
+    (PERCENT_INTENT, _percentage_template),
+    (DISTRIBUTION_INTENT, _distribution_template),
+    (COUNT_INTENT, _count_template),
+]
+
+def match_template(question: str) -> Optional[Dict[str, str]]:
+    """
+    Matches a question against the library of pre-approved SQL templates.
+    Returns a dict with "template", "description" and "sql", or None when the
+    question needs the full decomposition workflow.
+    """
+    text = " ".join(question.lower().split()).rstrip('?.! ')
+
+    intents = [builder for pattern, builder in TEMPLATES if re.search(pattern, text)]
+    # Several intents ("average BMI and how many smokers") means several steps
+    if len(intents) != 1:
+        return None
+
+    grouped = intents[0] is _distribution_template
+    if re.search(COMPLEX_MARKERS, text) or not _is_fully_covered(text, grouped):
+        return None
+    # "Average BMI by sex" needs a GROUP BY the other templates don't emit
+    if not grouped and _match_dimension(text)[0]:
+        return None
+
+    return intents[0](text)
@@ -0,0 +1,178 @@
+import os
+import re
+import math
+import time
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+# Minimum cosine similarity for a previous question to count as a rephrasing
+QUESTION_CACHE_THRESHOLD = float(os.getenv('QUESTION_CACHE_THRESHOLD', 0.85))
+QUESTION_CACHE_SIZE = int(os.getenv('QUESTION_CACHE_SIZE', 500))
+
+# Phrases mapped to one canonical token before vectorizing, so that common
+# rephrasings of the schema vocabulary land on the same features.
+SYNONYMS = [
+    (r'chronic kidney disease|kidney disease|renal disease|\bckd\b', 'ckd'),
+    (r'body mass index|\bbmi\b', 'bmi'),
+    (r'(?:high )?blood pressure(?: abnormalit\w*)?|abnormal blood pressure|hypertensi\w*|(?:high )?\bbp\b', 'bp'),
+    (r'adrenal and thyroid disorder|thyroid disorder|\bthyroid\b', 'thyroid'),
+    (r'\b(?:mean|avg|average)\b', 'average'),
+    (r'\b(?:minimum|min)\b', 'min'),
+    (r'\b(?:maximum|max)\b', 'max'),
+    (r'\b(?:how many|count|number of)\b', 'count'),
+    (r'\b(?:percentage|percent|proportion|share|fraction|rate)\b', 'percent'),
+    (r'\b(?:distribution|breakdown|break down|split)\b', 'distribution'),
+    (r'\b(?:smokers?|smoking|smoke)\b', 'smoking'),
+    (r'\b(?:stress level|level of stress|stressed|stress)\b', 'stress'),
+    (r'\b(?:gender|sex)\b', 'sex'),
+    (r'\b(?:females?|women|woman)\b', 'female'),
+    (r'\b(?:males?|men|man)\b', 'male'),
+    (r'\b(?:physical activity|step|exercise)\b', 'activity'),
+    (r'\bpregnan\w*', 'pregnancy'),
+    (r'\b(?:hemoglobin|haemoglobin)\b', 'hemoglobin'),
+    (r'\b(?:alcohol|drinking|drinker)\b', 'alcohol'),
+    (r'\b(?:over|above|older than|more than|greater than)\b', 'over'),
+    (r'\b(?:under|below|younger than|less than)\b', 'under'),
+    (r'\b(?:elderly|older|seniors?)\b', 'older'),
+]
+
+STOPWORDS = {
+    'what', 'whats', 'is', 'are', 'was', 'the', 'of', 'a', 'an', 'patients', 'patient', 'people',
+    'individuals', 'population', 'with', 'who', 'have', 'has', 'having', 'for', 'among', 'in',
+    'me', 'show', 'give', 'tell', 'do', 'does', 'there', 'our', 'all', 'by', 'across', 'per',
+    'suffering', 'from', 'diagnosed', 'their', 'that', 'which', 'and', 'to', 'please', 'can', 'you',
+    's', 'vs', 'versus', 'against', 'between', 'year', 'old',
+}
+
+# Words that flip or bound the meaning of a question. Two questions are only
+# interchangeable if they agree on all of them (and on every number).
+GUARD_WORDS = {
+    'not', 'no', 'non', 'without', 'never', 'over', 'under', 'above', 'below', 'more', 'less',
+    'least', 'most', 'greater', 'fewer', 'highest', 'lowest', 'top', 'bottom',
+    'female', 'male', 'older', 'younger', 'high', 'low', 'or',
+    # Aggregates (after SYNONYMS): an average is never a median or a total
+    'average', 'median', 'total', 'sum', 'min', 'max', 'count', 'percent', 'distribution',
+}
+
+# Canonical schema and cohort tokens (after SYNONYMS). Each one is a column or
+# filter, so a cached plan is only reused for exactly the same set of them.
+SCHEMA_TOKENS = {
+    'ckd', 'bmi', 'bp', 'thyroid', 'smoking', 'stress', 'sex', 'female', 'male', 'activity',
+    'pregnancy', 'hemoglobin', 'alcohol', 'salt', 'pedigree', 'age',
+}
+
+def _singular(word: str) -> str:
+    # Crude plural folding ("levels" -> "level"), enough for schema vocabulary
+    return word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')) else word
+
+def normalize_question(question: str) -> List[str]:
+    words = re.findall(r"[a-z]+|\d+(?:\.\d+)?", question.lower())
+    text = " ".join(_singular(w) for w in words)
+    for pattern, token in SYNONYMS:
+        text = re.sub(pattern, token, text)
+    return [w for w in text.split() if w not in STOPWORDS]
+
+def _features(tokens: List[str]) -> Counter:
+    features = Counter(tokens)
+    features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return features
+
+def _guards(tokens: List[str]) -> frozenset:
+    return frozenset(t for t in tokens if t in GUARD_WORDS or t in SCHEMA_TOKENS or t[0].isdigit())
+
+class QuestionCache:
+    """
+    Local TF-IDF index over previously answered questions (CPU only, no
+    network). A lookup above the similarity threshold returns the stored
+    decomposition plan and step SQL so the workflow can skip planning and
+    SQL generation. Only questions with the same guard and schema tokens
+    are compared.
+    """
+
+    def __init__(self, threshold: float = QUESTION_CACHE_THRESHOLD, max_entries: int = QUESTION_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _idf(self) -> Dict[str, float]:
+        n = len(self.entries)
+        document_frequency = Counter()
+        for entry in self.entries.values():
+            document_frequency.update(entry["features"].keys())
+        return {f: math.log((1 + n) / (1 + df)) + 1 for f, df in document_frequency.items()}
+
+    @staticmethod
+    def _cosine(a: Counter, b: Counter, idf: Dict[str, float], default_idf: float) -> float:
+        weights_a = {f: c * idf.get(f, default_idf) for f, c in a.items()}
+        weights_b = {f: c * idf.get(f, default_idf) for f, c in b.items()}
+        dot = sum(w * weights_b.get(f, 0.0) for f, w in weights_a.items())
+        norm = math.sqrt(sum(w * w for w in weights_a.values())) * math.sqrt(sum(w * w for w in weights_b.values()))
+        return dot / norm if norm else 0.0
+
+    def lookup(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns {"question", "similarity", "plan", "sql"} for the most similar
+        cached question above the threshold, or None.
+        """
+        tokens = normalize_question(question)
+        if not tokens:
+            return None
+        features, guards = _features(tokens), _guards(tokens)
+
+        with self.lock:
+            if not self.entries:
+                return None
+            idf = self._idf()
+            default_idf = math.log(1 + len(self.entries)) + 1
+            best_key, best_score = None, 0.0
+            for key, entry in self.entries.items():
+                if entry["guards"] != guards:
+                    continue
+                score = self._cosine(features, entry["features"], idf, default_idf)
+                if score > best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None or best_score < self.threshold:
+                return None
+
+            entry = self.entries[best_key]
+            self.entries.move_to_end(best_key)
+            entry["hits"] += 1
+            return {"question": entry["question"], "similarity": round(best_score, 3),
+                    "plan": entry["plan"], "sql": dict(entry["sql"])}
+
+    def add(self, question: str, plan: List[Dict[str, Any]], sql: Dict[int, str]):
+        """
+        Stores a fully successful plan with the SQL that ran for each step.
+        """
+        tokens = normalize_question(question)
+        if not tokens:
+            return
+        key = " ".join(tokens)
+        with self.lock:
+            self.entries[key] = {
+                "question": question,
+                "features": _features(tokens),
+                "guards": _guards(tokens),
+                "plan": plan,
+                "sql": dict(sql),
+                "hits": 0,
+                "created": time.time()
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+@lru_cache(maxsize=None)
+def get_question_cache() -> QuestionCache:
+    """
+    Process-wide cache shared by every session.
+    """
+    return QuestionCache()
@@ -0,0 +1,86 @@
+import math
+from typing import Any, Dict, List
+import pandas as pd
+
+# Rough heuristic for English/number-heavy text across common LLM tokenizers
+CHARS_PER_TOKEN = 4
+
+# Columns with at most this many distinct values get group totals
+MAX_GROUP_CARDINALITY = 12
+
+# Upper bound on sample rows kept when a result has to be compacted
+MAX_TOP_ROWS = 50
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def _schema_section(df: pd.DataFrame) -> str:
+    return "Columns: " + ", ".join(f"{col} ({dtype})" for col, dtype in df.dtypes.items())
+
+def _numeric_section(df: pd.DataFrame) -> str:
+    numeric = df.select_dtypes(include='number')
+    if numeric.empty:
+        return ""
+    summary = numeric.describe().T[['mean', 'min', 'max']]
+    summary.insert(0, 'sum', numeric.sum())
+    return "Numeric Summary:\n" + summary.round(3).to_string()
+
+def _group_section(df: pd.DataFrame) -> str:
+    group_cols = [col for col in df.columns if df[col].nunique(dropna=False) <= MAX_GROUP_CARDINALITY]
+    value_cols = [col for col in df.select_dtypes(include='number').columns if col not in group_cols]
+    lines = []
+    for col in group_cols:
+        grouped = df.groupby(col, dropna=False)
+        totals = grouped[value_cols].sum() if value_cols else pd.DataFrame(index=grouped.size().index)
+        totals.insert(0, 'rows', grouped.size())
+        lines.append(f"Group Totals by {col}:\n{totals.round(3).to_string()}")
+    return "\n".join(lines)
+
+def compact_dataframe(df: pd.DataFrame, token_budget: int) -> Dict[str, Any]:
+    """
+    Converts a step result into a text representation that fits the token budget.
+    Small results are passed through verbatim; large ones are replaced by schema,
+    row count, numeric summaries, group totals and as many top rows as fit.
+    Returns {"text", "original_tokens", "compact_tokens"}.
+    """
+    full_text = df.to_string(index=False)
+    original_tokens = estimate_tokens(full_text)
+
+    if original_tokens <= token_budget:
+        return {"text": full_text, "original_tokens": original_tokens, "compact_tokens": original_tokens}
+
+    header = f"Rows: {len(df)} (showing a compacted summary)\n{_schema_section(df)}"
+    optional_sections = [s for s in [_numeric_section(df), _group_section(df)] if s]
+
+    # Shrink the sample of rows first, then drop the least important sections
+    text = header
+    while True:
+        fixed = "\n".join([header] + optional_sections)
+        k = min(len(df), MAX_TOP_ROWS)
+        while k >= 1:
+            candidate = f"{fixed}\nTop {k} Rows:\n{df.head(k).to_string(index=False)}"
+            if estimate_tokens(candidate) <= token_budget:
+                text = candidate
+                break
+            k //= 2
+        if k >= 1 or not optional_sections:
+            break
+        optional_sections.pop()
+
+    if k < 1:
+        text = "\n".join([header] + optional_sections)[:token_budget * CHARS_PER_TOKEN]
+
+    return {"text": text, "original_tokens": original_tokens, "compact_tokens": estimate_tokens(text)}
+
+def summarize_compaction(compactions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Aggregates per-step compaction results into a report for the workflow output.
+    """
+    original = sum(c["original_tokens"] for c in compactions)
+    compact = sum(c["compact_tokens"] for c in compactions)
+    return {
+        "original_tokens": original,
+        "compact_tokens": compact,
+        "tokens_saved": original - compact,
+        "compression_ratio": round(original / compact, 2) if compact else 1.0
+    }
@@ -1,42 +1,361 @@
+import os
+import re
+import json
+import time
+import uuid
+import tempfile
+from functools import lru_cache
 import duckdb
 import pandas as pd
 import streamlit as st
+from src.zone_maps import compute_table_stats
+
+# Optional persisted mode: one DuckDB file per session under this directory,
+# reattached on browser refresh or worker restart. Empty keeps the in-memory database.
+SESSION_DB_DIR = os.getenv('SESSION_DB_DIR', '')
+
+# Session files untouched for this long are deleted
+SESSION_DB_MAX_AGE_DAYS = float(os.getenv('SESSION_DB_MAX_AGE_DAYS', 7))
+
+# uploaded_tables metadata, stored next to the tables it describes
+METADATA_TABLE = '_uploaded_tables'
+
+# In-memory budget per session for uploaded tables. Past it, the least
+# recently used tables are offloaded to Parquet and kept as views.
+SESSION_MEMORY_QUOTA_MB = int(os.getenv('SESSION_MEMORY_QUOTA_MB', 512))
+SESSION_OFFLOAD_DIR = os.getenv('SESSION_OFFLOAD_DIR') or os.path.join(tempfile.gettempdir(), 'neurohealth_offload')
+
+# Uncompressed bytes per value, for memory accounting (VARCHAR is measured)
+TYPE_BYTES = {
+    'BOOLEAN': 1, 'TINYINT': 1, 'UTINYINT': 1, 'SMALLINT': 2, 'USMALLINT': 2,
+    'INTEGER': 4, 'UINTEGER': 4, 'FLOAT': 4, 'DATE': 4,
+    'BIGINT': 8, 'UBIGINT': 8, 'DOUBLE': 8, 'TIMESTAMP': 8, 'HUGEINT': 16
+}
+
+def get_session_id() -> str:
+    """
+    Session id kept in the page URL (?sid=...), so a refresh or reconnect
+    finds the same database file.
+    """
+    sid = st.query_params.get('sid', '')
+    if not re.fullmatch(r'[A-Za-z0-9_-]{8,64}', sid):
+        sid = uuid.uuid4().hex
+        st.query_params['sid'] = sid
+    return sid
+
+def cleanup_session_dbs(directory: str, max_age_days: float = SESSION_DB_MAX_AGE_DAYS,
+                        suffixes: tuple = ('.duckdb', '.duckdb.wal')) -> int:
+    """
+    Deletes session database (or offload) files not used for `max_age_days`.
+    Returns the number of files removed.
+    """
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.endswith(suffixes):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            print(f"Session DB cleanup error ({name}): {e}")
+    return removed
+
+@lru_cache(maxsize=None)
+def _cleanup_once(directory: str, suffixes: tuple = ('.duckdb', '.duckdb.wal')) -> int:
+    # Once per process, when the first session opens
+    return cleanup_session_dbs(directory, suffixes=suffixes)
+
+def estimate_table_bytes(conn, table_name: str) -> int:
+    """
+    Uncompressed size estimate: rows x fixed type widths, with VARCHAR
+    widths from the average length over a sample.
+    """
+    rows = conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+    if not rows:
+        return 0
+    width = 0
+    varchars = []
+    for col, data_type in conn.execute(f"SELECT column_name, data_type FROM duckdb_columns() "
+                                       f"WHERE table_name = '{table_name}' AND database_name = current_database() "
+                                       f"AND schema_name = 'main'").fetchall():
+        if data_type == 'VARCHAR':
+            varchars.append(col)
+        else:
+            width += TYPE_BYTES.get(data_type.split('(')[0], 8)
+    if varchars:
+        lengths = conn.execute(
+            "SELECT " + ", ".join(f'COALESCE(AVG(strlen("{c}")), 0)' for c in varchars) +
+            f' FROM (SELECT * FROM "{table_name}" USING SAMPLE 10000)').fetchone()
+        # 16-byte string header, inlined up to 12 bytes
+        width += sum(16 + (length if length > 12 else 0) for length in lengths)
+    return int(rows * width)
 
 class SessionDatabaseManager:
-    
+
     def __init__(self):
         if 'duckdb_conn' not in st.session_state:
-            st.session_state.duckdb_conn = duckdb.connect(':memory:')
-            st.session_state.uploaded_tables = {}
+            if SESSION_DB_DIR:
+                st.session_state.duckdb_conn, st.session_state.uploaded_tables = self._open_persisted()
+            else:
+                st.session_state.duckdb_conn = duckdb.connect(':memory:')
+                st.session_state.uploaded_tables = {}
+            st.session_state.offload_prefix = uuid.uuid4().hex[:12]
         self.conn = st.session_state.duckdb_conn
         self.tables = st.session_state.uploaded_tables
-    
+        self.offload_prefix = st.session_state.offload_prefix
+        self.persisted = bool(SESSION_DB_DIR)
+
+    def _open_persisted(self):
+        """
+        Opens (or reattaches) this session's database file and reloads its
+        table metadata. Tables are not read, so this is fast at any size.
+        """
+        os.makedirs(SESSION_DB_DIR, exist_ok=True)
+        _cleanup_once(SESSION_DB_DIR)
+        path = os.path.join(SESSION_DB_DIR, f"{get_session_id()}.duckdb")
+        if os.path.exists(path):
+            # Mark as in use so cleanup keeps it
+            os.utime(path)
+
+        conn = duckdb.connect(path)
+        # Tables live in the file here, so the quota caps DuckDB's buffer pool:
+        # past it, cold pages are evicted to the file instead of offloaded
+        conn.execute(f"SET memory_limit = '{SESSION_MEMORY_QUOTA_MB}MB'")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+                table_name VARCHAR PRIMARY KEY,
+                type VARCHAR,
+                rows BIGINT,
+                columns VARCHAR,
+                file_name VARCHAR,
+                created_at DOUBLE
+            )
+        """)
+        # Content hash and uploaded file name, for src.ingestion deduplication
+        conn.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS sha256 VARCHAR")
+        conn.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS source VARCHAR")
+        # Memory estimate and zone maps (JSON), so reattaching doesn't scan the tables
+        conn.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS bytes BIGINT")
+        conn.execute(f"ALTER TABLE {METADATA_TABLE} ADD COLUMN IF NOT EXISTS stats VARCHAR")
+        existing = {row[0] for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+        for table_name in existing:
+            if table_name.startswith('_staging_'):
+                # Upload interrupted before it was registered
+                conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        tables = {}
+        for table_name, data_type, rows, columns, file_name, sha256, source, size, stats in conn.execute(
+                f"SELECT table_name, type, rows, columns, file_name, sha256, source, bytes, stats "
+                f"FROM {METADATA_TABLE} ORDER BY created_at").fetchall():
+            if table_name not in existing:
+                # Metadata left behind by an interrupted write
+                conn.execute(f"DELETE FROM {METADATA_TABLE} WHERE table_name = ?", [table_name])
+                continue
+            tables[table_name] = {
+                'type': data_type,
+                'rows': rows,
+                'columns': json.loads(columns),
+                'file_name': file_name,
+                'sha256': sha256,
+                'source': source,
+                'bytes': size,
+                'stats': json.loads(stats) if stats else None,
+                'last_used': time.time(),
+                'offloaded': None
+            }
+            if size is None or stats is None:
+                # Saved before these were stored: computed once, then kept
+                tables[table_name]['bytes'] = estimate_table_bytes(conn, table_name)
+                tables[table_name]['stats'] = compute_table_stats(conn, table_name)
+                conn.execute(f"UPDATE {METADATA_TABLE} SET bytes = ?, stats = ? WHERE table_name = ?", [
+                    tables[table_name]['bytes'], json.dumps(tables[table_name]['stats']), table_name
+                ])
+        return conn, tables
+
+    def _save_metadata(self, table_name: str):
+        if not self.persisted:
+            return
+        meta = self.tables[table_name]
+        self.conn.execute(f"""
+            INSERT OR REPLACE INTO {METADATA_TABLE}
+                (table_name, type, rows, columns, file_name, created_at, sha256, source, bytes, stats)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            table_name, meta['type'], meta['rows'], json.dumps(meta['columns']), meta['file_name'], time.time(),
+            meta.get('sha256'), meta.get('source'), meta.get('bytes'),
+            json.dumps(meta['stats']) if meta.get('stats') else None
+        ])
+
+    def _delete_metadata(self, table_name: str):
+        if self.persisted:
+            self.conn.execute(f"DELETE FROM {METADATA_TABLE} WHERE table_name = ?", [table_name])
+
+    # --- Memory Accounting ---
+
+    def touch(self, table_names):
+        now = time.time()
+        for name in table_names:
+            if name in self.tables:
+                self.tables[name]['last_used'] = now
+                if self.tables[name].get('offloaded'):
+                    os.utime(self.tables[name]['offloaded'])
+
+    def memory_usage(self) -> dict:
+        if self.persisted:
+            # Everything is in the session file; memory is what the buffer pool holds
+            return {
+                'used_bytes': self.conn.execute("SELECT SUM(memory_usage_bytes) FROM duckdb_memory()").fetchone()[0],
+                'offloaded_bytes': sum(m.get('bytes', 0) for m in self.tables.values()),
+                'quota_bytes': SESSION_MEMORY_QUOTA_MB * 1024 * 1024
+            }
+        in_memory = sum(m.get('bytes', 0) for m in self.tables.values() if not m.get('offloaded'))
+        on_disk = sum(m.get('bytes', 0) for m in self.tables.values() if m.get('offloaded'))
+        return {
+            'used_bytes': in_memory,
+            'offloaded_bytes': on_disk,
+            'quota_bytes': SESSION_MEMORY_QUOTA_MB * 1024 * 1024
+        }
+
+    def _offload(self, table_name: str):
+        os.makedirs(SESSION_OFFLOAD_DIR, exist_ok=True)
+        _cleanup_once(SESSION_OFFLOAD_DIR, ('.parquet',))
+        path = os.path.join(SESSION_OFFLOAD_DIR, f"{self.offload_prefix}_{table_name}.parquet")
+        self.conn.execute(f"COPY {table_name} TO '{path}' (FORMAT PARQUET)")
+        try:
+            self.conn.execute("BEGIN TRANSACTION")
+            self.conn.execute(f"DROP TABLE {table_name}")
+            self.conn.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{path}')")
+            self.conn.execute("COMMIT")
+        except Exception:
+            # The table stays in memory; its Parquet copy is not referenced
+            self.conn.execute("ROLLBACK")
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        self.tables[table_name]['offloaded'] = path
+        print(f"Offloaded {table_name} ({self.tables[table_name]['bytes'] / 1e6:.1f} MB) to {path}")
+
+    def enforce_quota(self, protect=()):
+        """
+        Offloads least recently used tables until the in-memory total fits the
+        session quota; `protect` (just-loaded tables) go last. Persisted
+        sessions are file-backed already: their quota is DuckDB's
+        memory_limit, set when the file is opened.
+        """
+        if self.persisted:
+            return
+        usage = self.memory_usage()
+        excess = usage['used_bytes'] - usage['quota_bytes']
+        if excess <= 0:
+            return
+        candidates = sorted((name for name, meta in self.tables.items() if not meta.get('offloaded')),
+                            key=lambda name: (name in protect, self.tables[name]['last_used']))
+        for name in candidates:
+            if excess <= 0:
+                break
+            try:
+                self._offload(name)
+                excess -= self.tables[name]['bytes']
+            except Exception as e:
+                print(f"Offload error ({name}): {e}")
+
+    def _drop(self, table_name: str):
+        path = self.tables[table_name].get('offloaded')
+        if path:
+            self.conn.execute(f"DROP VIEW IF EXISTS {table_name}")
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+
     def create_table_from_df(self, df: pd.DataFrame, table_name: str, data_type: str):
+        if table_name in self.tables:
+            self._drop(table_name)
         self.conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM df")
         self.tables[table_name] = {
             'type': data_type,
             'rows': len(df),
             'columns': list(df.columns),
-            'file_name': table_name
+            'file_name': table_name,
+            'bytes': estimate_table_bytes(self.conn, table_name),
+            'stats': compute_table_stats(self.conn, table_name),
+            'last_used': time.time(),
+            'offloaded': None
         }
-    
+        self._save_metadata(table_name)
+        self.enforce_quota(protect=(table_name,))
+
+    def commit_staged(self, staged: list):
+        """
+        Registers tables prepared by src.ingestion in one transaction: each
+        staging table is renamed to its final name and its metadata saved.
+        On failure nothing is registered, tables being replaced keep their
+        metadata, and the staging tables are dropped.
+        """
+        if not staged:
+            return
+        previous = {r['table_name']: self.tables.get(r['table_name']) for r in staged}
+        try:
+            self.conn.execute("BEGIN TRANSACTION")
+            for r in staged:
+                replaced = previous[r['table_name']]
+                if replaced and replaced.get('offloaded'):
+                    self.conn.execute(f"DROP VIEW IF EXISTS {r['table_name']}")
+                else:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {r['table_name']}")
+                self.conn.execute(f"ALTER TABLE {r['staging']} RENAME TO {r['table_name']}")
+                self.tables[r['table_name']] = {
+                    'type': r['data_type'],
+                    'rows': r['rows'],
+                    'columns': r['columns'],
+                    'file_name': r['table_name'],
+                    'sha256': r['sha256'],
+                    'source': r['file_name'],
+                    'bytes': estimate_table_bytes(self.conn, r['table_name']),
+                    # Zone maps, computed on the worker at ingest time
+                    'stats': r.get('stats') or compute_table_stats(self.conn, r['table_name']),
+                    'last_used': time.time(),
+                    'offloaded': None
+                }
+                self._save_metadata(r['table_name'])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            for name, meta in previous.items():
+                if meta is None:
+                    self.tables.pop(name, None)
+                else:
+                    self.tables[name] = meta
+            for r in staged:
+                self.conn.execute(f"DROP TABLE IF EXISTS {r['staging']}")
+            raise
+        # Parquet files of replaced offloaded tables are only removed once committed
+        for meta in previous.values():
+            if meta and meta.get('offloaded') and os.path.exists(meta['offloaded']):
+                os.remove(meta['offloaded'])
+        self.enforce_quota(protect=[r['table_name'] for r in staged])
+
     def execute_query(self, query: str) -> pd.DataFrame:
         return self.conn.execute(query).df()
-    
+
     def get_uploaded_sources(self) -> dict:
         return self.tables
-    
+
     def remove_table(self, table_name: str):
         if table_name in self.tables:
-            self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+            self._drop(table_name)
             del self.tables[table_name]
+            self._delete_metadata(table_name)
             return True
         return False
-    
+
     def clear_all(self):
         for table in list(self.tables.keys()):
-            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._drop(table)
+            self._delete_metadata(table)
         self.tables.clear()
-    
+
     def table_exists(self, table_name: str) -> bool:
         return table_name in self.tables
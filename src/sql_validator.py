@@ -0,0 +1,83 @@
+import re
+import threading
+from functools import lru_cache
+import duckdb
+
+# Empty tables mirroring supabase_schema.sql. EXPLAIN against them parses and
+# binds a query (tables, columns, types) without touching any data.
+SCHEMA_DDL = """
+CREATE TABLE patients (
+    patient_number INTEGER,
+    blood_pressure_abnormality INTEGER,
+    level_of_hemoglobin DOUBLE,
+    genetic_pedigree_coefficient DOUBLE,
+    age INTEGER,
+    bmi INTEGER,
+    sex INTEGER,
+    pregnancy DOUBLE,
+    smoking INTEGER,
+    salt_content_in_the_diet INTEGER,
+    alcohol_consumption_per_day DOUBLE,
+    level_of_stress INTEGER,
+    chronic_kidney_disease INTEGER,
+    adrenal_and_thyroid_disorders INTEGER
+);
+CREATE TABLE activity (
+    id BIGINT,
+    patient_number INTEGER,
+    day_number INTEGER,
+    physical_activity DOUBLE
+);
+"""
+
+class SQLValidator:
+    """
+    Cheap local checks for generated SQL before it is sent to Supabase or the
+    federated engine: single read-only statement that parses and binds.
+    """
+
+    def __init__(self):
+        self.conn = duckdb.connect(':memory:')
+        self.conn.execute(SCHEMA_DDL)
+        self.lock = threading.Lock()
+
+    def validate(self, sql: str):
+        """
+        Returns (is_valid, error_message).
+        Errors that only reflect DuckDB/PostgreSQL dialect differences (e.g. a
+        function DuckDB does not know) are not treated as invalid.
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+
+        try:
+            statements = cursor.extract_statements(sql)
+            if len(statements) != 1:
+                return False, f"Expected exactly one SQL statement, got {len(statements)}."
+            if statements[0].type != duckdb.StatementType.SELECT:
+                return False, f"Only SELECT queries are allowed, got {statements[0].type.name}."
+
+            cursor.execute(f"EXPLAIN {sql}")
+            return True, ""
+
+        except duckdb.ParserException as e:
+            return False, str(e)
+        except duckdb.BinderException as e:
+            # Only unknown tables/columns are certain errors; the rest ("No
+            # function matches", casts...) may be DuckDB/PostgreSQL differences
+            if re.search(r'not found|does not have a column', str(e)):
+                return False, str(e)
+            return True, ""
+        except duckdb.CatalogException as e:
+            if "Function with name" in str(e):
+                return True, ""
+            return False, str(e)
+        except duckdb.Error:
+            # Anything else is likely a dialect gap; let PostgreSQL decide
+            return True, ""
+        finally:
+            cursor.close()
+
+@lru_cache(maxsize=None)
+def get_sql_validator() -> SQLValidator:
+    return SQLValidator()
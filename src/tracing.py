@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# Append-only JSONL log of agent traces (one line per workflow run)
+TRACE_LOG_PATH = os.getenv('AGENT_TRACE_LOG', os.path.join('logs', 'agent_traces.jsonl'))
+
+_log_lock = threading.Lock()
+
+class Tracer:
+    """
+    Collects timed spans for one agent workflow run.
+    Each span records wall time, prompt/completion tokens, LLM calls, retries
+    and cache hit status for a stage (decomposition, sql_generation, ...).
+    """
+
+    def __init__(self, query: str, log_path: Optional[str] = None):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.query = query
+        # An empty path disables logging
+        self.log_path = TRACE_LOG_PATH if log_path is None else log_path
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.calls: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        record = {
+            "stage": stage,
+            "start_ms": round((time.perf_counter() - self._t0) * 1000, 1),
+            "duration_ms": 0.0,
+            "llm_calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "retries": 0,
+            "cache_hit": False,
+            **attrs
+        }
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self.spans.append(record)
+
+    def record_call(self, stage: str, model: str, duration_ms: float, prompt_tokens: int = 0,
+                    completion_tokens: int = 0):
+        """
+        Records one LLM call, so latency can be compared per stage and model.
+        """
+        with self.lock:
+            self.calls.append({"stage": stage, "model": model, "duration_ms": round(duration_ms, 1),
+                               "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+
+    def model_summary(self) -> List[Dict[str, Any]]:
+        groups: Dict[Any, Dict[str, Any]] = {}
+        for call in self.calls:
+            group = groups.setdefault((call["stage"], call["model"]), {
+                "stage": call["stage"], "model": call["model"], "calls": 0, "duration_ms": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0})
+            group["calls"] += 1
+            group["duration_ms"] = round(group["duration_ms"] + call["duration_ms"], 1)
+            group["prompt_tokens"] += call["prompt_tokens"]
+            group["completion_tokens"] += call["completion_tokens"]
+        for group in groups.values():
+            group["avg_ms"] = round(group["duration_ms"] / group["calls"], 1)
+        return list(groups.values())
+
+    def summary(self) -> Dict[str, Any]:
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            stage = stages.setdefault(span["stage"], {"count": 0, "duration_ms": 0.0, "prompt_tokens": 0,
+                                                      "completion_tokens": 0, "retries": 0, "cache_hits": 0})
+            stage["count"] += 1
+            stage["duration_ms"] = round(stage["duration_ms"] + span["duration_ms"], 1)
+            stage["prompt_tokens"] += span["prompt_tokens"]
+            stage["completion_tokens"] += span["completion_tokens"]
+            stage["retries"] += span["retries"]
+            stage["cache_hits"] += int(span["cache_hit"])
+        return stages
+
+    def finish(self, success: bool) -> Dict[str, Any]:
+        """
+        Closes the trace, appends it to the log and returns it as a dict.
+        """
+        trace = {
+            "trace_id": self.trace_id,
+            "timestamp": self.started_at,
+            "query": self.query,
+            "success": success,
+            "total_ms": round((time.perf_counter() - self._t0) * 1000, 1),
+            "llm_calls": sum(s["llm_calls"] for s in self.spans),
+            "prompt_tokens": sum(s["prompt_tokens"] for s in self.spans),
+            "completion_tokens": sum(s["completion_tokens"] for s in self.spans),
+            "stages": self.summary(),
+            "models": self.model_summary(),
+            "spans": self.spans
+        }
+        self.save(trace)
+        return trace
+
+    def save(self, trace: Dict[str, Any]):
+        if not self.log_path:
+            return
+        try:
+            with _log_lock:
+                os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(trace, default=str) + "\n")
+        except OSError as e:
+            print(f"Trace log write error: {e}")
+
+def read_traces(log_path: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    Returns the most recent traces from the log, newest last.
+    """
+    log_path = log_path or TRACE_LOG_PATH
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()[-limit:]
+    return [json.loads(line) for line in lines if line.strip()]
@@ -0,0 +1,162 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from src.plan_optimizer import normalize_sql, TABLE_COLUMNS
+
+# Per-source column statistics ("zone maps") for the federated engine.
+# Every uploaded table and the shared base snapshot keep exact row/null counts
+# and min/max per column, computed once when they are created. A query that
+# filters on a column can then skip sources whose range can't match, and
+# COUNT/MIN/MAX over a whole table is answered without scanning anything.
+#
+# Only single-table, single-SELECT queries with AND-ed `column op number`
+# predicates are considered; anything else runs as before.
+
+# Predicates compare against numeric literals only
+ORDERABLE_TYPES = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'FLOAT', 'DOUBLE')
+
+NUMBER = r'-?\d+(?:\.\d+)?'
+
+SIMPLE_QUERY = re.compile(
+    r'^SELECT (?P<select>.+?) FROM (?P<table>' + '|'.join(TABLE_COLUMNS) + r')'
+    r'(?: (?:AS )?(?P<alias>(?!WHERE\b|GROUP\b|ORDER\b|LIMIT\b|HAVING\b)\w+))?'
+    r'(?: WHERE (?P<where>.+?))?'
+    r'(?P<tail> (?:GROUP BY|HAVING|ORDER BY|LIMIT) .*)?$', re.I)
+
+COMPARISON = re.compile(r'^(?:(?P<alias>\w+)\.)?(?P<col>\w+) ?(?P<op><=|>=|<>|!=|=|<|>) ?(?P<value>' + NUMBER + r')$')
+FLIPPED = {'<': '>', '>': '<', '<=': '>=', '>=': '<=', '=': '=', '<>': '<>', '!=': '!='}
+# NOT BETWEEN is never rewritten: its complement isn't an AND of bounds
+BETWEEN = re.compile(r'\b(?!NOT\b)((?:\w+\.)?\w+) BETWEEN (' + NUMBER + r') AND (' + NUMBER + r')', re.I)
+
+AGGREGATE = re.compile(r'^(?P<fn>COUNT|MIN|MAX)\((?:(?P<star>\*)|(?:\w+\.)?(?P<col>\w+))\)(?: AS \w+)?$', re.I)
+
+def compute_table_stats(conn, table_name: str, database: str = None) -> Dict[str, Any]:
+    """
+    {'rows': n, 'columns': {col: {'min', 'max', 'nulls', 'distinct'}}} in one
+    scan. min/max are kept for orderable types only; distinct is approximate.
+    """
+    database = database or conn.execute("SELECT current_database()").fetchone()[0]
+    columns = conn.execute(
+        "SELECT column_name, data_type FROM duckdb_columns() "
+        "WHERE database_name = ? AND schema_name = 'main' AND table_name = ?",
+        [database, table_name]).fetchall()
+    exprs = ["COUNT(*)"]
+    for col, data_type in columns:
+        orderable = data_type in ORDERABLE_TYPES
+        exprs += [f'MIN("{col}")' if orderable else 'NULL', f'MAX("{col}")' if orderable else 'NULL',
+                  f'COUNT("{col}")', f'APPROX_COUNT_DISTINCT("{col}")']
+    row = conn.execute(f'SELECT {", ".join(exprs)} FROM "{database}".main."{table_name}"').fetchone()
+
+    stats = {'rows': row[0], 'columns': {}}
+    for i, (col, data_type) in enumerate(columns):
+        low, high, non_null, distinct = row[1 + i * 4:5 + i * 4]
+        stats['columns'][col.lower()] = {
+            'min': low, 'max': high, 'nulls': row[0] - non_null, 'distinct': distinct,
+            'orderable': data_type in ORDERABLE_TYPES
+        }
+    return stats
+
+def parse_simple_query(sql: str) -> Optional[Dict[str, str]]:
+    """
+    Splits a single-table, single-SELECT query into its parts, or None.
+    """
+    sql = normalize_sql(sql)
+    if len(re.findall(r'\bselect\b', sql, re.I)) != 1 or re.search(r'\b(join|union|with)\b', sql, re.I):
+        return None
+    match = SIMPLE_QUERY.match(sql)
+    if not match:
+        return None
+    parts = {k: (v or '').strip() for k, v in match.groupdict().items()}
+    parts['table'] = parts['table'].lower()
+    return parts
+
+def parse_predicates(query: Dict[str, str]) -> Optional[List[Tuple[str, str, float]]]:
+    """
+    (column, op, number) for the top-level AND-ed comparisons of the WHERE
+    clause, on the table's own schema columns. Other conjuncts (anything
+    with NOT, IN, LIKE, ...) are ignored, which is safe for pruning: a source
+    that fails one conjunct can't return rows. None if the clause has OR or
+    parentheses.
+    """
+    where = query['where']
+    if not where or '(' in where or re.search(r'\bor\b', where, re.I):
+        return None
+    where = BETWEEN.sub(r'\1 >= \2 AND \1 <= \3', where)
+    predicates = []
+    for conjunct in re.split(r' and ', where, flags=re.I):
+        conjunct = conjunct.strip()
+        if re.search(r'\bnot\b', conjunct, re.I):
+            continue
+        match = COMPARISON.match(conjunct)
+        op = match.group('op') if match else None
+        if not match:
+            # 60 <= age
+            flipped = re.match(r'^(' + NUMBER + r') ?(<=|>=|<>|!=|=|<|>) ?((?:\w+\.)?\w+)$', conjunct)
+            if not flipped:
+                continue
+            match = COMPARISON.match(f"{flipped.group(3)} {FLIPPED[flipped.group(2)]} {flipped.group(1)}")
+            op = match.group('op')
+        if match.group('alias') and match.group('alias').lower() not in (query['alias'].lower(), query['table']):
+            continue
+        if match.group('col').lower() not in TABLE_COLUMNS[query['table']]:
+            continue
+        predicates.append((match.group('col').lower(), op, float(match.group('value'))))
+    return predicates
+
+def can_match(stats: Dict[str, Any], predicates: List[Tuple[str, str, float]]) -> bool:
+    """
+    False only when the statistics prove no row of the source satisfies
+    every predicate; missing statistics mean it may match.
+    """
+    if stats is None:
+        return True
+    if stats['rows'] == 0:
+        return False
+    for col, op, value in predicates:
+        s = stats['columns'].get(col)
+        if s is None:
+            continue
+        if s['nulls'] == stats['rows']:
+            return False
+        low, high = s['min'], s['max']
+        if not s['orderable'] or low is None:
+            continue
+        if op == '=' and not (low <= value <= high):
+            return False
+        if op == '>' and not high > value:
+            return False
+        if op == '>=' and not high >= value:
+            return False
+        if op == '<' and not low < value:
+            return False
+        if op == '<=' and not low <= value:
+            return False
+        if op in ('<>', '!=') and low == high == value:
+            return False
+    return True
+
+def answer_from_stats(query: Dict[str, str], sources: List[Dict[str, Any]]) -> Optional[List[Any]]:
+    """
+    Values for a `SELECT COUNT(*)/COUNT(col)/MIN(col)/MAX(col), ... FROM table`
+    with no WHERE or GROUP BY, combined over all sources; None if any item
+    can't be answered exactly from the statistics.
+    """
+    if query['where'] or (query['tail'] and not re.match(r'^LIMIT [1-9]\d*$', query['tail'], re.I)):
+        return None
+    values = []
+    for item in query['select'].split(','):
+        match = AGGREGATE.match(item.strip())
+        if not match:
+            return None
+        fn, col = match.group('fn').upper(), (match.group('col') or '').lower()
+        if fn == 'COUNT':
+            if match.group('star'):
+                values.append(sum(s['rows'] for s in sources))
+            else:
+                values.append(sum(s['rows'] - s['columns'][col]['nulls'] for s in sources if col in s['columns']))
+            continue
+        present = [s['columns'][col] for s in sources if col in s['columns'] and s['columns'][col]['nulls'] < s['rows']]
+        if any(not c['orderable'] for c in present):
+            return None
+        bounds = [c['min' if fn == 'MIN' else 'max'] for c in present]
+        values.append((min(bounds) if fn == 'MIN' else max(bounds)) if bounds else None)
+    return values
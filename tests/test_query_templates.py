@@ -0,0 +1,21 @@
+import pytest
+from src.query_templates import match_template
+
+@pytest.mark.parametrize("question, population, numerator", [
+    ("What percentage of CKD patients smoke?", "chronic_kidney_disease = 1", "smoking = 1"),
+    ("percentage of smokers with CKD", "smoking = 1", "chronic_kidney_disease = 1"),
+    ("percentage of ckd patients with high stress", "chronic_kidney_disease = 1", "level_of_stress = 3"),
+])
+def test_percentage_population_is_the_denominator(question, population, numerator):
+    template = match_template(question)
+    assert template["template"] == "cohort_percentage"
+    assert template["sql"].endswith(f"FROM patients WHERE {population}")
+    assert f"SUM(CASE WHEN {numerator} THEN 1 ELSE 0 END)" in template["sql"]
+
+def test_ambiguous_percentage_goes_to_the_agent():
+    assert match_template("percentage of ckd smokers") is None
+
+def test_distribution_of_cohort_filters_instead_of_grouping():
+    template = match_template("what is the age distribution of ckd patients")
+    assert "AS age_group" in template["sql"]
+    assert "WHERE chronic_kidney_disease = 1" in template["sql"]
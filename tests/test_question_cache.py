@@ -0,0 +1,20 @@
+import pytest
+from src.question_cache import QuestionCache
+
+@pytest.fixture
+def cache():
+    # Low threshold: the guards, not the similarity, must tell these apart
+    cache = QuestionCache(threshold=0.5)
+    cache.add("What is the average BMI of CKD patients who smoke?", [{"step_id": 1}], {1: "SELECT AVG(bmi) ..."})
+    return cache
+
+def test_rephrasing_reuses_the_plan(cache):
+    assert cache.lookup("what is the mean body mass index of ckd patients who smoke") is not None
+
+@pytest.mark.parametrize("question", [
+    "What is the median BMI of CKD patients who smoke?",
+    "What is the maximum BMI of CKD patients who smoke?",
+    "What is the average BMI of CKD patients or smokers?",
+])
+def test_different_aggregate_or_logic_misses(cache, question):
+    assert cache.lookup(question) is None